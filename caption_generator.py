@@ -19,15 +19,53 @@ from __future__ import division
 from __future__ import print_function
 
 import heapq
-import math
 
 
 import numpy as np
 
 
+def _top_k_words(softmax, k):
+  """Finds the k most probable next words for each row of a softmax matrix.
+
+  Ties are broken in favor of the smaller word id, so the selected words match
+  those of a stable descending sort of each row.
+
+  Args:
+    softmax: A numpy array of shape [batch_size, vocab_size].
+    k: Number of words to keep for each row.
+
+  Returns:
+    word_ids: An integer numpy array of shape [batch_size, min(k, vocab_size)].
+      The word ids within each row are not sorted.
+    probabilities: A numpy array with the same shape as word_ids containing the
+      corresponding softmax values.
+  """
+  batch_size, vocab_size = softmax.shape
+  rows = np.arange(batch_size)[:, np.newaxis]
+  if k >= vocab_size:
+    word_ids = np.tile(np.arange(vocab_size), (batch_size, 1))
+    return word_ids, softmax
+  word_ids = np.argpartition(softmax, vocab_size - k, axis=1)[:, -k:]
+
+  # argpartition breaks ties arbitrarily. Redo the selection for the (rare) rows
+  # where words tied with the k-th largest probability did not all make it in.
+  kth_largest = softmax[rows, word_ids].min(axis=1)[:, np.newaxis]
+  num_above = np.sum(softmax > kth_largest, axis=1)
+  num_tied = np.sum(softmax == kth_largest, axis=1)
+  for i in np.flatnonzero(num_above + num_tied > k):
+    row = softmax[i]
+    above = np.flatnonzero(row > kth_largest[i])
+    tied = np.flatnonzero(row == kth_largest[i])[:k - len(above)]
+    word_ids[i] = np.concatenate([above, tied])
+
+  return word_ids, softmax[rows, word_ids]
+
+
 class Caption(object):
   """Represents a complete or partial caption."""
 
+  __slots__ = ("sentence", "state", "logprob", "score", "metadata")
+
   def __init__(self, sentence, state, logprob, score, metadata=None):
     """Initializes the Caption.
 
@@ -85,6 +123,11 @@ class TopN(object):
     else:
       heapq.heappushpop(self._data, x)
 
+  def min(self):
+    """Returns the smallest element without removing it."""
+    assert self._data
+    return self._data[0]
+
   def extract(self, sort=False):
     """Extracts all elements from the TopN. This is a destructive operation.
 
@@ -108,6 +151,38 @@ class TopN(object):
     self._data = []
 
 
+class _CaptionRef(object):
+  """A complete caption that is stored in the beam history.
+
+  The sentence and metadata are only materialized, via back-pointers, if the
+  caption is among the final results.
+  """
+
+  __slots__ = ("score", "logprob", "step", "index", "state")
+
+  def __init__(self, score, logprob, step, index, state):
+    """Initializes the reference.
+
+    Args:
+      score: Score of the caption.
+      logprob: Log-probability of the caption.
+      step: Beam search step at which the end word was generated.
+      index: Index of the parent beam within that step.
+      state: Model state after generating the end word.
+    """
+    self.score = score
+    self.logprob = logprob
+    self.step = step
+    self.index = index
+    self.state = state
+
+  def __lt__(self, other):
+    return self.score < other.score
+
+  def __eq__(self, other):
+    return self.score == other.score
+
+
 class CaptionGenerator(object):
   """Class to generate captions from an image-to-text model."""
 
@@ -116,13 +191,17 @@ class CaptionGenerator(object):
                vocab,
                beam_size=3,
                max_caption_length=20,
-               length_normalization_factor=0.0):
+               length_normalization_factor=0.0,
+               word_shortlist=None):
     """Initializes the generator.
 
     Args:
       model: Object encapsulating a trained image-to-text model. Must have
-        methods feed_image() and inference_step(). For example, an instance of
-        InferenceWrapperBase.
+        methods feed_image() and inference_step(), and may have feed_images()
+        for feeding a batch of images at once and inference_step_top_k() for
+        fetching only the most probable next words. If the model also has
+        supports_top_k(), inference_step_top_k() is only used for the graphs
+        it returns True for. For example, an instance of InferenceWrapperBase.
       vocab: A Vocabulary object.
       beam_size: Beam size to use when generating captions.
       max_caption_length: The maximum caption length before stopping the search.
@@ -130,14 +209,57 @@ class CaptionGenerator(object):
         scored by logprob/length^x, rather than logprob. This changes the
         relative scores of captions depending on their lengths. For example, if
         x > 0 then longer captions will be favored.
+      word_shortlist: Optional list of the word ids that captions may contain.
+        It must include the end word.
+
+    Raises:
+      ValueError: If word_shortlist does not include the end word.
     """
     self.vocab = vocab
     self.model = model
+    self.word_shortlist = None
+    if word_shortlist is not None:
+      self.word_shortlist = np.asarray(word_shortlist, dtype=np.int32)
+      if vocab.end_id not in self.word_shortlist:
+        raise ValueError("word_shortlist must include the end word id %d" %
+                         vocab.end_id)
 
     self.beam_size = beam_size
     self.max_caption_length = max_caption_length
     self.length_normalization_factor = length_normalization_factor
 
+  def _use_top_k(self, sess):
+    """Returns whether to run inference_step_top_k() in sess."""
+    if not hasattr(self.model, "inference_step_top_k"):
+      return False
+    # Graphs frozen or exported before the top_k subgraph existed lack it.
+    supports_top_k = getattr(self.model, "supports_top_k", None)
+    return supports_top_k is None or supports_top_k(sess)
+
+  def _expand(self, sess, input_feed, state_feed):
+    """Runs one inference step and finds the beam_size most probable words.
+
+    Returns:
+      word_ids: An integer numpy array of shape [batch_size, k].
+      probabilities: A numpy array of the same shape as word_ids.
+      new_states: The new model states.
+      metadata: The metadata returned by the model.
+    """
+    if self._use_top_k(sess):
+      return self.model.inference_step_top_k(sess, input_feed, state_feed,
+                                             self.beam_size,
+                                             self.word_shortlist)
+
+    softmax, new_states, metadata = self.model.inference_step(
+        sess, input_feed, state_feed)
+    if self.word_shortlist is None:
+      word_ids, probabilities = _top_k_words(softmax, self.beam_size)
+    else:
+      word_ids, probabilities = _top_k_words(softmax[:, self.word_shortlist],
+                                             self.beam_size)
+      word_ids = self.word_shortlist[word_ids]
+    return word_ids, probabilities, new_states, metadata
+
   def beam_search(self, sess, encoded_image):
     """Runs beam search caption generation on a single image.
 
@@ -148,64 +270,155 @@ class CaptionGenerator(object):
     Returns:
       A list of Caption sorted by descending score.
     """
-    # Feed in the image to get the initial state.
-    initial_state = self.model.feed_image(sess, encoded_image)
-
-    initial_beam = Caption(
-        sentence=[self.vocab.start_id],
-        state=initial_state[0],
-        logprob=0.0,
-        score=0.0,
-        metadata=[""])
-    partial_captions = TopN(self.beam_size)
-    partial_captions.push(initial_beam)
-    complete_captions = TopN(self.beam_size)
+    return self.beam_search_batch(sess, [encoded_image])[0]
+
+  def beam_search_batch(self, sess, encoded_images):
+    """Runs beam search caption generation on a batch of images.
+
+    The partial captions of all images are packed into a single batch, so each
+    step calls inference_step() once for up to len(encoded_images) * beam_size
+    beams. Images drop out of the batch as soon as their search is finished.
+
+    Beams are kept in preallocated arrays: the word and parent beam index of
+    every beam at every step, plus one state matrix for the live beams that is
+    gathered by parent index after each step. Caption objects are only built
+    for the returned captions.
+
+    Args:
+      sess: TensorFlow Session object.
+      encoded_images: A list of encoded image strings.
+
+    Returns:
+      A list with one entry per image; each entry is a list of Caption sorted by
+      descending score, as returned by beam_search().
+    """
+    num_images = len(encoded_images)
+
+    # Feed in the images to get the initial states.
+    if hasattr(self.model, "feed_images"):
+      states = np.asarray(self.model.feed_images(sess, encoded_images))
+    else:
+      states = np.array([self.model.feed_image(sess, encoded_image)[0]
+                         for encoded_image in encoded_images])
+
+    # tokens[t, j] is the word of the j-th live beam at step t, and parents[t, j]
+    # is the index of its parent beam at step t - 1.
+    max_beams = max(1, self.beam_size) * num_images
+    tokens = np.empty([self.max_caption_length, max_beams], dtype=np.int32)
+    parents = np.empty([self.max_caption_length, max_beams], dtype=np.int32)
+    tokens[0, :num_images] = self.vocab.start_id
+    parents[0, :num_images] = -1
+    step_metadata = []
+
+    beam_images = np.arange(num_images)  # The image of each live beam.
+    logprobs = np.zeros([num_images], dtype=np.float64)
+    complete_captions = [TopN(self.beam_size) for _ in range(num_images)]
 
     # Run beam search.
-    for _ in range(self.max_caption_length - 1):
-      partial_captions_list = partial_captions.extract()
-      partial_captions.reset()
-      input_feed = np.array([c.sentence[-1] for c in partial_captions_list])
-      state_feed = np.array([c.state for c in partial_captions_list])
-
-      softmax, new_states, metadata = self.model.inference_step(sess,
-                                                                input_feed,
-                                                                state_feed)
-
-      for i, partial_caption in enumerate(partial_captions_list):
-        word_probabilities = softmax[i]
-        state = new_states[i]
-        # For this partial caption, get the beam_size most probable next words.
-        words_and_probs = list(enumerate(word_probabilities))
-        words_and_probs.sort(key=lambda x: -x[1])
-        words_and_probs = words_and_probs[0:self.beam_size]
-        # Each next word gives a new partial caption.
-        for w, p in words_and_probs:
-          if p < 1e-12:
-            continue  # Avoid log(0).
-          sentence = partial_caption.sentence + [w]
-          logprob = partial_caption.logprob + math.log(p)
-          score = logprob
-          if metadata:
-            metadata_list = partial_caption.metadata + [metadata[i]]
-          else:
-            metadata_list = None
-          if w == self.vocab.end_id:
-            if self.length_normalization_factor > 0:
-              score /= len(sentence)**self.length_normalization_factor
-            beam = Caption(sentence, state, logprob, score, metadata_list)
-            complete_captions.push(beam)
-          else:
-            beam = Caption(sentence, state, logprob, score, metadata_list)
-            partial_captions.push(beam)
-      if partial_captions.size() == 0:
-        # We have run out of partial candidates; happens when beam_size = 1.
-        break
-
-    # If we have no complete captions then fall back to the partial captions.
-    # But never output a mixture of complete and partial captions because a
-    # partial caption could have a higher score than all the complete captions.
-    if not complete_captions.size():
-      complete_captions = partial_captions
-
-    return complete_captions.extract(sort=True)
+    step = 0
+    while step < self.max_caption_length - 1 and len(beam_images):
+      num_beams = len(beam_images)
+      word_ids, probabilities, new_states, metadata = self._expand(
+          sess, tokens[step, :num_beams], states)
+      step_metadata.append(metadata)
+
+      valid = probabilities >= 1e-12  # Avoid log(0).
+      candidate_logprobs = np.log(
+          np.where(valid, probabilities, 1.0).astype(np.float64))
+      candidate_logprobs += logprobs[:, np.newaxis]
+      is_end = word_ids == self.vocab.end_id
+
+      # Each next word gives a new partial or complete caption.
+      for i, j in zip(*np.nonzero(valid & is_end)):
+        logprob = float(candidate_logprobs[i, j])
+        score = logprob
+        if self.length_normalization_factor > 0:
+          score /= (step + 2)**self.length_normalization_factor
+        complete_captions[beam_images[i]].push(
+            _CaptionRef(score, logprob, step, i, new_states[i].copy()))
+
+      # Rank the partial candidates of each image by descending log-probability
+      # (equal log-probabilities keep the order in which they were generated)
+      # and keep the first beam_size of each image.
+      candidate_logprobs[~valid | is_end] = -np.inf
+      num_words = word_ids.shape[1]
+      rows = np.repeat(np.arange(num_beams), num_words)
+      flat_logprobs = candidate_logprobs.ravel()
+      order = np.lexsort((word_ids.ravel(), rows, -flat_logprobs,
+                          beam_images[rows]))
+      order = order[flat_logprobs[order] > -np.inf]
+      order_images = beam_images[rows[order]]
+      rank = np.arange(len(order)) - np.searchsorted(order_images,
+                                                     order_images)
+      order = order[rank < self.beam_size]
+      order_images = order_images[rank < self.beam_size]
+
+      # Drop the images whose captions can no longer change: without length
+      # normalization, extending a caption never increases its log-probability.
+      if self.length_normalization_factor <= 0 and len(order):
+        first = np.flatnonzero(np.r_[True, order_images[1:] !=
+                                     order_images[:-1]])
+        finished = np.zeros([num_images], dtype=bool)
+        for n, best in zip(order_images[first], flat_logprobs[order[first]]):
+          finished[n] = (complete_captions[n].size() == self.beam_size and
+                         best < complete_captions[n].min().score)
+        keep = ~finished[order_images]
+        order = order[keep]
+        order_images = order_images[keep]
+
+      # Gather the surviving beams.
+      step += 1
+      parent_rows = rows[order]
+      num_beams = len(order)
+      tokens[step, :num_beams] = word_ids.ravel()[order]
+      parents[step, :num_beams] = parent_rows
+      logprobs = flat_logprobs[order]
+      states = new_states[parent_rows]
+      beam_images = order_images
+
+    def _backtrack(last_step, index):
+      """Returns the sentence and metadata of a beam in the history."""
+      sentence = []
+      metadata = []
+      for t in range(last_step, -1, -1):
+        sentence.append(int(tokens[t, index]))
+        parent = parents[t, index]
+        if t:
+          metadata.append(step_metadata[t - 1][parent]
+                          if step_metadata[t - 1] else None)
+        index = parent
+      metadata.append("")
+      sentence.reverse()
+      metadata.reverse()
+      if any(m is None for m in metadata):
+        metadata = None
+      return sentence, metadata
+
+    results = []
+    for n in range(num_images):
+      captions = []
+      if complete_captions[n].size():
+        for ref in complete_captions[n].extract(sort=True):
+          sentence, metadata = _backtrack(ref.step, ref.index)
+          sentence.append(self.vocab.end_id)
+          if metadata is not None:
+            if step_metadata[ref.step]:
+              metadata.append(step_metadata[ref.step][ref.index])
+            else:
+              metadata = None
+          captions.append(
+              Caption(sentence, ref.state, ref.logprob, ref.score, metadata))
+      else:
+        # If we have no complete captions then fall back to the partial
+        # captions. But never output a mixture of complete and partial captions
+        # because a partial caption could have a higher score than all the
+        # complete captions.
+        for j in np.flatnonzero(beam_images == n):
+          sentence, metadata = _backtrack(step, j)
+          logprob = float(logprobs[j])
+          captions.append(
+              Caption(sentence, states[j], logprob, logprob, metadata))
+        captions.sort(reverse=True)
+      results.append(captions)
+
+    return results
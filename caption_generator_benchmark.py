@@ -0,0 +1,82 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Benchmarks for the beam expansion step of CaptionGenerator.
+
+Run with:
+  python caption_generator_benchmark.py --benchmarks=.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+
+import numpy as np
+import tensorflow as tf
+
+import caption_generator
+
+
+def _sorted_top_k_words(softmax, k):
+  """Reference expansion: a full Python sort of every softmax row."""
+  top_words = []
+  for word_probabilities in softmax:
+    words_and_probs = list(enumerate(word_probabilities))
+    words_and_probs.sort(key=lambda x: -x[1])
+    top_words.append(words_and_probs[0:k])
+  return top_words
+
+
+class BeamExpansionBenchmark(tf.test.Benchmark):
+  """Compares per-step candidate selection over [beam_size, vocab_size]."""
+
+  def _run(self, name, fn, softmax, beam_size, iters):
+    fn(softmax, beam_size)  # Warm up.
+    start = time.time()
+    for _ in range(iters):
+      fn(softmax, beam_size)
+    wall_time = (time.time() - start) / iters
+    self.report_benchmark(iters=iters, wall_time=wall_time, name=name)
+    return wall_time
+
+  def _benchmark_vocab_size(self, vocab_size, beam_size=3, iters=20):
+    rng = np.random.RandomState(0)
+    logits = rng.randn(beam_size, vocab_size).astype(np.float32)
+    softmax = np.exp(logits) / np.sum(np.exp(logits), axis=1, keepdims=True)
+
+    sorted_time = self._run("sorted_vocab_%d" % vocab_size,
+                            _sorted_top_k_words, softmax, beam_size, iters)
+    top_k_time = self._run("argpartition_vocab_%d" % vocab_size,
+                           caption_generator._top_k_words,  # pylint: disable=protected-access
+                           softmax, beam_size, iters)
+    tf.logging.info("vocab_size=%d: %.3f ms -> %.3f ms per step (%.1fx)",
+                    vocab_size, sorted_time * 1e3, top_k_time * 1e3,
+                    sorted_time / top_k_time)
+
+  def benchmark_vocab_2k(self):
+    self._benchmark_vocab_size(2000)
+
+  def benchmark_vocab_12k(self):
+    self._benchmark_vocab_size(12000)
+
+  def benchmark_vocab_50k(self):
+    self._benchmark_vocab_size(50000)
+
+
+if __name__ == "__main__":
+  tf.logging.set_verbosity(tf.logging.INFO)
+  tf.test.main()
@@ -89,6 +89,31 @@ class FakeModel(object):
   # pylint: enable=unused-argument
 
 
+class FakeTopKModel(FakeModel):
+  """Fake model that also selects the most probable words, as in the graph."""
+
+  def __init__(self, supports_top_k=True):
+    super(FakeTopKModel, self).__init__()
+    self.num_top_k_steps = 0
+    self._supports_top_k = supports_top_k
+
+  def supports_top_k(self, sess):  # pylint: disable=unused-argument
+    return self._supports_top_k
+
+  def inference_step_top_k(self, sess, input_feed, state_feed, k,
+                           word_shortlist=None):
+    self.num_top_k_steps += 1
+    softmax_output, new_state, metadata = self.inference_step(
+        sess, input_feed, state_feed)
+    if word_shortlist is None:
+      word_shortlist = np.arange(self._vocab_size)
+    softmax_output = softmax_output[:, word_shortlist]
+    # Stable sort, so equal probabilities keep the smaller index first.
+    indices = np.argsort(-softmax_output, axis=1, kind="mergesort")[:, :k]
+    values = np.take_along_axis(softmax_output, indices, axis=1)
+    return word_shortlist[indices], values, new_state, metadata
+
+
 class CaptionGeneratorTest(tf.test.TestCase):
 
   def _assertExpectedCaptions(self,
@@ -173,6 +198,59 @@ class CaptionGeneratorTest(tf.test.TestCase):
     self._assertExpectedCaptions(
         expected, beam_size=4, length_normalization_factor=3)
 
+  def testBeamSearchBatch(self):
+    generator = caption_generator.CaptionGenerator(
+        model=FakeModel(), vocab=FakeVocab(), beam_size=3)
+    expected = [[0, 2, 6, 1], [0, 4, 10, 1], [0, 3, 8, 1]]
+    batch_captions = generator.beam_search_batch(sess=None,
+                                                 encoded_images=[None] * 4)
+    self.assertEqual(4, len(batch_captions))
+    for captions in batch_captions:
+      self.assertEqual(expected, [c.sentence for c in captions])
+
+  def testInferenceStepTopK(self):
+    model = FakeTopKModel()
+    generator = caption_generator.CaptionGenerator(
+        model=model, vocab=FakeVocab(), beam_size=3)
+    captions = generator.beam_search(sess=None, encoded_image=None)
+    self.assertEqual([[0, 2, 6, 1], [0, 4, 10, 1], [0, 3, 8, 1]],
+                     [c.sentence for c in captions])
+    self.assertAllClose([0.18, 0.16, 0.15],
+                        [math.exp(c.logprob) for c in captions])
+    self.assertGreater(model.num_top_k_steps, 0)
+
+  def testInferenceStepWithoutTopKSubgraph(self):
+    model = FakeTopKModel(supports_top_k=False)
+    generator = caption_generator.CaptionGenerator(
+        model=model, vocab=FakeVocab(), beam_size=3)
+    captions = generator.beam_search(sess=None, encoded_image=None)
+    self.assertEqual([[0, 2, 6, 1], [0, 4, 10, 1], [0, 3, 8, 1]],
+                     [c.sentence for c in captions])
+    self.assertEqual(0, model.num_top_k_steps)
+
+  def testWordShortlistWithoutEndWord(self):
+    with self.assertRaises(ValueError):
+      caption_generator.CaptionGenerator(
+          model=FakeModel(), vocab=FakeVocab(), word_shortlist=[0, 2, 3])
+
+  def testWordShortlist(self):
+    # Without word 2, the caption [0, 2, 6, 1] cannot be generated.
+    expected = [[0, 4, 10, 1], [0, 3, 8, 1], [0, 4, 1]]
+    word_shortlist = [0, 1, 3, 4, 5, 6, 7, 8, 9, 10, 11]
+    for model in [FakeModel(), FakeTopKModel()]:
+      generator = caption_generator.CaptionGenerator(
+          model=model, vocab=FakeVocab(), beam_size=3,
+          word_shortlist=word_shortlist)
+      captions = generator.beam_search(sess=None, encoded_image=None)
+      self.assertEqual(expected, [c.sentence for c in captions])
+
+  def testTopKWordsBreaksTiesBySmallerId(self):
+    softmax = np.array([[0.1, 0.3, 0.3, 0.3],
+                        [0.4, 0.1, 0.4, 0.1]])
+    word_ids, probabilities = caption_generator._top_k_words(softmax, 2)  # pylint: disable=protected-access
+    self.assertEqual([[1, 2], [0, 2]], np.sort(word_ids, axis=1).tolist())
+    self.assertAllClose([[0.3, 0.3], [0.4, 0.4]], probabilities)
+
 
 if __name__ == '__main__':
   tf.test.main()
@@ -0,0 +1,110 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Estimates the padding waste of caption batching on a TFRecord dataset.
+
+Reads the caption lengths of the input shards, simulates randomly shuffled
+batches padded to their longest caption, and compares them with batches drawn
+from the buckets of ModelConfig.caption_length_boundaries. The padded steps are
+LSTM and softmax steps whose outputs are masked out of the loss.
+
+Usage:
+  python caption_padding_stats.py \
+    --input_file_pattern="data/out/train-?????-of-00256" \
+    --bucket_boundaries=4,5,6,8,10,13,18
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+
+import numpy as np
+import tensorflow as tf
+
+import configuration
+
+FLAGS = tf.flags.FLAGS
+
+tf.flags.DEFINE_string("input_file_pattern", "",
+                       "File pattern of sharded TFRecord input files.")
+tf.flags.DEFINE_string("bucket_boundaries", "",
+                       "Comma-separated input sequence length boundaries. "
+                       "Defaults to ModelConfig.caption_length_boundaries.")
+tf.flags.DEFINE_integer("seed", 0, "Seed of the simulated shuffling.")
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+
+def padding_fraction(lengths, batch_size, bucket_boundaries=None):
+  """Returns the fraction of padded steps in full batches of lengths.
+
+  Args:
+    lengths: 1-D numpy array of input sequence lengths, in batching order.
+    batch_size: Batch size.
+    bucket_boundaries: Optional increasing list of length boundaries; if given,
+      each batch is drawn from a single bucket.
+
+  Returns:
+    The number of padded steps divided by the total number of steps.
+  """
+  buckets = np.searchsorted(bucket_boundaries or [], lengths, side="right")
+  real_steps = 0
+  total_steps = 0
+  for bucket in np.unique(buckets):
+    bucket_lengths = lengths[buckets == bucket]
+    num_batches = len(bucket_lengths) // batch_size
+    batches = bucket_lengths[:num_batches * batch_size].reshape(
+        [num_batches, batch_size])
+    real_steps += batches.sum()
+    total_steps += batches.max(axis=1).sum() * batch_size
+  return 1.0 - real_steps / max(total_steps, 1)
+
+
+def main(unused_argv):
+  assert FLAGS.input_file_pattern, "--input_file_pattern is required"
+
+  model_config = configuration.ModelConfig()
+  if FLAGS.bucket_boundaries:
+    bucket_boundaries = [int(b) for b in FLAGS.bucket_boundaries.split(",")]
+  else:
+    bucket_boundaries = model_config.caption_length_boundaries
+
+  lengths = []
+  for pattern in FLAGS.input_file_pattern.split(","):
+    for filename in tf.gfile.Glob(pattern):
+      for serialized in tf.python_io.tf_record_iterator(filename):
+        example = tf.train.SequenceExample.FromString(serialized)
+        caption = example.feature_lists.feature_list[
+            model_config.caption_feature_name].feature
+        lengths.append(len(caption) - 1)
+  if not lengths:
+    tf.logging.fatal("Found no captions in %s", FLAGS.input_file_pattern)
+
+  lengths = np.array(lengths)
+  np.random.RandomState(FLAGS.seed).shuffle(lengths)
+  unbucketed = padding_fraction(lengths, model_config.batch_size)
+  bucketed = padding_fraction(lengths, model_config.batch_size,
+                              bucket_boundaries)
+  print("Captions: %d, mean input length: %.2f" % (len(lengths),
+                                                   lengths.mean()))
+  print("Padded steps without buckets: %.1f%%" % (100 * unbucketed))
+  print("Padded steps with buckets %s: %.1f%%" % (bucket_boundaries,
+                                                  100 * bucketed))
+  print("LSTM and softmax steps per epoch: %.2fx fewer" %
+        ((1 - bucketed) / (1 - unbucketed)))
+
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -0,0 +1,275 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Local HTTP server that keeps a captioning model warm.
+
+Concurrent requests are grouped into micro-batches before they reach the model.
+
+Usage:
+  python caption_server.py --checkpoint_path=model \
+    --vocab_file=data/out/word_counts.txt --port=8000
+
+  curl --data-binary @image.jpg http://127.0.0.1:8000/caption
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import threading
+import time
+
+
+from six.moves import BaseHTTPServer
+from six.moves import queue
+from six.moves import socketserver
+import tensorflow as tf
+
+import caption_generator
+import configuration
+import inference_pipeline
+import show_and_tell_model
+import vocabulary
+
+FLAGS = tf.flags.FLAGS
+
+tf.flags.DEFINE_string("checkpoint_path", "",
+                       "Model checkpoint file or directory containing a "
+                       "model checkpoint file.")
+tf.flags.DEFINE_string("frozen_graph", "",
+                       "Optional frozen graph written by export_frozen_graph.py "
+                       "to use instead of --checkpoint_path.")
+tf.flags.DEFINE_string("vocab_file", "", "Text file containing the vocabulary.")
+tf.flags.DEFINE_string("lstm_implementation", "basic",
+                       "LSTM cell implementation: basic or block. Checkpoints "
+                       "of either implementation can be loaded.")
+tf.flags.DEFINE_string("host", "127.0.0.1", "Address to listen on.")
+tf.flags.DEFINE_integer("port", 8000, "Port to listen on.")
+tf.flags.DEFINE_integer("max_batch_size", 16,
+                        "Maximum number of images captioned together.")
+tf.flags.DEFINE_integer("max_batch_wait_ms", 10,
+                        "Maximum time a request waits for a batch to fill.")
+tf.flags.DEFINE_integer("max_request_bytes", 10 * 1024 * 1024,
+                        "Maximum size of a request body. Larger requests are "
+                        "rejected with status 413 without reading them.")
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+
+class _Request(object):
+  """A pending item of a MicroBatcher."""
+
+  __slots__ = ("item", "result", "error", "done")
+
+  def __init__(self, item):
+    self.item = item
+    self.result = None
+    self.error = None
+    self.done = threading.Event()
+
+
+class MicroBatcher(object):
+  """Groups items submitted from concurrent threads into batches.
+
+  A batch is processed as soon as it holds max_batch_size items, or when its
+  first item has waited max_wait_ms.
+  """
+
+  def __init__(self, process_fn, max_batch_size, max_wait_ms):
+    """Starts the batching thread.
+
+    Args:
+      process_fn: Function that takes a list of items and returns a list with
+        one result per item.
+      max_batch_size: Maximum number of items per batch.
+      max_wait_ms: Maximum time in milliseconds to wait for a batch to fill.
+    """
+    self._process_fn = process_fn
+    self._max_batch_size = max_batch_size
+    self._max_wait_secs = max_wait_ms / 1000.0
+    self._queue = queue.Queue()
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self):
+    while True:
+      batch = [self._queue.get()]
+      deadline = time.time() + self._max_wait_secs
+      while len(batch) < self._max_batch_size:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+          break
+        try:
+          batch.append(self._queue.get(timeout=timeout))
+        except queue.Empty:
+          break
+
+      try:
+        results = self._process_fn([request.item for request in batch])
+        for request, result in zip(batch, results):
+          request.result = result
+      except Exception as e:  # pylint: disable=broad-except
+        for request in batch:
+          request.error = e
+      for request in batch:
+        request.done.set()
+
+  def submit(self, item):
+    """Processes an item as part of a batch and returns its result.
+
+    Raises:
+      Exception: Any exception raised by process_fn for the item's batch.
+    """
+    request = _Request(item)
+    self._queue.put(request)
+    request.done.wait()
+    if request.error is not None:
+      raise request.error
+    return request.result
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+def make_handler(batcher, max_request_bytes=10 * 1024 * 1024):
+  """Returns an HTTP request handler class that captions via batcher.
+
+  batcher.submit(encoded_image) must return a list of caption dicts, or None if
+  the image could not be decoded. Request bodies larger than max_request_bytes
+  are rejected.
+  """
+
+  class _CaptionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handles POST /caption with an encoded image as the request body."""
+
+    def _send_json(self, code, record):
+      body = json.dumps(record).encode("utf-8")
+      self.send_response(code)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+      if self.path == "/healthz":
+        self._send_json(200, {"status": "ok"})
+      else:
+        self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+      if self.path != "/caption":
+        self._send_json(404, {"error": "not found"})
+        return
+      try:
+        length = int(self.headers.get("Content-Length", 0))
+      except ValueError:
+        length = -1
+      if length < 0:
+        self.close_connection = True
+        self._send_json(400, {"error": "invalid Content-Length"})
+        return
+      if not length:
+        self._send_json(400, {"error": "empty request body"})
+        return
+      if length > max_request_bytes:
+        # The body is not read, so the connection cannot be reused.
+        self.close_connection = True
+        self._send_json(413, {"error": "request body exceeds %d bytes" %
+                                       max_request_bytes})
+        return
+      encoded_image = self.rfile.read(length)
+
+      start_time = time.time()
+      try:
+        captions = batcher.submit(encoded_image)
+      except Exception as e:  # pylint: disable=broad-except
+        tf.logging.error("Failed to caption image: %s", e)
+        self._send_json(500, {"error": "internal error: %s" % e})
+        return
+      if captions is None:
+        self._send_json(400, {"error": "could not decode image"})
+        return
+      self._send_json(200, {
+          "captions": captions,
+          "caption_secs": time.time() - start_time,
+      })
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+      tf.logging.debug(format, *args)
+
+  return _CaptionHandler
+
+
+def main(_):
+  assert FLAGS.checkpoint_path or FLAGS.frozen_graph, (
+      "--checkpoint_path or --frozen_graph is required")
+  assert FLAGS.vocab_file, "--vocab_file is required"
+
+  # Create the vocabulary, and build the model with the vocabulary size of the
+  # checkpoint, which may be larger than the vocabulary file.
+  vocab = vocabulary.Vocabulary(FLAGS.vocab_file)
+  model_config = configuration.ModelConfig()
+  model_config.lstm_implementation = FLAGS.lstm_implementation
+  if not FLAGS.frozen_graph:
+    model_config.vocab_size = inference_pipeline.checkpoint_vocab_size(
+        FLAGS.checkpoint_path)
+    model_config.logits_weights_vocab_major = (
+        show_and_tell_model.checkpoint_logits_vocab_major(
+            FLAGS.checkpoint_path))
+
+  # Build the inference graph.
+  g, model, restore_fn = inference_pipeline.build_inference_graph(
+      model_config, FLAGS.checkpoint_path, FLAGS.frozen_graph)
+
+  with tf.Session(graph=g) as sess:
+    restore_fn(sess)
+    generator = caption_generator.CaptionGenerator(model, vocab)
+
+    def _caption_batch(encoded_images):
+      try:
+        batch_captions = generator.beam_search_batch(sess, encoded_images)
+      except tf.errors.InvalidArgumentError:
+        # A single undecodable image fails the whole batch; retry one by one,
+        # and report undecodable images as None.
+        batch_captions = []
+        for encoded_image in encoded_images:
+          try:
+            batch_captions.extend(
+                generator.beam_search_batch(sess, [encoded_image]))
+          except tf.errors.InvalidArgumentError:
+            batch_captions.append(None)
+      return [None if captions is None else
+              [inference_pipeline.caption_to_dict(c, vocab) for c in captions]
+              for captions in batch_captions]
+
+    batcher = MicroBatcher(_caption_batch,
+                           max_batch_size=FLAGS.max_batch_size,
+                           max_wait_ms=FLAGS.max_batch_wait_ms)
+    server = _ThreadingHTTPServer(
+        (FLAGS.host, FLAGS.port),
+        make_handler(batcher, max_request_bytes=FLAGS.max_request_bytes))
+    tf.logging.info("Serving captions on http://%s:%d/caption", FLAGS.host,
+                    FLAGS.port)
+    try:
+      server.serve_forever()
+    finally:
+      server.server_close()
+
+
+if __name__ == "__main__":
+  tf.app.run()
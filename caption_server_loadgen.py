@@ -0,0 +1,106 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Load generator for caption_server.py.
+
+Sends images from concurrent client threads and reports throughput and latency
+percentiles.
+
+Usage:
+  python caption_server_loadgen.py --input_files=data/craigcapImg/erie/*.jpg \
+    --num_requests=500 --concurrency=16
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+
+import numpy as np
+from six.moves import urllib
+import tensorflow as tf
+
+FLAGS = tf.flags.FLAGS
+
+tf.flags.DEFINE_string("server_url", "http://127.0.0.1:8000/caption",
+                       "URL of the caption server.")
+tf.flags.DEFINE_string("input_files", "",
+                       "File pattern or comma-separated list of file patterns "
+                       "of image files.")
+tf.flags.DEFINE_integer("num_requests", 200, "Total number of requests.")
+tf.flags.DEFINE_integer("concurrency", 8, "Number of concurrent clients.")
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+
+def main(_):
+  filenames = []
+  for file_pattern in FLAGS.input_files.split(","):
+    filenames.extend(tf.gfile.Glob(file_pattern))
+  assert filenames, "No files match --input_files"
+  images = []
+  for filename in filenames:
+    with tf.gfile.GFile(filename, "rb") as f:
+      images.append(f.read())
+
+  lock = threading.Lock()
+  next_request = [0]
+  latencies = []
+  num_errors = [0]
+
+  def _client():
+    while True:
+      with lock:
+        index = next_request[0]
+        next_request[0] += 1
+      if index >= FLAGS.num_requests:
+        return
+      request = urllib.request.Request(
+          FLAGS.server_url, data=images[index % len(images)],
+          headers={"Content-Type": "application/octet-stream"})
+      start_time = time.time()
+      try:
+        urllib.request.urlopen(request).read()
+      except urllib.error.URLError as e:
+        tf.logging.error("Request failed: %s", e)
+        with lock:
+          num_errors[0] += 1
+        continue
+      with lock:
+        latencies.append(time.time() - start_time)
+
+  start_time = time.time()
+  threads = [threading.Thread(target=_client) for _ in range(FLAGS.concurrency)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  total_secs = time.time() - start_time
+
+  latencies_ms = 1000.0 * np.array(latencies)
+  print("Requests: %d (%d errors) with %d clients in %.2f sec (%.1f req/sec)" %
+        (FLAGS.num_requests, num_errors[0], FLAGS.concurrency, total_secs,
+         len(latencies) / total_secs))
+  if len(latencies_ms):
+    for percentile in (50, 90, 95, 99):
+      print("  p%d latency: %.1f ms" %
+            (percentile, np.percentile(latencies_ms, percentile)))
+    print("  max latency: %.1f ms" % np.max(latencies_ms))
+
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -0,0 +1,144 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Unit tests for caption_server."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import threading
+
+
+from six.moves import http_client
+import tensorflow as tf
+
+import caption_server
+
+
+class MicroBatcherTest(tf.test.TestCase):
+
+  def _submitConcurrently(self, batcher, items):
+    results = [None] * len(items)
+
+    def _submit(i):
+      try:
+        results[i] = batcher.submit(items[i])
+      except ValueError as e:
+        results[i] = e
+
+    threads = [threading.Thread(target=_submit, args=(i,))
+               for i in range(len(items))]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    return results
+
+  def testBatchesConcurrentRequests(self):
+    batch_sizes = []
+
+    def _process(items):
+      batch_sizes.append(len(items))
+      return [2 * x for x in items]
+
+    batcher = caption_server.MicroBatcher(_process, max_batch_size=4,
+                                          max_wait_ms=200)
+    results = self._submitConcurrently(batcher, list(range(10)))
+
+    self.assertEqual([2 * x for x in range(10)], results)
+    self.assertEqual(10, sum(batch_sizes))
+    self.assertLessEqual(max(batch_sizes), 4)
+    self.assertLess(len(batch_sizes), 10)
+
+  def testPropagatesErrors(self):
+
+    def _process(items):
+      raise ValueError("bad batch of %d" % len(items))
+
+    batcher = caption_server.MicroBatcher(_process, max_batch_size=2,
+                                          max_wait_ms=1)
+    for result in self._submitConcurrently(batcher, [1, 2, 3]):
+      self.assertIsInstance(result, ValueError)
+
+
+class FakeBatcher(object):
+  """Fake MicroBatcher that captions b"image" and fails on b"crash"."""
+
+  def submit(self, item):
+    if item == b"crash":
+      raise ValueError("crashed")
+    if item == b"image":
+      return [{"sentence": "a chair", "logprob": -1.0, "score": -1.0}]
+    if item == b"blank":
+      return []
+    return None
+
+
+class CaptionHandlerTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(CaptionHandlerTest, self).setUp()
+    self._server = caption_server._ThreadingHTTPServer(
+        ("127.0.0.1", 0),
+        caption_server.make_handler(FakeBatcher(), max_request_bytes=100))
+    self._thread = threading.Thread(target=self._server.serve_forever)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def tearDown(self):
+    self._server.shutdown()
+    self._server.server_close()
+    super(CaptionHandlerTest, self).tearDown()
+
+  def _post(self, body, headers=None):
+    conn = http_client.HTTPConnection("127.0.0.1",
+                                      self._server.server_address[1])
+    conn.request("POST", "/caption", body, headers or {})
+    response = conn.getresponse()
+    result = response.status, json.loads(response.read().decode("utf-8"))
+    conn.close()
+    return result
+
+  def testCaptions(self):
+    status, record = self._post(b"image")
+    self.assertEqual(200, status)
+    self.assertEqual("a chair", record["captions"][0]["sentence"])
+
+  def testNoCaptions(self):
+    status, record = self._post(b"blank")
+    self.assertEqual(200, status)
+    self.assertEqual([], record["captions"])
+
+  def testUndecodableImage(self):
+    self.assertEqual(400, self._post(b"not an image")[0])
+
+  def testInternalError(self):
+    status, record = self._post(b"crash")
+    self.assertEqual(500, status)
+    self.assertIn("crashed", record["error"])
+
+  def testInvalidContentLength(self):
+    status, record = self._post(b"image", {"Content-Length": "five"})
+    self.assertEqual(400, status)
+    self.assertIn("Content-Length", record["error"])
+
+  def testRequestTooLarge(self):
+    self.assertEqual(413, self._post(b"x" * 101)[0])
+    self.assertEqual(200, self._post(b"image")[0])
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -0,0 +1,144 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Compares the captions and latency of two frozen inference graphs.
+
+The graphs may be exported by export_frozen_graph.py from different checkpoints
+or with a different --lstm_implementation or --vocab_file. Both caption the
+same images from TFRecord shards, and the script reports:
+
+  - the size of each GraphDef file,
+  - the fraction of images whose best caption is identical,
+  - the drift of the best caption's log-probability on those images,
+  - the captioning time per image of each graph.
+
+Usage:
+  python compare_frozen_graphs.py \
+    --baseline_graph=model/frozen_inference_graph.pb \
+    --candidate_graph=model/frozen_inference_graph_block.pb \
+    --vocab_file=data/out/word_counts.txt \
+    --input_file_pattern="data/out/test-?????-of-00008"
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+
+import numpy as np
+import tensorflow as tf
+
+import caption_generator
+import configuration
+import inference_pipeline
+import vocabulary
+
+FLAGS = tf.flags.FLAGS
+
+tf.flags.DEFINE_string("baseline_graph", "", "Baseline frozen GraphDef file.")
+tf.flags.DEFINE_string("candidate_graph", "", "Candidate frozen GraphDef file.")
+tf.flags.DEFINE_string("vocab_file", "", "Text file containing the vocabulary.")
+tf.flags.DEFINE_string("input_file_pattern", "",
+                       "File pattern of sharded TFRecord files with images.")
+tf.flags.DEFINE_integer("max_images", 500, "Maximum number of images to use.")
+tf.flags.DEFINE_integer("batch_size", 1,
+                        "Number of images passed to each beam_search_batch() "
+                        "call.")
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+
+def read_encoded_images(file_pattern, max_images, image_feature):
+  """Returns up to max_images encoded images from TFRecord shards."""
+  encoded_images = []
+  for pattern in file_pattern.split(","):
+    for filename in sorted(tf.gfile.Glob(pattern)):
+      for serialized in tf.python_io.tf_record_iterator(filename):
+        example = tf.train.SequenceExample.FromString(serialized)
+        encoded_images.append(
+            example.context.feature[image_feature].bytes_list.value[0])
+        if len(encoded_images) == max_images:
+          return encoded_images
+  return encoded_images
+
+
+def best_captions(frozen_graph_file, vocab, encoded_images, batch_size):
+  """Captions images with a frozen graph.
+
+  Returns:
+    captions: A list with the best Caption of each image, or None.
+    secs_per_image: The mean captioning time per image.
+  """
+  g, model, restore_fn = inference_pipeline.build_inference_graph(
+      configuration.ModelConfig(), None, frozen_graph_file)
+  images = [(i, encoded_image, 0.0)
+            for i, encoded_image in enumerate(encoded_images)]
+  with tf.Session(graph=g) as sess:
+    restore_fn(sess)
+    generator = caption_generator.CaptionGenerator(model, vocab)
+    # Warm up.
+    generator.beam_search_batch(sess, encoded_images[:batch_size])
+    start_time = time.time()
+    captions = [c[0] if c else None
+                for _, c, _ in inference_pipeline.caption_images(
+                    sess, generator, images, batch_size=batch_size)]
+    secs_per_image = (time.time() - start_time) / len(encoded_images)
+  return captions, secs_per_image
+
+
+def main(unused_argv):
+  assert FLAGS.baseline_graph, "--baseline_graph is required"
+  assert FLAGS.candidate_graph, "--candidate_graph is required"
+  assert FLAGS.vocab_file, "--vocab_file is required"
+  assert FLAGS.input_file_pattern, "--input_file_pattern is required"
+
+  vocab = vocabulary.Vocabulary(FLAGS.vocab_file)
+  encoded_images = read_encoded_images(
+      FLAGS.input_file_pattern, FLAGS.max_images,
+      configuration.ModelConfig().image_feature_name)
+  if not encoded_images:
+    tf.logging.fatal("Found no images in %s", FLAGS.input_file_pattern)
+
+  baseline, baseline_secs = best_captions(FLAGS.baseline_graph, vocab,
+                                          encoded_images, FLAGS.batch_size)
+  candidate, candidate_secs = best_captions(FLAGS.candidate_graph, vocab,
+                                            encoded_images, FLAGS.batch_size)
+
+  baseline_bytes = tf.gfile.Stat(FLAGS.baseline_graph).length
+  candidate_bytes = tf.gfile.Stat(FLAGS.candidate_graph).length
+
+  num_agree = 0
+  drifts = []
+  for a, b in zip(baseline, candidate):
+    if a is not None and b is not None and a.sentence == b.sentence:
+      num_agree += 1
+      drifts.append(abs(a.logprob - b.logprob))
+
+  print("GraphDef size: baseline %d bytes, candidate %d bytes (%.2fx)" %
+        (baseline_bytes, candidate_bytes, baseline_bytes / candidate_bytes))
+  print("Images: %d" % len(encoded_images))
+  print("Identical best captions: %d (%.1f%%)" %
+        (num_agree, 100.0 * num_agree / len(encoded_images)))
+  if drifts:
+    print("Log-probability drift of identical captions: mean %.4f, max %.4f" %
+          (np.mean(drifts), np.max(drifts)))
+  print("Caption time per image: baseline %.1f ms, candidate %.1f ms (%.2fx)" %
+        (baseline_secs * 1e3, candidate_secs * 1e3,
+         baseline_secs / candidate_secs))
+
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -29,19 +29,42 @@ class ModelConfig(object):
     # Must be provided in training and evaluation modes.
     self.input_file_pattern = None
 
-    # Image format ("jpeg" or "png").
+    # Image format ("jpeg", "png" or "raw"). "raw" images are uint8 RGB pixels
+    # of shape [stored_image_height, stored_image_width, 3], as written by
+    # data/genTFRecord.py --image_storage=raw. Inference always reads encoded
+    # images, and treats "raw" as "jpeg".
     self.image_format = "jpeg"
+    # Size the images in the input shards were resized to when they were
+    # written (data/genTFRecord.py --stored_image_size), or 0 if they are
+    # stored at their original size. Images of the size process_image()
+    # resizes to are not resized again. Ignored in inference mode.
+    self.stored_image_height = 0
+    self.stored_image_width = 0
 
     # Approximate number of values per input shard. Used to ensure sufficient
     # mixing between shards in training.
     self.values_per_input_shard = 2300
     # Minimum number of shards to keep in the input queue.
     self.input_queue_capacity_factor = 2
-    # Number of threads for prefetching SequenceExample protos.
+    # Number of threads for prefetching SequenceExample protos. With the
+    # "dataset" input pipeline, the number of shards read in parallel.
     self.num_input_reader_threads = 1
+    # Input pipeline used in training and evaluation: "queue" (queue runners)
+    # or "dataset" (tf.data, see inputs.batch_dataset_with_dynamic_pad).
+    self.input_pipeline = "queue"
+    # Number of batches prefetched by the "dataset" input pipeline.
+    self.num_prefetch_batches = 2
 
     # Name of the SequenceExample context feature containing image data.
     self.image_feature_name = "image/data"
+    # If True, training and evaluation read precomputed InceptionV3 outputs
+    # (written by extract_inception_features.py) instead of images. Requires
+    # train_inception=False. Inference always reads images.
+    self.use_inception_features = False
+    # Name of the SequenceExample context feature containing the precomputed
+    # InceptionV3 output, and its size.
+    self.inception_feature_name = "image/inception_features"
+    self.inception_feature_size = 2048
     # Name of the SequenceExample feature list containing integer captions.
     self.caption_feature_name = "image/caption_ids"
 
@@ -50,9 +73,25 @@ class ModelConfig(object):
     # for differences between tokenizer versions used in preprocessing. There is
     # no harm in using a value greater than the actual vocab size, but using a
     # value less than the actual vocab size will result in an error.
+    # train.py, evaluate.py and export_frozen_graph.py set it to the size of
+    # the vocabulary file when one is given; every extra word costs a row of
+    # the word embedding and a column of the logits layer. run_inference.py and
+    # caption_server.py read it from the checkpoint, so existing 12000-word
+    # checkpoints keep working. Existing checkpoints can be shrunk to a
+    # vocabulary with slice_vocab_checkpoint.py.
     self.vocab_size = 12000
 
+    # Increasing list of input sequence lengths (caption lengths minus 1) at
+    # which training and eval captions are split into buckets, e.g.
+    # [4, 5, 6, 8, 10, 13, 18]. Each batch is then drawn from a single bucket,
+    # which reduces padding but changes the composition of the batches.
+    # caption_padding_stats.py --bucket_boundaries measures the padding saved
+    # on a dataset. The default empty list pads each batch to its longest
+    # caption.
+    self.caption_length_boundaries = []
+
     # Number of threads for image preprocessing. Should be a multiple of 2.
+    # With the "dataset" input pipeline, the number of parallel map calls.
     self.num_preprocess_threads = 4
 
     # Batch size.
@@ -74,9 +113,33 @@ class ModelConfig(object):
     self.embedding_size = 512
     self.num_lstm_units = 512
 
+    # LSTM cell implementation: "basic" (BasicLSTMCell, built from separate
+    # matmul and elementwise ops) or "block" (LSTMBlockCell, a fused kernel per
+    # step). Their checkpoints are interchangeable; see
+    # show_and_tell_model.checkpoint_var_list.
+    self.lstm_implementation = "basic"
+
     # If < 1.0, the dropout keep probability applied to LSTM variables.
     self.lstm_dropout_keep_prob = 0.7
 
+    # Training loss: "softmax" (full softmax cross entropy), "sampled_softmax"
+    # or "nce". The sampled losses avoid computing the logits of the whole
+    # vocabulary at every training step; evaluation and inference always use
+    # the full softmax. Candidates are sampled from a log-uniform (Zipfian)
+    # distribution, which assumes that word ids are sorted by decreasing
+    # frequency, as in the word_counts file.
+    self.training_loss = "softmax"
+    # Number of classes sampled per batch by the sampled losses.
+    self.num_sampled_classes = 512
+    # If True, the logits weights are stored as [vocab_size, num_lstm_units]
+    # instead of [num_lstm_units, vocab_size]. The sampled losses then gather
+    # the rows of the sampled words and update only those rows, instead of
+    # transposing the whole matrix at every step. train.py enables it with the
+    # sampled losses. Checkpoints of the two layouts are not interchangeable;
+    # the scripts that load a checkpoint read its layout with
+    # show_and_tell_model.checkpoint_logits_vocab_major.
+    self.logits_weights_vocab_major = False
+
 
 class TrainingConfig(object):
   """Wrapper class for training hyperparameters."""
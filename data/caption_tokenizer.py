@@ -0,0 +1,185 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Caption tokenizer for genTFRecord.py.
+
+Captions are lowercased and split into words with the NLTK word tokenizer
+(nltk.tokenize.word_tokenize), which is imported on first use.
+
+The optional fast tokenizer applies the rules of the NLTK Treebank tokenizer
+with regular expressions, without sentence splitting. It only handles captions
+of lowercase ASCII letters, digits, whitespace and the punctuation below with
+at most one period, at the end; these rules are the same in every NLTK version
+and cannot be affected by sentence splitting. Other captions, e.g. those with
+quotes, apostrophes or inner periods, are passed to NLTK. On the craigcap
+titles 270,984 of the 298,083 distinct captions (about 91%) take the fast
+path.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import multiprocessing
+import re
+import threading
+
+
+# Captions that the fast tokenizer handles.
+_FAST_CAPTION = re.compile(r"^[a-z0-9\s,:;@#$%&?!()\[\]{}<>/+-]*\.?\s*$")
+
+# Substitutions of the NLTK Treebank tokenizer that can apply to a caption
+# matching _FAST_CAPTION, in the order NLTK applies them.
+_FAST_RULES = [
+    (re.compile(r"([:,])([^\d])"), r" \1 \2"),
+    (re.compile(r"([:,])$"), r" \1 "),
+    (re.compile(r"[;@#$%&]"), r" \g<0> "),
+    # The final period.
+    (re.compile(r"([^\.])(\.)\s*$"), r"\1 \2 "),
+    (re.compile(r"[?!]"), r" \g<0> "),
+    (re.compile(r"[\]\[\(\)\{\}\<\>]"), r" \g<0> "),
+    (re.compile(r"--"), r" -- "),
+]
+
+# Contractions split by the NLTK Treebank tokenizer that contain no apostrophe.
+_FAST_CONTRACTIONS = [
+    re.compile(r"(?i)\b(can)(not)\b"),
+    re.compile(r"(?i)\b(gim)(me)\b"),
+    re.compile(r"(?i)\b(gon)(na)\b"),
+    re.compile(r"(?i)\b(got)(ta)\b"),
+    re.compile(r"(?i)\b(lem)(me)\b"),
+    re.compile(r"(?i)\b(wan)(na)(?=\s)"),
+]
+
+
+def nltk_tokenize(text):
+  """Tokenizes text with nltk.tokenize.word_tokenize."""
+  import nltk.tokenize  # pylint: disable=g-import-not-at-top
+  return nltk.tokenize.word_tokenize(text)
+
+
+def fast_tokenize(text):
+  """Tokenizes text like nltk_tokenize().
+
+  Args:
+    text: A lowercase string.
+
+  Returns:
+    A list of strings, or None if text is not handled by the fast tokenizer.
+  """
+  if not _FAST_CAPTION.match(text):
+    return None
+  for regexp, substitution in _FAST_RULES:
+    text = regexp.sub(substitution, text)
+  text = " " + text + " "
+  for regexp in _FAST_CONTRACTIONS:
+    text = regexp.sub(r" \1 \2 ", text)
+  return text.split()
+
+
+class CaptionTokenizer(object):
+  """Tokenizes captions, memoizing the most recently used ones."""
+
+  def __init__(self, start_word, end_word, fast=False, cache_size=100000):
+    """Initializes the tokenizer.
+
+    Args:
+      start_word: Special word added to the beginning of each caption.
+      end_word: Special word added to the end of each caption.
+      fast: Whether to use fast_tokenize() for the captions it handles.
+      cache_size: Maximum number of memoized captions. If 0, nothing is
+        memoized.
+    """
+    self._start_word = start_word
+    self._end_word = end_word
+    self._fast = fast
+    self._cache_size = cache_size
+    self._cache = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def _tokenize(self, caption):
+    text = caption.lower()
+    words = fast_tokenize(text) if self._fast else None
+    if words is None:
+      words = nltk_tokenize(text)
+    return [self._start_word] + words + [self._end_word]
+
+  def tokenize(self, caption):
+    """Processes a caption string into a list of tokenized words.
+
+    Args:
+      caption: A string caption.
+
+    Returns:
+      A list of strings; the tokenized caption including the start and end
+      words.
+    """
+    with self._lock:
+      words = self._cache.pop(caption, None)
+      if words is not None:
+        self._cache[caption] = words
+        return list(words)
+    words = self._tokenize(caption)
+    if self._cache_size > 0:
+      with self._lock:
+        self._cache[caption] = words
+        if len(self._cache) > self._cache_size:
+          self._cache.popitem(last=False)
+    return list(words)
+
+  def tokenize_all(self, captions, num_processes=1, chunksize=256):
+    """Tokenizes a list of captions, each distinct caption once.
+
+    Args:
+      captions: A list of string captions.
+      num_processes: Number of worker processes. If 1, captions are tokenized
+        in this process.
+      chunksize: Number of distinct captions sent to a worker at a time.
+
+    Returns:
+      A list with the tokenized words of each caption.
+    """
+    distinct = list(collections.OrderedDict.fromkeys(captions))
+    if num_processes <= 1:
+      tokenized = [self.tokenize(c) for c in distinct]
+    else:
+      pool = multiprocessing.Pool(num_processes,
+                                  initializer=_init_worker,
+                                  initargs=(self._start_word, self._end_word,
+                                            self._fast))
+      try:
+        tokenized = pool.map(_tokenize_in_worker, distinct, chunksize)
+        pool.close()
+        pool.join()
+      finally:
+        # Stops the workers if pool.map() raised, e.g. on KeyboardInterrupt.
+        # A no-op after join().
+        pool.terminate()
+    caption_to_words = dict(zip(distinct, tokenized))
+    return [list(caption_to_words[c]) for c in captions]
+
+
+# Tokenizer of a worker process of CaptionTokenizer.tokenize_all().
+_worker_tokenizer = []
+
+
+def _init_worker(start_word, end_word, fast):
+  # Each caption reaches a worker once, so there is nothing to memoize.
+  _worker_tokenizer.append(
+      CaptionTokenizer(start_word, end_word, fast=fast, cache_size=0))
+
+
+def _tokenize_in_worker(caption):
+  return _worker_tokenizer[0].tokenize(caption)
@@ -0,0 +1,90 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests for caption_tokenizer."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import csv
+import os
+
+
+import tensorflow as tf
+
+import caption_tokenizer
+
+_CAPTIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "craigcapAnno")
+
+
+class CaptionTokenizerTest(tf.test.TestCase):
+
+  def testFastTokenizerMatchesNltkOnCorpus(self):
+    captions = set()
+    for filename in sorted(os.listdir(_CAPTIONS_DIR)):
+      with open(os.path.join(_CAPTIONS_DIR, filename), "r") as f:
+        for row in csv.reader(f):
+          if row[2] != "":
+            captions.add(row[1].lower())
+    self.assertTrue(captions)
+
+    num_fast = 0
+    for caption in sorted(captions):
+      words = caption_tokenizer.fast_tokenize(caption)
+      if words is not None:
+        num_fast += 1
+        self.assertEqual(caption_tokenizer.nltk_tokenize(caption), words,
+                         msg=caption)
+    self.assertGreater(num_fast, 0.9 * len(captions))
+
+  def testFastTokenizer(self):
+    self.assertEqual(["table", ",", "4", "chairs", ":", "$", "100", "(", "new",
+                      ")", "."],
+                     caption_tokenizer.fast_tokenize(
+                         "table, 4 chairs: $100 (new)."))
+    self.assertEqual(["i", "can", "not", "sell", "1,000", "items", "!", "!"],
+                     caption_tokenizer.fast_tokenize(
+                         "i cannot sell 1,000 items!!"))
+    self.assertIsNone(caption_tokenizer.fast_tokenize("2 ft. long"))
+    self.assertIsNone(caption_tokenizer.fast_tokenize("mom's chair"))
+
+  def testTokenize(self):
+    tokenizer = caption_tokenizer.CaptionTokenizer("<S>", "</S>", fast=True)
+    self.assertEqual(["<S>", "red", "sofa", "</S>"],
+                     tokenizer.tokenize("Red Sofa"))
+
+  def testCacheIsBounded(self):
+    tokenizer = caption_tokenizer.CaptionTokenizer("<S>", "</S>", fast=True,
+                                                   cache_size=2)
+    for caption in ["a", "b", "c", "a"]:
+      tokenizer.tokenize(caption)
+    self.assertEqual(["c", "a"], list(tokenizer._cache.keys()))
+
+    # Callers may modify the returned words.
+    tokenizer.tokenize("a").append("x")
+    self.assertEqual(["<S>", "a", "</S>"], tokenizer.tokenize("a"))
+
+  def testTokenizeAll(self):
+    tokenizer = caption_tokenizer.CaptionTokenizer("<S>", "</S>", fast=True)
+    captions = ["Red Sofa", "desk", "Red Sofa"]
+    expected = [tokenizer.tokenize(c) for c in captions]
+    self.assertEqual(expected, tokenizer.tokenize_all(captions))
+    self.assertEqual(expected,
+                     tokenizer.tokenize_all(captions, num_processes=2))
+
+
+if __name__ == "__main__":
+  tf.test.main()
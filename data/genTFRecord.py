@@ -65,11 +65,20 @@ The SequenceExample proto contains the following fields:
     image/image_id: string craigcap image identifier taken from filename
     image/data: string containing JPEG encoded image in RGB colorspace
 
+  and, with --image_storage=jpeg or --image_storage=raw:
+    image/data: string containing the image resized to --stored_image_size,
+      JPEG encoded or as uint8 RGB pixels in row major order
+    image/format: string "jpeg" or "raw"
+    image/height: integer height of the stored image
+    image/width: integer width of the stored image
+
   feature_lists:
     image/caption: list of strings containing the (tokenized) caption words
     image/caption_ids: list of integer ids corresponding to the caption words
 
-The captions are tokenized using the NLTK (http://www.nltk.org/) word tokenizer.
+The captions are tokenized using the NLTK (http://www.nltk.org/) word tokenizer,
+or with --fast_tokenizer by regular expressions that give the same result for
+most captions (see caption_tokenizer.py).
 The vocabulary of word identifiers is constructed from the sorted list (by
 descending frequency) of word tokens in the training set. Only tokens appearing
 at least 4 times are considered; all other words get the "unknown" word id.
@@ -77,6 +86,15 @@ at least 4 times are considered; all other words get the "unknown" word id.
 NOTE: This script will consume around (TODO)GB of disk space.
 
 Running this script using 16 threads may take around (TODO) hour on a mid level 2014 pc.
+With --num_processes=N the shards are instead written by N worker processes,
+each with its own ImageDecoder, which avoids contention on the GIL. The output
+is the same in both modes for the same --seed.
+
+Each build writes a manifest (out/manifest.json) of the processed images with
+a hash of their contents, the split and the shards they went to. With
+--incremental only new images are processed, and they are written to
+additional shards such as out/train-20170101120000-00000-of-00002. Images that
+changed after their records were written require a full build.
 """
 
 from __future__ import absolute_import
@@ -84,21 +102,27 @@ from __future__ import division
 from __future__ import print_function
 
 from collections import Counter
+from collections import deque
 from collections import namedtuple
+from collections import OrderedDict
 from datetime import datetime
+import hashlib
 import json
 import csv
+import multiprocessing
 import os.path
 import random
+import struct
 import sys
 import threading
 
 
 
-import nltk.tokenize
 import numpy as np
 import tensorflow as tf
 
+import caption_tokenizer
+
 tf.flags.DEFINE_string("craigcap_image_dir", "craigcapImg",
                        "Training image directory.")
 
@@ -126,14 +150,93 @@ tf.flags.DEFINE_integer("min_word_count", 4,
 tf.flags.DEFINE_string("word_counts_output_file", "out/word_counts.txt",
                        "Output vocabulary file of word counts.")
 
+tf.flags.DEFINE_boolean("fast_tokenizer", False,
+                        "Whether to tokenize the captions that it handles with "
+                        "caption_tokenizer.fast_tokenize instead of NLTK.")
+tf.flags.DEFINE_integer("tokenizer_cache_size", 100000,
+                        "Number of recently tokenized captions memoized by "
+                        "each process.")
+
 tf.flags.DEFINE_integer("num_threads", 8,
                         "Number of threads to preprocess the images.")
+tf.flags.DEFINE_integer("num_processes", 0,
+                        "Number of worker processes to preprocess the images. "
+                        "If positive, shards are handed out to a process pool "
+                        "instead of num_threads threads.")
+tf.flags.DEFINE_integer("seed", 12345,
+                        "Seed of the shuffle of the image-caption pairs.")
+
+tf.flags.DEFINE_string("image_storage", "original",
+                       "How images are stored: \"original\" (the scraped JPEG "
+                       "files), \"jpeg\" (resized to stored_image_size and "
+                       "re-encoded) or \"raw\" (resized uint8 pixels). Train "
+                       "on resized images with stored_image_height and "
+                       "stored_image_width set in configuration.py.")
+tf.flags.DEFINE_integer("stored_image_size", 346,
+                        "Height and width of the stored images if "
+                        "image_storage is \"jpeg\" or \"raw\". The default "
+                        "is the size image_processing.process_image() resizes "
+                        "to.")
+tf.flags.DEFINE_integer("stored_jpeg_quality", 95,
+                        "JPEG quality of the stored images if image_storage "
+                        "is \"jpeg\".")
+
+tf.flags.DEFINE_boolean("dedupe_images", False,
+                        "Whether to merge images with identical or nearly "
+                        "identical content, e.g. the same photo posted under "
+                        "different ids in different cities, into one image "
+                        "with the captions of all of them.")
+tf.flags.DEFINE_integer("near_duplicate_distance", 3,
+                        "Maximum Hamming distance between the 64 bit "
+                        "perceptual hashes of near duplicate images. If "
+                        "negative, only byte identical images are merged.")
+tf.flags.DEFINE_string("image_hash_index_file", "",
+                       "Index of the image hashes computed by "
+                       "--dedupe_images, reused for unchanged files. "
+                       "Defaults to output_dir/image_hashes.json.")
+
+tf.flags.DEFINE_boolean("streaming", False,
+                        "Whether to stream the city CSV files into the shards "
+                        "instead of loading all metadata into memory. Items "
+                        "are assigned to splits and shards by a hash of their "
+                        "image id, so memory use does not grow with the "
+                        "number of cities.")
+tf.flags.DEFINE_integer("streaming_batch_size", 1024,
+                        "Number of image-caption pairs serialized per batch "
+                        "in streaming mode.")
+tf.flags.DEFINE_integer("streaming_shuffle_buffer_size", 32,
+                        "Number of serialized records buffered per shard in "
+                        "streaming mode to shuffle the order of the records "
+                        "within the shard. Memory use is about this many "
+                        "records times the number of shards.")
+tf.flags.DEFINE_integer("streaming_max_tracked_ids", 1000000,
+                        "Number of most recently seen image ids whose first "
+                        "city is remembered in streaming mode, so that the "
+                        "captions of a repeated id are kept with its first "
+                        "image. A repeat of an id that is no longer tracked "
+                        "keeps the image of its own city.")
+
+tf.flags.DEFINE_boolean("incremental", False,
+                        "Whether to only process images that are not in the "
+                        "manifest of a previous build. They are appended to "
+                        "output_dir in new shards, and the existing "
+                        "vocabulary is reused. Fails if images of the previous "
+                        "build changed.")
+tf.flags.DEFINE_string("manifest_file", "",
+                       "Manifest of the processed images. Defaults to "
+                       "output_dir/manifest.json.")
 
 FLAGS = tf.flags.FLAGS
 
 ImageMetadata = namedtuple("ImageMetadata",
                            ["image_id", "filename", "captions"])
 
+# How images are stored when they are not stored as the original files:
+# image_format is "jpeg" or "raw", size the height and width they are resized
+# to and jpeg_quality the quality of re-encoded JPEGs.
+ImageStorage = namedtuple("ImageStorage",
+                          ["image_format", "size", "jpeg_quality"])
+
 
 class Vocabulary(object):
   """Simple vocabulary wrapper."""
@@ -157,23 +260,165 @@ class Vocabulary(object):
 
 
 class ImageDecoder(object):
-  """Helper class for decoding images in TensorFlow."""
+  """Helper class for decoding images in TensorFlow.
 
-  def __init__(self):
-    # Create a single TensorFlow Session for all image decoding calls.
-    self._sess = tf.Session()
+  The Session is created on the first decode, so a decoder that only sees
+  images passing _parse_jpeg_header() checks costs nothing.
+  """
+
+  def __init__(self, jpeg_quality=95):
+    self._jpeg_quality = jpeg_quality
+    self._lock = threading.Lock()
+    self._sess = None
 
-    # TensorFlow ops for JPEG decoding.
-    self._encoded_jpeg = tf.placeholder(dtype=tf.string)
-    self._decode_jpeg = tf.image.decode_jpeg(self._encoded_jpeg, channels=3)
+  def _build(self):
+    # Create a single TensorFlow Session for all image decoding calls.
+    g = tf.Graph()
+    with g.as_default():
+      # TensorFlow ops for JPEG decoding.
+      self._encoded_jpeg = tf.placeholder(dtype=tf.string)
+      self._decode_jpeg = tf.image.decode_jpeg(self._encoded_jpeg, channels=3)
+
+      # TensorFlow ops for resizing, as in image_processing.process_image().
+      self._size = tf.placeholder(dtype=tf.int32, shape=[2])
+      image = tf.image.convert_image_dtype(self._decode_jpeg, dtype=tf.float32)
+      image = tf.image.resize_images(image, size=self._size,
+                                     method=tf.image.ResizeMethod.BILINEAR)
+      self._resized = tf.image.convert_image_dtype(image, dtype=tf.uint8,
+                                                   saturate=True)
+      self._encode_resized = tf.image.encode_jpeg(self._resized,
+                                                  quality=self._jpeg_quality)
+
+      # TensorFlow ops for the pixels of a difference hash.
+      gray = tf.image.rgb_to_grayscale(
+          tf.image.convert_image_dtype(self._decode_jpeg, dtype=tf.float32))
+      self._dhash_pixels = tf.squeeze(
+          tf.image.resize_images(gray, size=[8, 9],
+                                 method=tf.image.ResizeMethod.AREA), [2])
+    self._sess = tf.Session(graph=g)
+
+  def _session(self):
+    with self._lock:
+      if self._sess is None:
+        self._build()
+    return self._sess
 
   def decode_jpeg(self, encoded_jpeg):
-    image = self._sess.run(self._decode_jpeg,
-                           feed_dict={self._encoded_jpeg: encoded_jpeg})
+    image = self._session().run(self._decode_jpeg,
+                                feed_dict={self._encoded_jpeg: encoded_jpeg})
     assert len(image.shape) == 3
     assert image.shape[2] == 3
     return image
 
+  def resize_jpeg(self, encoded_jpeg, size, image_format):
+    """Resizes a JPEG image to [size, size].
+
+    Args:
+      encoded_jpeg: String of JPEG encoded image bytes.
+      size: Height and width of the resized image.
+      image_format: "jpeg" to return the resized image JPEG encoded, or "raw"
+        to return its uint8 pixels in row major order.
+
+    Returns:
+      A string of image bytes.
+    """
+    sess = self._session()
+    feed_dict = {self._encoded_jpeg: encoded_jpeg, self._size: [size, size]}
+    if image_format == "jpeg":
+      return sess.run(self._encode_resized, feed_dict=feed_dict)
+    assert image_format == "raw"
+    return sess.run(self._resized, feed_dict=feed_dict).tobytes()
+
+  def dhash(self, encoded_jpeg):
+    """Returns the 64 bit difference hash of a JPEG image.
+
+    The image is reduced to 8x9 gray pixels, and each bit is whether a pixel is
+    brighter than its left neighbor. Recompressed or rescaled copies of an
+    image have hashes within a few bits of each other.
+    """
+    pixels = self._session().run(self._dhash_pixels,
+                                 feed_dict={self._encoded_jpeg: encoded_jpeg})
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(sum(1 << i for i, bit in enumerate(bits) if bit))
+
+
+# JPEG start of frame markers, which hold the image dimensions. 0xC4, 0xC8 and
+# 0xCC share the range but are not frame headers.
+# Start of frame markers of the 8-bit baseline (SOF0), extended sequential
+# (SOF1) and progressive (SOF2) Huffman coded JPEGs that tf.image.decode_jpeg
+# reads. Other frame types, e.g. lossless or arithmetic coded, are decoded in
+# full to check them.
+_SOF_MARKERS = frozenset([0xC0, 0xC1, 0xC2])
+# Other start of frame markers.
+_OTHER_SOF_MARKERS = (frozenset(range(0xC3, 0xD0)) -
+                      frozenset([0xC4, 0xC8, 0xCC]))
+
+
+def _parse_jpeg_header(encoded_jpeg):
+  """Reads the dimensions of a JPEG image from its start of frame header.
+
+  Args:
+    encoded_jpeg: String of JPEG encoded image bytes.
+
+  Returns:
+    A tuple (height, width, num_components), or None if no well formed 8-bit
+    SOF0, SOF1 or SOF2 start of frame header precedes the image data.
+  """
+  if encoded_jpeg[:2] != b"\xff\xd8":
+    return None
+  i = 2
+  size = len(encoded_jpeg)
+  try:
+    while i + 4 <= size:
+      prefix, marker = struct.unpack_from(">BB", encoded_jpeg, i)
+      if prefix != 0xFF:
+        return None
+      if marker == 0xFF:
+        # Fill byte.
+        i += 1
+        continue
+      if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+        # Standalone markers without a length.
+        i += 2
+        continue
+      if marker in _SOF_MARKERS:
+        _, precision, height, width, num_components = struct.unpack_from(
+            ">HBHHB", encoded_jpeg, i + 2)
+        if precision != 8:
+          return None
+        return height, width, num_components
+      if marker in _OTHER_SOF_MARKERS or marker in (0xD9, 0xDA):
+        # Unsupported frame type, or end of image or start of scan before any
+        # frame header.
+        return None
+      (length,) = struct.unpack_from(">H", encoded_jpeg, i + 2)
+      i += 2 + length
+  except struct.error:
+    return None
+  return None
+
+
+def _validate_jpeg(encoded_jpeg, decoder):
+  """Checks that an image can be decoded to 3 channels.
+
+  Images with a well formed 8-bit SOF0, SOF1 or SOF2 header of 1 or 3
+  components that end in an end of image marker are accepted without decoding
+  them. Others are decoded in full.
+
+  Args:
+    encoded_jpeg: String of JPEG encoded image bytes.
+    decoder: An ImageDecoder object.
+
+  Raises:
+    tf.errors.InvalidArgumentError or AssertionError: If the image is invalid.
+  """
+  header = _parse_jpeg_header(encoded_jpeg)
+  if (header is not None and header[0] > 0 and header[1] > 0 and
+      header[2] in (1, 3) and
+      encoded_jpeg.rstrip(b"\0")[-2:] == b"\xff\xd9"):
+    return
+  decoder.decode_jpeg(encoded_jpeg)
+
 
 def _int64_feature(value):
   """Wrapper for inserting an int64 Feature into a SequenceExample proto."""
@@ -182,7 +427,7 @@ def _int64_feature(value):
 
 def _bytes_feature(value):
   """Wrapper for inserting a bytes Feature into a SequenceExample proto."""
-  return tf.train.Feature(bytes_list=tf.train.BytesList(value=[str(value)]))
+  return tf.train.Feature(bytes_list=tf.train.BytesList(value=[tf.compat.as_bytes(value)]))
 
 
 def _int64_feature_list(values):
@@ -195,25 +440,33 @@ def _bytes_feature_list(values):
   return tf.train.FeatureList(feature=[_bytes_feature(v) for v in values])
 
 
-def _to_sequence_example(image, decoder, vocab):
+def _to_sequence_example(image, decoder, vocab, image_storage=None):
   """Builds a SequenceExample proto for an image-caption pair.
 
   Args:
     image: An ImageMetadata object.
     decoder: An ImageDecoder object.
     vocab: A Vocabulary object.
+    image_storage: An ImageStorage object, or None to store the original JPEG.
 
   Returns:
     A SequenceExample proto.
   """
-  with tf.gfile.FastGFile(image.filename, "r") as f:
+  with tf.gfile.FastGFile(image.filename, "rb") as f:
     try:
       encoded_image = f.read()
-      decoder.decode_jpeg(encoded_image)
-      context = tf.train.Features(feature={
+      _validate_jpeg(encoded_image, decoder)
+      context = {
           "image/image_id": _bytes_feature(image.image_id), # we are using the filename string as the identifier instead of an int
           "image/data": _bytes_feature(encoded_image),
-      })
+      }
+      if image_storage is not None:
+        context["image/data"] = _bytes_feature(decoder.resize_jpeg(
+            encoded_image, image_storage.size, image_storage.image_format))
+        context["image/format"] = _bytes_feature(image_storage.image_format)
+        context["image/height"] = _int64_feature(image_storage.size)
+        context["image/width"] = _int64_feature(image_storage.size)
+      context = tf.train.Features(feature=context)
       assert len(image.captions) == 1
       caption = image.captions[0]
       caption_ids = [vocab.word_to_id(word) for word in caption]
@@ -232,67 +485,199 @@ def _to_sequence_example(image, decoder, vocab):
       return
 
 
+def _shard_ranges(num_images, num_shards, num_threads):
+  """Returns the [start, end) range of images in each shard.
+
+  The images are first split into num_threads batches and each batch into
+  num_shards / num_threads shards, so that the shards are the same whether they
+  are written by threads or by processes.
+  """
+  num_threads = min(num_shards, num_threads)
+  num_shards_per_batch = int(num_shards / num_threads)
+  spacing = np.linspace(0, num_images, num_threads + 1).astype(int)
+  ranges = []
+  for i in range(num_threads):
+    shard_spacing = np.linspace(spacing[i], spacing[i + 1],
+                                num_shards_per_batch + 1).astype(int)
+    for s in range(num_shards_per_batch):
+      ranges.append((shard_spacing[s], shard_spacing[s + 1]))
+  return ranges
+
+
+def _write_shard(output_file, images, decoder, vocab, image_storage=None,
+                 progress_fn=None):
+  """Writes image-caption pairs to a TFRecord file.
+
+  Args:
+    output_file: Output TFRecord file.
+    images: List of ImageMetadata.
+    decoder: An ImageDecoder object.
+    vocab: A Vocabulary object.
+    image_storage: An ImageStorage object, or None to store the original JPEGs.
+    progress_fn: Optional function called with the number of pairs written to
+      the shard so far after each written pair.
+
+  Returns:
+    The number of image-caption pairs written.
+  """
+  writer = tf.python_io.TFRecordWriter(output_file)
+  shard_counter = 0
+  for image in images:
+    sequence_example = _to_sequence_example(image, decoder, vocab,
+                                            image_storage)
+    if sequence_example is not None:
+      writer.write(sequence_example.SerializeToString())
+      shard_counter += 1
+      if progress_fn:
+        progress_fn(shard_counter)
+  writer.close()
+  return shard_counter
+
+
+def _shard_filename(output_dir, name, shard, num_shards):
+  """Returns a sharded file name, e.g. 'out/train-00002-of-00010'."""
+  return os.path.join(output_dir,
+                      "%s-%.5d-of-%.5d" % (name, shard, num_shards))
+
+
 def _process_image_files(thread_index, ranges, name, images, decoder, vocab,
-                         num_shards):
-  """Processes and saves a subset of images as TFRecord files in one thread.
+                         num_shards, image_storage):
+  """Processes and saves a subset of shards as TFRecord files in one thread.
 
   Args:
-    thread_index: Integer thread identifier within [0, len(ranges)].
-    ranges: A list of pairs of integers specifying the ranges of the dataset to
-      process in parallel.
+    thread_index: Integer thread identifier within [0, num_threads).
+    ranges: A list with one list per thread of the (start, end) ranges of the
+      images in each of its shards.
     name: Unique identifier specifying the dataset.
     images: List of ImageMetadata.
     decoder: An ImageDecoder object.
     vocab: A Vocabulary object.
     num_shards: Integer number of shards for the output files.
+    image_storage: An ImageStorage object, or None to store the original JPEGs.
   """
   # Each thread produces N shards where N = num_shards / num_threads. For
   # instance, if num_shards = 128, and num_threads = 2, then the first thread
   # would produce shards [0, 64).
-  num_threads = len(ranges)
-  assert not num_shards % num_threads
-  num_shards_per_batch = int(num_shards / num_threads)
-
-  shard_ranges = np.linspace(ranges[thread_index][0], ranges[thread_index][1],
-                             num_shards_per_batch + 1).astype(int)
-  num_images_in_thread = ranges[thread_index][1] - ranges[thread_index][0]
-
+  num_shards_per_batch = len(ranges[thread_index])
+  num_images_in_thread = ranges[thread_index][-1][1] - ranges[thread_index][0][0]
   counter = 0
 
-  # Changed xrange to range because we are running python3 not python2
-  for s in range(num_shards_per_batch):
-    # Generate a sharded version of the file name, e.g. 'train-00002-of-00010'
-    shard = thread_index * num_shards_per_batch + s
-    output_filename = "%s-%.5d-of-%.5d" % (name, shard, num_shards)
-    output_file = os.path.join(FLAGS.output_dir, output_filename)
-    writer = tf.python_io.TFRecordWriter(output_file)
-
-    shard_counter = 0
-    images_in_shard = np.arange(shard_ranges[s], shard_ranges[s + 1], dtype=int)
-    for i in images_in_shard:
-      image = images[i]
-
-      sequence_example = _to_sequence_example(image, decoder, vocab)
-      if sequence_example is not None:
-        writer.write(sequence_example.SerializeToString())
-        shard_counter += 1
-        counter += 1
-
-      if not counter % 1000:
-        print("%s [thread %d]: Processed %d of %d items in thread batch." %
-              (datetime.now(), thread_index, counter, num_images_in_thread))
-        sys.stdout.flush()
+  def _print_progress(shard_counter):
+    if not (counter + shard_counter) % 1000:
+      print("%s [thread %d]: Processed %d of %d items in thread batch." %
+            (datetime.now(), thread_index, counter + shard_counter,
+             num_images_in_thread))
+      sys.stdout.flush()
 
-    writer.close()
+  for s, (start, end) in enumerate(ranges[thread_index]):
+    shard = thread_index * num_shards_per_batch + s
+    output_file = _shard_filename(FLAGS.output_dir, name, shard, num_shards)
+    shard_counter = _write_shard(output_file, images[start:end], decoder, vocab,
+                                 image_storage, progress_fn=_print_progress)
+    counter += shard_counter
     print("%s [thread %d]: Wrote %d image-caption pairs to %s" %
           (datetime.now(), thread_index, shard_counter, output_file))
     sys.stdout.flush()
-    shard_counter = 0
   print("%s [thread %d]: Wrote %d image-caption pairs to %d shards." %
         (datetime.now(), thread_index, counter, num_shards_per_batch))
   sys.stdout.flush()
 
 
+# State of a worker process of _process_dataset_in_processes(), set by
+# _init_worker().
+_worker_state = {}
+
+
+def _init_worker(output_dir, name, images, vocab, num_shards, image_storage):
+  """Initializes a worker process with its own ImageDecoder."""
+  _worker_state["output_dir"] = output_dir
+  _worker_state["name"] = name
+  _worker_state["images"] = images
+  _worker_state["vocab"] = vocab
+  _worker_state["num_shards"] = num_shards
+  _worker_state["image_storage"] = image_storage
+  _worker_state["decoder"] = ImageDecoder(
+      image_storage.jpeg_quality if image_storage else 95)
+
+
+def _process_shard(task):
+  """Writes one shard in a worker process.
+
+  Args:
+    task: A tuple (shard, start, end) of the shard index and the range of its
+      images.
+
+  Returns:
+    A tuple (output_file, num_images, num_written).
+  """
+  shard, start, end = task
+  output_file = _shard_filename(_worker_state["output_dir"],
+                                _worker_state["name"], shard,
+                                _worker_state["num_shards"])
+  num_written = _write_shard(output_file, _worker_state["images"][start:end],
+                             _worker_state["decoder"], _worker_state["vocab"],
+                             _worker_state["image_storage"])
+  return output_file, end - start, num_written
+
+
+def _process_dataset_in_processes(name, images, vocab, num_shards,
+                                  num_processes, image_storage):
+  """Writes the shards of a data set in a pool of worker processes.
+
+  Each worker creates its own ImageDecoder and takes the next unwritten shard
+  whenever it finishes one. The shard ranges are those of the threaded path, so
+  the output is identical.
+
+  Args:
+    name: Unique identifier specifying the dataset.
+    images: Shuffled list of ImageMetadata with one caption each.
+    vocab: A Vocabulary object.
+    num_shards: Integer number of shards for the output files.
+    num_processes: Number of worker processes.
+    image_storage: An ImageStorage object, or None to store the original JPEGs.
+  """
+  ranges = _shard_ranges(len(images), num_shards, FLAGS.num_threads)
+  tasks = [(shard, start, end) for shard, (start, end) in enumerate(ranges)]
+  print("Launching %d processes for %d shards." % (num_processes, num_shards))
+  pool = multiprocessing.Pool(
+      num_processes, initializer=_init_worker,
+      initargs=(FLAGS.output_dir, name, images, vocab, num_shards,
+                image_storage))
+  num_shards_done = 0
+  num_images_done = 0
+  num_written = 0
+  try:
+    for output_file, shard_images, shard_written in pool.imap_unordered(
+        _process_shard, tasks):
+      num_shards_done += 1
+      num_images_done += shard_images
+      num_written += shard_written
+      print("%s: Wrote %d image-caption pairs to %s (%d of %d shards, %d of %d "
+            "pairs)." % (datetime.now(), shard_written, output_file,
+                         num_shards_done, num_shards, num_images_done,
+                         len(images)))
+      sys.stdout.flush()
+    pool.close()
+    pool.join()
+  finally:
+    # Stops the workers if anything, including KeyboardInterrupt,
+    # ended the loop early. A no-op after join().
+    pool.terminate()
+  print("%s: Wrote %d image-caption pairs to %d shards." %
+        (datetime.now(), num_written, num_shards))
+
+
+def _image_storage():
+  """Returns the ImageStorage given by the flags, or None."""
+  if FLAGS.image_storage == "original":
+    return None
+  assert FLAGS.image_storage in ("jpeg", "raw"), (
+      "Invalid --image_storage: %s" % FLAGS.image_storage)
+  assert FLAGS.stored_image_size > 0, "--stored_image_size must be positive"
+  return ImageStorage(FLAGS.image_storage, FLAGS.stored_image_size,
+                      FLAGS.stored_jpeg_quality)
+
+
 def _process_dataset(name, images, vocab, num_shards):
   """Processes a complete data set and saves it as a TFRecord.
 
@@ -301,38 +686,61 @@ def _process_dataset(name, images, vocab, num_shards):
     images: List of ImageMetadata.
     vocab: A Vocabulary object.
     num_shards: Integer number of shards for the output files.
+
+  Returns:
+    A dict of image filename to the list of names of the shards with its
+    image-caption pairs.
   """
   # Break up each image into a separate entity for each caption.
   images = [ImageMetadata(image.image_id, image.filename, [caption])
             for image in images for caption in image.captions]
 
   # Shuffle the ordering of images. Make the randomization repeatable.
-  random.seed(12345)
+  random.seed(FLAGS.seed)
   random.shuffle(images)
 
-  # Break the images into num_threads batches. Batch i is defined as
-  # images[ranges[i][0]:ranges[i][1]].
+  filename_to_shards = {}
+  for shard, (start, end) in enumerate(
+      _shard_ranges(len(images), num_shards, FLAGS.num_threads)):
+    shard_name = os.path.basename(
+        _shard_filename(FLAGS.output_dir, name, shard, num_shards))
+    for image in images[start:end]:
+      shards = filename_to_shards.setdefault(image.filename, [])
+      if shard_name not in shards:
+        shards.append(shard_name)
+
+  image_storage = _image_storage()
+  if FLAGS.num_processes > 0:
+    _process_dataset_in_processes(name, images, vocab, num_shards,
+                                  FLAGS.num_processes, image_storage)
+    print("%s: Finished processing all %d image-caption pairs in data set "
+          "'%s'." % (datetime.now(), len(images), name))
+    return filename_to_shards
+
+  # Break the shards into num_threads batches. Batch i holds the shards
+  # ranges[i].
   num_threads = min(num_shards, FLAGS.num_threads)
-  spacing = np.linspace(0, len(images), num_threads + 1).astype(np.int)
-  ranges = []
+  shard_ranges = _shard_ranges(len(images), num_shards, num_threads)
+  num_shards_per_batch = int(num_shards / num_threads)
+  ranges = [shard_ranges[i * num_shards_per_batch:
+                         (i + 1) * num_shards_per_batch]
+            for i in range(num_threads)]
   threads = []
 
-  # Changed xrange to range because we are running python3 not python2
-  for i in range(len(spacing) - 1):
-    ranges.append([spacing[i], spacing[i + 1]])
-
   # Create a mechanism for monitoring when all threads are finished.
   coord = tf.train.Coordinator()
 
   # Create a utility for decoding JPEG images to run sanity checks.
-  decoder = ImageDecoder()
+  decoder = ImageDecoder(image_storage.jpeg_quality if image_storage else 95)
 
   # Launch a thread for each batch.
-  print("Launching %d threads for spacings: %s" % (num_threads, ranges))
-  
+  print("Launching %d threads for spacings: %s" %
+        (num_threads, [(r[0][0], r[-1][1]) for r in ranges]))
+
   # Changed xrange to range because we are running python3 not python2
   for thread_index in range(len(ranges)):
-    args = (thread_index, ranges, name, images, decoder, vocab, num_shards)
+    args = (thread_index, ranges, name, images, decoder, vocab, num_shards,
+            image_storage)
     t = threading.Thread(target=_process_image_files, args=args)
     t.start()
     threads.append(t)
@@ -341,6 +749,7 @@ def _process_dataset(name, images, vocab, num_shards):
   coord.join(threads)
   print("%s: Finished processing all %d image-caption pairs in data set '%s'." %
         (datetime.now(), len(images), name))
+  return filename_to_shards
 
 
 def _create_vocab(captions):
@@ -350,7 +759,7 @@ def _create_vocab(captions):
   word in the file is its corresponding 0-based line number.
 
   Args:
-    captions: A list of lists of strings.
+    captions: An iterable of lists of strings.
 
   Returns:
     A Vocabulary object.
@@ -380,6 +789,35 @@ def _create_vocab(captions):
   return vocab
 
 
+def _load_vocab(word_counts_file):
+  """Loads the Vocabulary written by _create_vocab().
+
+  Args:
+    word_counts_file: File of word counts written by a previous build.
+
+  Returns:
+    A Vocabulary object.
+  """
+  with tf.gfile.FastGFile(word_counts_file, "r") as f:
+    reverse_vocab = [line.split()[0] for line in f if line.strip()]
+  print("Loaded vocabulary file:", word_counts_file)
+  vocab_dict = dict([(x, y) for (y, x) in enumerate(reverse_vocab)])
+  return Vocabulary(vocab_dict, len(reverse_vocab))
+
+
+# The CaptionTokenizer of this process, created by _get_tokenizer().
+_tokenizer = []
+
+
+def _get_tokenizer():
+  """Returns the CaptionTokenizer given by the flags."""
+  if not _tokenizer:
+    _tokenizer.append(caption_tokenizer.CaptionTokenizer(
+        FLAGS.start_word, FLAGS.end_word, fast=FLAGS.fast_tokenizer,
+        cache_size=FLAGS.tokenizer_cache_size))
+  return _tokenizer[0]
+
+
 def _process_caption(caption):
   """Processes a caption string into a list of tonenized words.
 
@@ -389,10 +827,7 @@ def _process_caption(caption):
   Returns:
     A list of strings; the tokenized caption.
   """
-  tokenized_caption = [FLAGS.start_word]
-  tokenized_caption.extend(nltk.tokenize.word_tokenize(caption.lower()))
-  tokenized_caption.append(FLAGS.end_word)
-  return tokenized_caption
+  return _get_tokenizer().tokenize(caption)
 
 
 def show(n, xs, desc):
@@ -422,15 +857,15 @@ def dedupe(xs, desc):
 
 
 
-def _load_and_process_metadata_craigcap(captions_dir, image_dir):
-  """Loads image metadata from a directory containing CSV files and processes the captions.
+def _load_metadata_craigcap(captions_dir, image_dir):
+  """Loads image metadata from a directory containing CSV files.
 
   Args:
     captions_dir: Directory containing CSV files for each city containing caption annotations.
     image_dir: Directory containing subdirecties for each city with image files.
 
   Returns:
-    A list of ImageMetadata.
+    A list of ImageMetadata with the untokenized caption strings.
   """
   image_metadata = []
 
@@ -486,19 +921,657 @@ def _load_and_process_metadata_craigcap(captions_dir, image_dir):
   assert set([x[0] for x in id_to_filename]) == set(id_to_captions.keys())
   print("Loaded caption metadata for %d images from %s and %s" % (len(id_to_filename), captions_dir, image_dir))
 
-  # Process the captions and combine the data into a list of ImageMetadata.
-  print("Processing captions.")
-  
-  num_captions = 0
   for image_id, base_filename in id_to_filename:
     filename = os.path.join(image_dir, base_filename)
-    captions = [_process_caption(c) for c in id_to_captions[image_id]]
-    image_metadata.append(ImageMetadata(image_id, filename, captions))
+    image_metadata.append(
+        ImageMetadata(image_id, filename, id_to_captions[image_id]))
+  return image_metadata
+
+
+def _process_metadata_captions(image_metadata, captions_dir, image_dir):
+  """Tokenizes the captions of a list of ImageMetadata.
+
+  Args:
+    image_metadata: A list of ImageMetadata with untokenized captions.
+    captions_dir: Directory the captions were loaded from.
+    image_dir: Directory the images were loaded from.
+
+  Returns:
+    A list of ImageMetadata with tokenized captions.
+  """
+  print("Processing captions.")
+  tokenized = _get_tokenizer().tokenize_all(
+      [c for image in image_metadata for c in image.captions],
+      num_processes=FLAGS.num_processes or FLAGS.num_threads)
+  processed_metadata = []
+  num_captions = 0
+  for image in image_metadata:
+    captions = tokenized[num_captions:num_captions + len(image.captions)]
+    processed_metadata.append(
+        ImageMetadata(image.image_id, image.filename, captions))
     num_captions += len(captions)
   print("Finished processing %d captions for %d images in %s and %s" %
-        (num_captions, len(id_to_filename), captions_dir, image_dir))
+        (num_captions, len(image_metadata), captions_dir, image_dir))
+  return processed_metadata
 
-  return image_metadata
+
+def _load_and_process_metadata_craigcap(captions_dir, image_dir):
+  """Loads image metadata from a directory containing CSV files and processes the captions.
+
+  Args:
+    captions_dir: Directory containing CSV files for each city containing caption annotations.
+    image_dir: Directory containing subdirecties for each city with image files.
+
+  Returns:
+    A list of ImageMetadata.
+  """
+  return _process_metadata_captions(
+      _load_metadata_craigcap(captions_dir, image_dir), captions_dir, image_dir)
+
+
+def _hash_image(filename):
+  """Hashes an image file in a worker process of _hash_images().
+
+  Returns:
+    A tuple (filename, sha1, dhash), where sha1 is the hex digest of the file
+    or None if it cannot be read, and dhash is the difference hash of the image
+    or None if it cannot be decoded.
+  """
+  try:
+    with tf.gfile.FastGFile(filename, "rb") as f:
+      encoded_image = f.read()
+  except tf.errors.OpError:
+    return filename, None, None
+  sha1 = hashlib.sha1(encoded_image).hexdigest()
+  try:
+    dhash = _worker_state["decoder"].dhash(encoded_image)
+  except tf.errors.InvalidArgumentError:
+    dhash = None
+  return filename, sha1, dhash
+
+
+def _init_hash_worker():
+  """Initializes a worker process of _hash_images()."""
+  _worker_state["decoder"] = ImageDecoder()
+
+
+def _hash_images(filenames, index_file, num_processes):
+  """Computes the hashes of image files in a pool of worker processes.
+
+  Hashes of files whose size and modification time match the index are
+  reused, and the index is rewritten with the hashes of all filenames.
+
+  Args:
+    filenames: List of image files.
+    index_file: JSON file of hashes from previous builds.
+    num_processes: Number of worker processes.
+
+  Returns:
+    A dict of filename to a tuple (sha1, dhash) as returned by _hash_image().
+  """
+  index = {}
+  if tf.gfile.Exists(index_file):
+    with tf.gfile.FastGFile(index_file, "r") as f:
+      index = json.load(f)
+
+  hashes = {}
+  new_index = {}
+  to_hash = []
+  for filename in filenames:
+    try:
+      st = os.stat(filename)
+    except OSError:
+      hashes[filename] = (None, None)
+      continue
+    entry = index.get(filename)
+    if entry is not None and entry[:2] == [st.st_size, st.st_mtime]:
+      hashes[filename] = (entry[2], entry[3])
+      new_index[filename] = entry
+    else:
+      to_hash.append((filename, st))
+  print("%s: Hashing %d images; reusing the hashes of %d." %
+        (datetime.now(), len(to_hash), len(new_index)))
+  sys.stdout.flush()
+
+  if to_hash:
+    stats = dict(to_hash)
+    pool = multiprocessing.Pool(num_processes, initializer=_init_hash_worker)
+    try:
+      for i, (filename, sha1, dhash) in enumerate(pool.imap_unordered(
+          _hash_image, [f for f, _ in to_hash], chunksize=64)):
+        hashes[filename] = (sha1, dhash)
+        if sha1 is not None:
+          st = stats[filename]
+          new_index[filename] = [st.st_size, st.st_mtime, sha1, dhash]
+        if not (i + 1) % 10000:
+          print("%s: Hashed %d of %d images." %
+                (datetime.now(), i + 1, len(to_hash)))
+          sys.stdout.flush()
+      pool.close()
+      pool.join()
+    finally:
+      pool.terminate()
+
+  with tf.gfile.FastGFile(index_file + ".tmp", "w") as f:
+    json.dump(new_index, f)
+  tf.gfile.Rename(index_file + ".tmp", index_file, overwrite=True)
+  return hashes
+
+
+def _band_keys(dhash, num_bands):
+  """Returns the bucket keys of a difference hash split into num_bands bands.
+
+  Two hashes within num_bands - 1 bits agree on at least one band, so near
+  duplicates can be found among the hashes sharing a bucket.
+  """
+  keys = []
+  for band in range(num_bands):
+    lo = band * 64 // num_bands
+    hi = (band + 1) * 64 // num_bands
+    keys.append((band, (dhash >> lo) & ((1 << (hi - lo)) - 1)))
+  return keys
+
+
+def _duplicate_groups(image_metadata, index_file, max_distance, num_processes):
+  """Groups images with identical or nearly identical content.
+
+  Images are duplicates if their files are byte identical or, if max_distance
+  is not negative, their difference hashes are within max_distance bits of the
+  hash of the first image of a group. Groups are formed in the order of
+  image_metadata: an image joins the earliest group it is a duplicate of, and
+  otherwise starts a new one. Unlike a transitive closure, this cannot chain
+  unrelated images together through a series of near duplicates.
+
+  Args:
+    image_metadata: A list of ImageMetadata.
+    index_file: JSON file of image hashes, see _hash_images().
+    max_distance: Maximum Hamming distance of near duplicate hashes.
+    num_processes: Number of worker processes hashing images.
+
+  Returns:
+    A list with the increasing indices into image_metadata of each group,
+    sorted by their first index.
+  """
+  hashes = _hash_images([image.filename for image in image_metadata],
+                        index_file, num_processes)
+  num_bands = max_distance + 1
+  groups = []
+  group_with_sha1 = {}
+  group_dhashes = {}
+  groups_in_bucket = {}
+  for i, image in enumerate(image_metadata):
+    sha1, dhash = hashes[image.filename]
+    group = group_with_sha1.get(sha1) if sha1 is not None else None
+    if group is None and dhash is not None and max_distance >= 0:
+      candidates = set()
+      for key in _band_keys(dhash, num_bands):
+        candidates.update(groups_in_bucket.get(key, []))
+      near = [g for g in candidates
+              if bin(group_dhashes[g] ^ dhash).count("1") <= max_distance]
+      if near:
+        group = min(near)
+    if group is None:
+      group = len(groups)
+      groups.append([])
+      if dhash is not None and max_distance >= 0:
+        group_dhashes[group] = dhash
+        for key in _band_keys(dhash, num_bands):
+          groups_in_bucket.setdefault(key, []).append(group)
+    groups[group].append(i)
+    if sha1 is not None:
+      group_with_sha1.setdefault(sha1, group)
+  return groups
+
+
+def _merge_duplicates(images):
+  """Returns the first of images with the distinct captions of all of them."""
+  captions = []
+  for image in images:
+    for caption in image.captions:
+      if caption not in captions:
+        captions.append(caption)
+  return ImageMetadata(images[0].image_id, images[0].filename, captions)
+
+
+def _print_duplicate_groups(image_metadata, groups):
+  """Prints the number and sizes of the groups of duplicate images."""
+  num_removed = 0
+  bytes_removed = 0
+  group_sizes = Counter()
+  for group in groups:
+    if len(group) > 1:
+      group_sizes[len(group)] += 1
+    for j in group[1:]:
+      num_removed += 1
+      bytes_removed += os.path.getsize(image_metadata[j].filename)
+  print("Removed %d duplicate images (%.1f MB) in %d groups; %d of %d images "
+        "remain." % (num_removed, bytes_removed / 1e6, sum(group_sizes.values()),
+                     len(groups), len(image_metadata)))
+  if group_sizes:
+    print("Duplicate group sizes: %s" % ", ".join(
+        "%d images: %d" % (size, count)
+        for size, count in sorted(group_sizes.items())))
+
+
+def _dedupe_images(image_metadata, index_file, max_distance, num_processes):
+  """Merges images with identical or nearly identical content.
+
+  Each group of duplicates found by _duplicate_groups() becomes the first of
+  its images with the captions of all of them.
+
+  Args:
+    image_metadata: A list of ImageMetadata with untokenized captions.
+    index_file: JSON file of image hashes, see _hash_images().
+    max_distance: Maximum Hamming distance of near duplicate hashes.
+    num_processes: Number of worker processes hashing images.
+
+  Returns:
+    deduped: A list of ImageMetadata.
+    duplicates: A dict of the filename of each image in deduped to the list
+      of ImageMetadata merged into it.
+  """
+  groups = _duplicate_groups(image_metadata, index_file, max_distance,
+                             num_processes)
+  _print_duplicate_groups(image_metadata, groups)
+  deduped = []
+  duplicates = {}
+  for group in groups:
+    images = [image_metadata[j] for j in group]
+    deduped.append(_merge_duplicates(images))
+    duplicates[images[0].filename] = images[1:]
+  return deduped, duplicates
+
+
+def _dedupe_images_incremental(image_metadata, manifest, index_file,
+                               max_distance, num_processes):
+  """Merges duplicate images without changing the groups of a previous build.
+
+  The images of the manifest keep the duplicates the manifest lists for them,
+  so their captions and content hashes only change if their files do. New
+  images are grouped with _duplicate_groups() after them. New images that
+  duplicate an image of the previous build cannot be merged into its existing
+  records, so they are dropped until the next full build.
+
+  Args:
+    image_metadata: A list of ImageMetadata with untokenized captions.
+    manifest: The manifest of the previous build, see _load_manifest().
+    index_file: JSON file of image hashes, see _hash_images().
+    max_distance: Maximum Hamming distance of near duplicate hashes.
+    num_processes: Number of worker processes hashing images.
+
+  Returns:
+    deduped: A list of ImageMetadata, in the order of image_metadata.
+    duplicates: A dict of the filename of each image in deduped to the list
+      of ImageMetadata merged into it.
+  """
+  image_dir = FLAGS.craigcap_image_dir
+  position = {}
+  by_key = {}
+  for i, image in enumerate(image_metadata):
+    position[image.filename] = i
+    by_key[_manifest_key(image, image_dir)] = image
+  previous_duplicates = set(
+      key for entry in manifest.values() for key in entry.get("duplicates", []))
+  previous = []
+  new = []
+  for image in image_metadata:
+    key = _manifest_key(image, image_dir)
+    if key in manifest:
+      previous.append(image)
+    elif key not in previous_duplicates:
+      new.append(image)
+
+  groups = _duplicate_groups(previous + new, index_file, max_distance,
+                             num_processes)
+  deduped = []
+  duplicates = {}
+  num_dropped = 0
+  for group in groups:
+    for j in group:
+      if j < len(previous):
+        image = previous[j]
+        members = [by_key[key] for key in
+                   manifest[_manifest_key(image, image_dir)].get(
+                       "duplicates", []) if key in by_key]
+        deduped.append(_merge_duplicates([image] + members))
+        duplicates[image.filename] = members
+    new_members = [new[j - len(previous)] for j in group
+                   if j >= len(previous)]
+    if group[0] < len(previous):
+      num_dropped += len(new_members)
+    elif new_members:
+      deduped.append(_merge_duplicates(new_members))
+      duplicates[new_members[0].filename] = new_members[1:]
+  deduped.sort(key=lambda image: position[image.filename])
+  print("Merged %d new images into %d; dropped %d new images that duplicate "
+        "images of the previous build until the next full build." %
+        (len(new) - num_dropped,
+         len(deduped) - len(previous), num_dropped))
+  return deduped, duplicates
+
+
+def _load_raw_metadata(manifest=None):
+  """Loads the untokenized image metadata given by the flags.
+
+  Args:
+    manifest: Manifest of a previous build whose duplicate groups are kept in
+      an incremental build, or None.
+
+  Returns:
+    raw_dataset: A list of ImageMetadata, deduplicated by content if
+      FLAGS.dedupe_images.
+    duplicates: A dict of the filename of each image in raw_dataset to the
+      list of ImageMetadata merged into it.
+  """
+  raw_dataset = _load_metadata_craigcap(FLAGS.craigcap_captions_dir,
+                                        FLAGS.craigcap_image_dir)
+  if not FLAGS.dedupe_images:
+    return raw_dataset, {}
+  index_file = (FLAGS.image_hash_index_file or
+                os.path.join(FLAGS.output_dir, "image_hashes.json"))
+  num_processes = FLAGS.num_processes or FLAGS.num_threads
+  if manifest is None:
+    return _dedupe_images(raw_dataset, index_file,
+                          FLAGS.near_duplicate_distance, num_processes)
+  return _dedupe_images_incremental(raw_dataset, manifest, index_file,
+                                    FLAGS.near_duplicate_distance,
+                                    num_processes)
+
+
+def _manifest_key(image, image_dir):
+  """Returns the manifest key of an image, e.g. 'erie/00000_3GL6XnTmyaG'."""
+  return os.path.splitext(os.path.relpath(image.filename, image_dir))[0]
+
+
+def _duplicate_keys(duplicates, image):
+  """Returns the manifest keys of the images merged into an image."""
+  return [_manifest_key(duplicate, FLAGS.craigcap_image_dir)
+          for duplicate in duplicates.get(image.filename, [])]
+
+
+def _content_hash(image):
+  """Returns a hash of the image file and the untokenized captions of an image.
+
+  Unreadable images hash to their captions only, so they are retried when
+  they appear.
+  """
+  h = hashlib.sha1()
+  try:
+    with tf.gfile.FastGFile(image.filename, "rb") as f:
+      h.update(f.read())
+  except tf.errors.OpError:
+    pass
+  for caption in image.captions:
+    h.update(b"\0")
+    h.update(caption.encode("utf-8"))
+  return h.hexdigest()
+
+
+def _load_manifest(manifest_file):
+  """Loads a manifest written by _write_manifest().
+
+  Returns:
+    A dict of manifest key to a dict with the "hash" of the image contents, the
+    "split" it went to, the names of the "shards" with its image-caption pairs
+    and the manifest keys of the "duplicates" merged into it by
+    --dedupe_images.
+  """
+  with tf.gfile.FastGFile(manifest_file, "r") as f:
+    return json.load(f)["images"]
+
+
+def _write_manifest(manifest_file, manifest):
+  """Writes a manifest of processed images."""
+  with tf.gfile.FastGFile(manifest_file + ".tmp", "w") as f:
+    json.dump({"images": manifest}, f, sort_keys=True)
+  tf.gfile.Rename(manifest_file + ".tmp", manifest_file, overwrite=True)
+  print("Wrote manifest of %d images to %s" % (len(manifest), manifest_file))
+
+
+def _num_incremental_shards(num_shards, num_new, num_existing):
+  """Returns the number of shards for new images of a split.
+
+  The shards get about as many images as those of a full build, and the count
+  is a valid number of shards for FLAGS.num_threads.
+  """
+  num_total = max(num_new + num_existing, 1)
+  n = max(1, int(round(num_shards * num_new / num_total)))
+  if n >= FLAGS.num_threads:
+    n -= n % FLAGS.num_threads
+  return n
+
+
+def _read_city_metadata(args):
+  """Reads the metadata of one city in a single pass over its CSV file.
+
+  Args:
+    args: A tuple (captions_dir, image_dir, city).
+
+  Returns:
+    A list of ImageMetadata with untokenized captions, in the order the image
+    ids first appear in the file.
+  """
+  captions_dir, image_dir, city = args
+  id_to_captions = {}
+  image_ids = []
+  with tf.gfile.FastGFile(os.path.join(captions_dir, city + ".csv"), "r") as f:
+    for row in csv.reader(f):
+      image_id = row[2]
+      if image_id == "":
+        continue
+      if image_id not in id_to_captions:
+        id_to_captions[image_id] = []
+        image_ids.append(image_id)
+      id_to_captions[image_id].append(row[1])
+  return [ImageMetadata(image_id,
+                        os.path.join(image_dir, city, image_id + ".jpg"),
+                        id_to_captions[image_id])
+          for image_id in image_ids]
+
+
+def _iter_metadata_craigcap(captions_dir, image_dir, num_processes,
+                            max_tracked_ids=0):
+  """Yields image metadata city by city, reading CSV files in parallel.
+
+  Only the cities with an image subdirectory are read, in sorted order. Unlike
+  _load_metadata_craigcap(), which returns each image id once with the
+  captions of all cities, an image id that appears in several cities is
+  yielded once per city with the captions of that city. The first city of the
+  max_tracked_ids most recently seen ids is remembered, and a repeat of a
+  tracked id has the image file of that city, so all of its captions are kept
+  for the same image. Other repeats have the image file of their own city.
+  At most 2 * num_processes cities and max_tracked_ids ids are held in memory
+  at a time.
+
+  Args:
+    captions_dir: Directory containing CSV files for each city.
+    image_dir: Directory containing subdirecties for each city with image files.
+    num_processes: Number of worker processes reading CSV files.
+    max_tracked_ids: Number of image ids whose first city is remembered, or 0
+      to yield every image with the image file of its own city.
+
+  Yields:
+    ImageMetadata with untokenized captions.
+  """
+  cities = sorted(city for city in os.listdir(image_dir)
+                  if city != "summarycsv")
+  tasks = deque((captions_dir, image_dir, city) for city in cities)
+  # Recently seen image ids to the image file of the first city they appear
+  # in, least recently seen first.
+  id_to_filename = OrderedDict()
+  num_images = 0
+  num_repeated_ids = 0
+  num_repeated_captions = 0
+  pool = multiprocessing.Pool(num_processes)
+  try:
+    pending = deque()
+    while tasks or pending:
+      while tasks and len(pending) < 2 * num_processes:
+        pending.append(
+            pool.apply_async(_read_city_metadata, (tasks.popleft(),)))
+      for image in pending.popleft().get():
+        num_images += 1
+        if max_tracked_ids > 0:
+          filename = id_to_filename.pop(image.image_id, image.filename)
+          id_to_filename[image.image_id] = filename
+          if len(id_to_filename) > max_tracked_ids:
+            id_to_filename.popitem(last=False)
+          if filename != image.filename:
+            num_repeated_ids += 1
+            num_repeated_captions += len(image.captions)
+            image = ImageMetadata(image.image_id, filename, image.captions)
+        yield image
+    pool.close()
+    pool.join()
+  finally:
+    # Also runs when the consumer stops iterating early.
+    pool.terminate()
+  print("Read %d images from %d cities; %d captions of %d repeats of an id "
+        "in a later city were kept with its first image." %
+        (num_images, len(cities), num_repeated_captions, num_repeated_ids))
+
+
+def _stable_hash(seed, key):
+  """Returns a hash of a string that is the same in every process and run."""
+  return int(hashlib.md5(("%d:%s" % (seed, key)).encode("utf-8")).hexdigest(),
+             16)
+
+
+def _streaming_split(image_id):
+  """Assigns an image to "train" (80%), "val" (10%) or "test" (10%)."""
+  bucket = _stable_hash(FLAGS.seed, image_id) % 10
+  if bucket < 8:
+    return "train"
+  return "val" if bucket == 8 else "test"
+
+
+def _init_serialize_worker(vocab, image_storage):
+  """Initializes a worker process of _main_streaming()."""
+  _worker_state["vocab"] = vocab
+  _worker_state["image_storage"] = image_storage
+  _worker_state["decoder"] = ImageDecoder(
+      image_storage.jpeg_quality if image_storage else 95)
+
+
+def _serialize_example(task):
+  """Tokenizes and serializes an image-caption pair in a worker process.
+
+  Args:
+    task: A tuple (split, shard, image), where image is an ImageMetadata with
+      one untokenized caption.
+
+  Returns:
+    A tuple (split, shard, serialized), where serialized is the serialized
+    SequenceExample or None if the image is invalid.
+  """
+  split, shard, image = task
+  image = ImageMetadata(image.image_id, image.filename,
+                        [_process_caption(image.captions[0])])
+  sequence_example = _to_sequence_example(image, _worker_state["decoder"],
+                                          _worker_state["vocab"],
+                                          _worker_state["image_storage"])
+  if sequence_example is None:
+    return split, shard, None
+  return split, shard, sequence_example.SerializeToString()
+
+
+def _main_streaming():
+  """Builds the data set without holding its metadata in memory.
+
+  The city CSV files are read twice: once to create the vocabulary from the
+  training captions, and once to write the shards. The caption ids of a record
+  need the whole vocabulary, and reading the CSV text again is cheaper than
+  writing records with word strings and rewriting them with their image data.
+  The vocabulary pass does not track repeated image ids, which only change
+  image files, not captions or splits. Each image goes to the
+  split given by a hash of its image id and each of its image-caption pairs to
+  a shard given by a hash of the pair, so a split and a shard never depend on
+  the other items. The records of each shard pass through a shuffle buffer of
+  FLAGS.streaming_shuffle_buffer_size records, so they are only approximately
+  in city order.
+  """
+  assert not FLAGS.dedupe_images, "--streaming does not support --dedupe_images"
+  num_processes = FLAGS.num_processes or FLAGS.num_threads
+  captions_dir = FLAGS.craigcap_captions_dir
+  image_dir = FLAGS.craigcap_image_dir
+
+  vocab = _create_vocab(
+      _process_caption(c)
+      for image in _iter_metadata_craigcap(captions_dir, image_dir,
+                                           num_processes)
+      if _streaming_split(image.image_id) == "train"
+      for c in image.captions)
+
+  num_shards = {"train": FLAGS.train_shards, "val": FLAGS.val_shards,
+                "test": FLAGS.test_shards}
+  writers = {}
+  buffers = {}
+  counts = Counter()
+  rng = random.Random(FLAGS.seed)
+  buffer_size = max(FLAGS.streaming_shuffle_buffer_size, 1)
+
+  def _write(results):
+    for split, shard, serialized in results:
+      if serialized is None:
+        continue
+      key = (split, shard)
+      if key not in writers:
+        writers[key] = tf.python_io.TFRecordWriter(
+            _shard_filename(FLAGS.output_dir, split, shard, num_shards[split]))
+        buffers[key] = []
+      counts[split] += 1
+      # Writes a random buffered record once the shard's buffer is full.
+      buffer = buffers[key]
+      if len(buffer) < buffer_size:
+        buffer.append(serialized)
+        continue
+      i = rng.randrange(buffer_size)
+      writers[key].write(buffer[i])
+      buffer[i] = serialized
+
+  pool = multiprocessing.Pool(num_processes,
+                              initializer=_init_serialize_worker,
+                              initargs=(vocab, _image_storage()))
+  try:
+    batch = []
+    for image in _iter_metadata_craigcap(captions_dir, image_dir,
+                                         num_processes,
+                                         FLAGS.streaming_max_tracked_ids):
+      split = _streaming_split(image.image_id)
+      for i, caption in enumerate(image.captions):
+        shard = (_stable_hash(FLAGS.seed, "%s/%d" % (image.image_id, i)) %
+                 num_shards[split])
+        batch.append(
+            (split, shard, ImageMetadata(image.image_id, image.filename,
+                                         [caption])))
+      if len(batch) >= FLAGS.streaming_batch_size:
+        _write(pool.map(_serialize_example, batch, chunksize=16))
+        batch = []
+        print("%s: Wrote %d train, %d val and %d test image-caption pairs." %
+              (datetime.now(), counts["train"], counts["val"], counts["test"]))
+        sys.stdout.flush()
+    _write(pool.map(_serialize_example, batch, chunksize=16))
+    pool.close()
+    pool.join()
+    for key in sorted(buffers):
+      rng.shuffle(buffers[key])
+      for serialized in buffers[key]:
+        writers[key].write(serialized)
+  finally:
+    pool.terminate()
+    for writer in writers.values():
+      writer.close()
+
+  # Write the shards that received no records, so every split has all of its
+  # shards.
+  for split in num_shards:
+    for shard in range(num_shards[split]):
+      if (split, shard) not in writers:
+        tf.python_io.TFRecordWriter(_shard_filename(
+            FLAGS.output_dir, split, shard, num_shards[split])).close()
+  print("%s: Finished writing %d train, %d val and %d test image-caption "
+        "pairs." % (datetime.now(), counts["train"], counts["val"],
+                    counts["test"]))
 
 
 def printFlags():
@@ -529,9 +1602,22 @@ def main(unused_argv):
   if not tf.gfile.IsDirectory(FLAGS.output_dir):
     tf.gfile.MakeDirs(FLAGS.output_dir)
 
+  manifest_file = (FLAGS.manifest_file or
+                   os.path.join(FLAGS.output_dir, "manifest.json"))
+  if FLAGS.incremental and FLAGS.streaming:
+    raise ValueError("--incremental does not support --streaming")
+  if FLAGS.incremental:
+    _main_incremental(manifest_file)
+    return
+  if FLAGS.streaming:
+    _main_streaming()
+    return
+
   # Load image metadata from caption files.
 
-  craigcap_dataset = _load_and_process_metadata_craigcap(FLAGS.craigcap_captions_dir, FLAGS.craigcap_image_dir)
+  raw_dataset, duplicates = _load_raw_metadata()
+  craigcap_dataset = _process_metadata_captions(
+      raw_dataset, FLAGS.craigcap_captions_dir, FLAGS.craigcap_image_dir)
   
 
   # Redistribute the craigcap data as follows:
@@ -548,9 +1634,109 @@ def main(unused_argv):
   train_captions = [c for image in train_dataset for c in image.captions]
   vocab = _create_vocab(train_captions)
 
-  _process_dataset("train", train_dataset, vocab, FLAGS.train_shards)
-  _process_dataset("val", val_dataset, vocab, FLAGS.val_shards)
-  _process_dataset("test", test_dataset, vocab, FLAGS.test_shards)
+  filename_to_shards = {}
+  filename_to_split = {}
+  for name, dataset, num_shards in [("train", train_dataset, FLAGS.train_shards),
+                                    ("val", val_dataset, FLAGS.val_shards),
+                                    ("test", test_dataset, FLAGS.test_shards)]:
+    filename_to_shards.update(_process_dataset(name, dataset, vocab,
+                                               num_shards))
+    filename_to_split.update((image.filename, name) for image in dataset)
+
+  manifest = {}
+  for image in raw_dataset:
+    manifest[_manifest_key(image, FLAGS.craigcap_image_dir)] = {
+        "hash": _content_hash(image),
+        "split": filename_to_split[image.filename],
+        "shards": filename_to_shards.get(image.filename, []),
+        "duplicates": _duplicate_keys(duplicates, image),
+    }
+  _write_manifest(manifest_file, manifest)
+
+
+def _main_incremental(manifest_file):
+  """Appends new images to the shards of a previous build.
+
+  Images whose manifest key and content hash are already in the manifest are
+  skipped before their captions are tokenized. New images are split 80/10/10
+  like a full build and written to new shards named after the build time, e.g.
+  out/train-20170101120000-00000-of-00002, so training should read "train-*".
+  Images in the manifest that no records were written for, e.g. because they
+  were unreadable, are retried in the split they were assigned to. Images whose
+  records were written and that have changed since cannot be replaced without
+  rewriting the shards holding their old records, so they require a full
+  build. With --dedupe_images, the duplicate groups of the previous build are
+  kept, see _dedupe_images_incremental(). The vocabulary of the previous build
+  is reused; run a full build to recompute it.
+
+  Args:
+    manifest_file: Manifest of the previous build, updated in place.
+
+  Raises:
+    ValueError: If images with records in the previous build have changed.
+  """
+  manifest = _load_manifest(manifest_file)
+  vocab = _load_vocab(FLAGS.word_counts_output_file)
+
+  new_images = []
+  retried_images = []
+  changed_keys = []
+  hashes = {}
+  raw_dataset, duplicates = _load_raw_metadata(manifest)
+  for image in raw_dataset:
+    key = _manifest_key(image, FLAGS.craigcap_image_dir)
+    hashes[image.filename] = _content_hash(image)
+    if key not in manifest:
+      new_images.append(image)
+    elif manifest[key]["hash"] != hashes[image.filename]:
+      if manifest[key]["shards"]:
+        changed_keys.append(key)
+      else:
+        retried_images.append(image)
+  if changed_keys:
+    raise ValueError(
+        "%d images with records in the previous build have changed, e.g. %s. "
+        "Their old records cannot be removed incrementally; run a full build "
+        "without --incremental." % (len(changed_keys), changed_keys[0]))
+  print("Found %d new images and %d images to retry; %d are in the manifest." %
+        (len(new_images), len(retried_images), len(manifest)))
+  if not new_images and not retried_images:
+    return
+  craigcap_dataset = _process_metadata_captions(
+      new_images + retried_images, FLAGS.craigcap_captions_dir,
+      FLAGS.craigcap_image_dir)
+  new_dataset = craigcap_dataset[:len(new_images)]
+  retried_dataset = craigcap_dataset[len(new_images):]
+
+  train_cutoff = int(0.8 * len(new_dataset))
+  val_cutoff = int(0.9 * len(new_dataset))
+  datasets = {"train": new_dataset[0:train_cutoff],
+              "val": new_dataset[train_cutoff:val_cutoff],
+              "test": new_dataset[val_cutoff:]}
+  # Retried images keep their split, so an image never moves between splits.
+  for image in retried_dataset:
+    key = _manifest_key(image, FLAGS.craigcap_image_dir)
+    datasets[manifest[key]["split"]].append(image)
+
+  build = datetime.now().strftime("%Y%m%d%H%M%S")
+  for name, num_shards in [("train", FLAGS.train_shards),
+                           ("val", FLAGS.val_shards),
+                           ("test", FLAGS.test_shards)]:
+    dataset = datasets[name]
+    if not dataset:
+      continue
+    num_existing = sum(1 for v in manifest.values() if v["split"] == name)
+    filename_to_shards = _process_dataset(
+        "%s-%s" % (name, build), dataset, vocab,
+        _num_incremental_shards(num_shards, len(dataset), num_existing))
+    for image in dataset:
+      manifest[_manifest_key(image, FLAGS.craigcap_image_dir)] = {
+          "hash": hashes[image.filename],
+          "split": name,
+          "shards": filename_to_shards.get(image.filename, []),
+          "duplicates": _duplicate_keys(duplicates, image),
+      }
+  _write_manifest(manifest_file, manifest)
 
 
 if __name__ == "__main__":
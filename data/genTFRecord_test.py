@@ -0,0 +1,215 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests for genTFRecord."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import struct
+
+
+import tensorflow as tf
+
+import genTFRecord
+
+
+def _segment(marker, payload):
+  """Returns a JPEG marker segment with a length field."""
+  return struct.pack(">BBH", 0xFF, marker, len(payload) + 2) + payload
+
+
+def _jpeg(sof_marker=0xC0, precision=8, height=48, width=64, num_components=3,
+          end_of_image=True):
+  """Returns the markers of a JPEG image with a few bytes of scan data."""
+  frame = struct.pack(">BHHB", precision, height, width, num_components)
+  for component in range(num_components):
+    frame += struct.pack(">BBB", component + 1, 0x11, 0)
+  data = b"\xff\xd8"
+  data += _segment(0xE0, b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00")
+  data += _segment(sof_marker, frame)
+  data += _segment(0xDA, b"\x01\x01\x00\x00\x3f\x00")
+  data += b"\x12\x34\xff\x00\x56"
+  if end_of_image:
+    data += b"\xff\xd9"
+  return data
+
+
+class FakeDecoder(object):
+  """Fake ImageDecoder that records the images decoded in full."""
+
+  def __init__(self):
+    self.decoded = []
+
+  def decode_jpeg(self, encoded_jpeg):
+    self.decoded.append(encoded_jpeg)
+
+
+class ParseJpegHeaderTest(tf.test.TestCase):
+
+  def testBaseline(self):
+    self.assertEqual((48, 64, 3), genTFRecord._parse_jpeg_header(_jpeg()))  # pylint: disable=protected-access
+
+  def testProgressive(self):
+    self.assertEqual((48, 64, 1),
+                     genTFRecord._parse_jpeg_header(  # pylint: disable=protected-access
+                         _jpeg(sof_marker=0xC2, num_components=1)))
+
+  def testCmyk(self):
+    self.assertEqual((48, 64, 4),
+                     genTFRecord._parse_jpeg_header(_jpeg(num_components=4)))  # pylint: disable=protected-access
+
+  def testTruncated(self):
+    data = _jpeg()
+    sof = data.index(b"\xff\xc0")
+    for size in [0, 1, 2, 5, sof + 4, sof + 8]:
+      self.assertIsNone(genTFRecord._parse_jpeg_header(data[:size]),  # pylint: disable=protected-access
+                        msg=size)
+
+  def testUnsupportedFrames(self):
+    # 12-bit precision, lossless (SOF3) and arithmetic coded (SOF9) frames.
+    for data in [_jpeg(precision=12), _jpeg(sof_marker=0xC3),
+                 _jpeg(sof_marker=0xC9)]:
+      self.assertIsNone(genTFRecord._parse_jpeg_header(data))  # pylint: disable=protected-access
+
+  def testNotJpeg(self):
+    self.assertIsNone(genTFRecord._parse_jpeg_header(b"\x89PNG\r\n\x1a\n"))  # pylint: disable=protected-access
+
+
+class ValidateJpegTest(tf.test.TestCase):
+
+  def _decoded(self, encoded_jpeg):
+    """Returns whether _validate_jpeg decodes encoded_jpeg in full."""
+    decoder = FakeDecoder()
+    genTFRecord._validate_jpeg(encoded_jpeg, decoder)  # pylint: disable=protected-access
+    return bool(decoder.decoded)
+
+  def testWellFormedImagesAreNotDecoded(self):
+    self.assertFalse(self._decoded(_jpeg()))
+    self.assertFalse(self._decoded(_jpeg(sof_marker=0xC2)))
+    self.assertFalse(self._decoded(_jpeg(num_components=1)))
+
+  def testOtherImagesAreDecoded(self):
+    self.assertTrue(self._decoded(_jpeg(num_components=4)))
+    self.assertTrue(self._decoded(_jpeg(end_of_image=False)))
+    self.assertTrue(self._decoded(_jpeg(precision=12)))
+    self.assertTrue(self._decoded(_jpeg(sof_marker=0xC3)))
+    self.assertTrue(self._decoded(_jpeg()[:20]))
+
+
+class ToSequenceExampleTest(tf.test.TestCase):
+
+  def testParseSerializedExample(self):
+    encoded_image = _jpeg()
+    filename = os.path.join(self.get_temp_dir(), "a.jpg")
+    with open(filename, "wb") as f:
+      f.write(encoded_image)
+    image = genTFRecord.ImageMetadata(
+        "a.jpg", filename, [["<S>", "a", u"caf\u00e9", "</S>"]])
+    vocab = genTFRecord.Vocabulary({"<S>": 0, "</S>": 1, "a": 2}, unk_id=3)
+    sequence_example = genTFRecord._to_sequence_example(  # pylint: disable=protected-access
+        image, FakeDecoder(), vocab)
+
+    context, sequence = tf.parse_single_sequence_example(
+        sequence_example.SerializeToString(),
+        context_features={
+            "image/image_id": tf.FixedLenFeature([], dtype=tf.string),
+            "image/data": tf.FixedLenFeature([], dtype=tf.string),
+        },
+        sequence_features={
+            "image/caption": tf.FixedLenSequenceFeature([], dtype=tf.string),
+            "image/caption_ids": tf.FixedLenSequenceFeature([],
+                                                            dtype=tf.int64),
+        })
+    with self.test_session() as sess:
+      context, sequence = sess.run([context, sequence])
+    self.assertEqual(b"a.jpg", context["image/image_id"])
+    self.assertEqual(encoded_image, context["image/data"])
+    self.assertAllEqual([b"<S>", b"a", u"caf\u00e9".encode("utf-8"), b"</S>"],
+                        sequence["image/caption"])
+    self.assertAllEqual([0, 2, 3, 1], sequence["image/caption_ids"])
+
+
+class IterMetadataCraigcapTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(IterMetadataCraigcapTest, self).setUp()
+    self._captions_dir = os.path.join(self.get_temp_dir(), "captions")
+    self._image_dir = os.path.join(self.get_temp_dir(), "images")
+    os.makedirs(self._captions_dir)
+    # Rows of (index, caption, image id) of each city.
+    cities = {"a": [("0", "a x", "x"), ("1", "a y", "y")],
+              "b": [("0", "b y", "y"), ("1", "b x", "x")]}
+    for city, rows in cities.items():
+      os.makedirs(os.path.join(self._image_dir, city))
+      with open(os.path.join(self._captions_dir, city + ".csv"), "w") as f:
+        f.write("".join("%s,%s,%s\n" % row for row in rows))
+
+  def _images(self, max_tracked_ids):
+    """Returns (image id, city, captions) of each yielded image."""
+    images = genTFRecord._iter_metadata_craigcap(  # pylint: disable=protected-access
+        self._captions_dir, self._image_dir, 1, max_tracked_ids)
+    return [(image.image_id,
+             os.path.basename(os.path.dirname(image.filename)),
+             image.captions) for image in images]
+
+  def testRepeatsKeepTheImageOfTheFirstCity(self):
+    self.assertEqual([("x", "a", ["a x"]), ("y", "a", ["a y"]),
+                      ("y", "a", ["b y"]), ("x", "a", ["b x"])],
+                     self._images(2))
+
+  def testRepeatsOfUntrackedIdsKeepTheirImage(self):
+    # Only the most recently seen id is tracked.
+    self.assertEqual([("x", "a", ["a x"]), ("y", "a", ["a y"]),
+                      ("y", "a", ["b y"]), ("x", "b", ["b x"])],
+                     self._images(1))
+    self.assertEqual([("x", "a", ["a x"]), ("y", "a", ["a y"]),
+                      ("y", "b", ["b y"]), ("x", "b", ["b x"])],
+                     self._images(0))
+
+
+class DuplicateGroupsTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(DuplicateGroupsTest, self).setUp()
+    # Filename to (sha1, dhash).
+    self._hashes = {}
+    self._hash_images = genTFRecord._hash_images  # pylint: disable=protected-access
+    genTFRecord._hash_images = (  # pylint: disable=protected-access
+        lambda filenames, index_file, num_processes: self._hashes)
+
+  def tearDown(self):
+    genTFRecord._hash_images = self._hash_images  # pylint: disable=protected-access
+    super(DuplicateGroupsTest, self).tearDown()
+
+  def _image(self, name, sha1, dhash):
+    filename = "/img/%s.jpg" % name
+    self._hashes[filename] = (sha1, dhash)
+    return genTFRecord.ImageMetadata(name, filename, [name])
+
+  def testNearDuplicatesDoNotChain(self):
+    # b is within 2 bits of a, and c within 2 bits of b but not of a.
+    images = [self._image("a", "1", 0b0000), self._image("b", "2", 0b0011),
+              self._image("c", "3", 0b1111), self._image("d", "1", 0b0000),
+              self._image("e", None, None)]
+    self.assertEqual([[0, 1, 3], [2], [4]],
+                     genTFRecord._duplicate_groups(images, None, 2, 1))  # pylint: disable=protected-access
+    self.assertEqual([[0, 3], [1], [2], [4]],
+                     genTFRecord._duplicate_groups(images, None, -1, 1))  # pylint: disable=protected-access
+
+
+if __name__ == "__main__":
+  tf.test.main()
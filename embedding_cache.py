@@ -0,0 +1,282 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Persistent cache of initial model states keyed by encoded image content.
+
+The cache directory contains three files:
+
+  config.json: The state size of the cached vectors and the identity of the
+    model that computed them (see model_identity()).
+  index.txt: The SHA-1 hex digest of one encoded image per line. The line
+    number is the row of the image's state in states.f32.
+  states.f32: A float32 matrix of shape [capacity, state_size], accessed as a
+    numpy memmap. Rows beyond the number of lines in index.txt are unused.
+
+A state row is written before its index line, so an interrupted process never
+leaves an index entry pointing at a missing state.
+
+A cache opened with a different model identity than the one it was filled with
+is emptied, so the states of an old checkpoint are never reused.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import hashlib
+import json
+import os
+import threading
+
+
+import numpy as np
+import tensorflow as tf
+
+
+def model_identity(checkpoint_path=None, frozen_graph_file=None):
+  """Returns a string identifying the model that computes the cached states.
+
+  Args:
+    checkpoint_path: Checkpoint file or a directory containing a checkpoint
+      file. Ignored if frozen_graph_file is given.
+    frozen_graph_file: Optional frozen GraphDef written by
+      export_frozen_graph.py.
+
+  Returns:
+    The SHA-1 of the frozen graph, or of the checkpoint index file (which holds
+    a checksum of every variable), prefixed with the file name.
+
+  Raises:
+    ValueError: If no checkpoint is found.
+  """
+  if frozen_graph_file:
+    filename = frozen_graph_file
+  else:
+    if tf.gfile.IsDirectory(checkpoint_path):
+      checkpoint_dir = checkpoint_path
+      checkpoint_path = tf.train.latest_checkpoint(checkpoint_dir)
+      if not checkpoint_path:
+        raise ValueError("No checkpoint file found in: %s" % checkpoint_dir)
+    filename = checkpoint_path
+    if tf.gfile.Exists(checkpoint_path + ".index"):
+      filename = checkpoint_path + ".index"
+  with tf.gfile.GFile(filename, "rb") as f:
+    digest = hashlib.sha1(f.read()).hexdigest()
+  return "%s@%s" % (os.path.basename(filename), digest)
+
+
+class EmbeddingCache(object):
+  """Maps the SHA-1 of an encoded image to its initial model state."""
+
+  def __init__(self, cache_dir, memory_cache_size=0, initial_capacity=1024,
+               model_id=None):
+    """Opens or creates a cache.
+
+    Args:
+      cache_dir: Directory containing the cache files. Created if missing.
+      memory_cache_size: If > 0, the number of most recently used states that
+        are also kept in memory.
+      initial_capacity: Number of rows preallocated in a new states file.
+      model_id: Optional identity of the model, e.g. from model_identity(). If
+        it differs from the identity the cache was filled with, the cache is
+        emptied.
+    """
+    self._cache_dir = cache_dir
+    self._config_file = os.path.join(cache_dir, "config.json")
+    self._index_file = os.path.join(cache_dir, "index.txt")
+    self._states_file = os.path.join(cache_dir, "states.f32")
+    self._initial_capacity = initial_capacity
+    self._model_id = model_id
+    self._memory_cache_size = memory_cache_size
+    self._memory_cache = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+    # Number of lookups served from memory, from disk, and not at all.
+    self.memory_hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+
+    if model_id is not None and os.path.exists(self._config_file):
+      with open(self._config_file, "r") as f:
+        cached_model_id = json.load(f).get("model_id")
+      if cached_model_id != model_id:
+        tf.logging.warning("Emptying embedding cache %s of model %s for model "
+                           "%s", cache_dir, cached_model_id, model_id)
+        for filename in [self._config_file, self._index_file,
+                         self._states_file]:
+          if os.path.exists(filename):
+            os.remove(filename)
+
+    self._rows = {}
+    if os.path.exists(self._index_file):
+      with open(self._index_file, "r") as f:
+        for row, line in enumerate(f):
+          self._rows[line.strip()] = row
+
+    self._state_size = None
+    self._states = None
+    if os.path.exists(self._config_file):
+      with open(self._config_file, "r") as f:
+        self._state_size = json.load(f)["state_size"]
+      self._open_states()
+
+    tf.logging.info("Opened embedding cache with %d entries in %s",
+                    len(self._rows), cache_dir)
+
+  @property
+  def hits(self):
+    """Total number of lookups served from the cache."""
+    return self.memory_hits + self.disk_hits
+
+  def __len__(self):
+    return len(self._rows)
+
+  @staticmethod
+  def key(encoded_image):
+    """Returns the cache key of an encoded image string."""
+    return hashlib.sha1(encoded_image).hexdigest()
+
+  def _open_states(self):
+    """Memory maps the states file."""
+    capacity = os.path.getsize(self._states_file) // (4 * self._state_size)
+    self._states = np.memmap(self._states_file, dtype=np.float32, mode="r+",
+                             shape=(capacity, self._state_size))
+
+  def _grow_states(self, capacity):
+    """Resizes the states file to hold at least capacity rows."""
+    if self._states is not None:
+      self._states.flush()
+      self._states = None
+    with open(self._states_file, "ab") as f:
+      f.truncate(4 * self._state_size * capacity)
+    self._open_states()
+
+  def _remember(self, key, state):
+    """Inserts a state into the in-memory LRU cache."""
+    if self._memory_cache_size <= 0:
+      return
+    self._memory_cache.pop(key, None)
+    self._memory_cache[key] = state
+    if len(self._memory_cache) > self._memory_cache_size:
+      self._memory_cache.popitem(last=False)
+
+  def get(self, key):
+    """Looks up a state.
+
+    Args:
+      key: Cache key returned by key().
+
+    Returns:
+      A float32 numpy array of shape [state_size], or None on a cache miss.
+    """
+    with self._lock:
+      state = self._memory_cache.pop(key, None)
+      if state is not None:
+        self._memory_cache[key] = state
+        self.memory_hits += 1
+        return state
+
+      row = self._rows.get(key)
+      if row is None:
+        self.misses += 1
+        return None
+      state = np.array(self._states[row])
+      self._remember(key, state)
+      self.disk_hits += 1
+      return state
+
+  def put(self, key, state):
+    """Stores a state.
+
+    Args:
+      key: Cache key returned by key().
+      state: A numpy array of shape [state_size].
+    """
+    state = np.asarray(state, dtype=np.float32).reshape([-1])
+    with self._lock:
+      if key in self._rows:
+        return
+      if self._state_size is None:
+        self._state_size = state.size
+        with open(self._config_file, "w") as f:
+          json.dump({"state_size": self._state_size,
+                     "model_id": self._model_id}, f)
+        self._grow_states(self._initial_capacity)
+      elif state.size != self._state_size:
+        raise ValueError("Expected state of size %d, got %d" %
+                         (self._state_size, state.size))
+
+      row = len(self._rows)
+      if row >= self._states.shape[0]:
+        self._grow_states(2 * self._states.shape[0])
+      self._states[row] = state
+      self._states.flush()
+      with open(self._index_file, "a") as f:
+        f.write(key + "\n")
+      self._rows[key] = row
+      self._remember(key, state)
+
+  def flush(self):
+    """Writes pending changes to disk."""
+    with self._lock:
+      if self._states is not None:
+        self._states.flush()
+
+
+class CachingModel(object):
+  """Wraps an inference model so that image states are read from a cache.
+
+  feed_image() and feed_images() only run the image model on cache misses. All
+  other attributes are forwarded to the wrapped model.
+  """
+
+  def __init__(self, model, cache):
+    """Initializes the wrapper.
+
+    Args:
+      model: Object with methods feed_image() and inference_step(), e.g. an
+        instance of InferenceWrapperBase.
+      cache: An EmbeddingCache.
+    """
+    self.model = model
+    self.cache = cache
+
+  def __getattr__(self, name):
+    return getattr(self.model, name)
+
+  def feed_image(self, sess, encoded_image):
+    return self.feed_images(sess, [encoded_image])
+
+  def feed_images(self, sess, encoded_images):
+    keys = [EmbeddingCache.key(encoded_image)
+            for encoded_image in encoded_images]
+    states = [self.cache.get(key) for key in keys]
+
+    missing = [i for i, state in enumerate(states) if state is None]
+    if missing:
+      missing_images = [encoded_images[i] for i in missing]
+      if hasattr(self.model, "feed_images"):
+        new_states = self.model.feed_images(sess, missing_images)
+      else:
+        new_states = np.concatenate(
+            [self.model.feed_image(sess, image) for image in missing_images])
+      for i, state in zip(missing, new_states):
+        self.cache.put(keys[i], state)
+        states[i] = state
+
+    return np.array(states, dtype=np.float32)
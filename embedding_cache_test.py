@@ -0,0 +1,106 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Unit tests for EmbeddingCache."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+
+import numpy as np
+import tensorflow as tf
+
+import embedding_cache
+
+
+class FakeModel(object):
+  """Fake model whose initial state is derived from the image bytes."""
+
+  def __init__(self):
+    self.num_fed_images = 0
+
+  # pylint: disable=unused-argument
+
+  def feed_image(self, sess, encoded_image):
+    self.num_fed_images += 1
+    return np.full([1, 4], len(encoded_image), dtype=np.float32)
+
+  # pylint: enable=unused-argument
+
+
+class EmbeddingCacheTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(EmbeddingCacheTest, self).setUp()
+    self._cache_dir = os.path.join(self.get_temp_dir(), self.id())
+
+  def testPutAndGet(self):
+    cache = embedding_cache.EmbeddingCache(self._cache_dir)
+    key = cache.key(b"image")
+    self.assertIsNone(cache.get(key))
+    cache.put(key, np.arange(4))
+    self.assertAllEqual(np.arange(4), cache.get(key))
+    self.assertEqual(1, cache.hits)
+    self.assertEqual(1, cache.misses)
+
+  def testPersistsAcrossInstances(self):
+    cache = embedding_cache.EmbeddingCache(self._cache_dir, initial_capacity=2)
+    for i in range(5):
+      cache.put(cache.key(b"image%d" % i), np.full([4], i))
+    cache.flush()
+
+    cache = embedding_cache.EmbeddingCache(self._cache_dir)
+    self.assertEqual(5, len(cache))
+    for i in range(5):
+      self.assertAllEqual(np.full([4], i), cache.get(cache.key(b"image%d" % i)))
+    self.assertEqual(5, cache.disk_hits)
+
+  def testEmptiedForOtherModel(self):
+    cache = embedding_cache.EmbeddingCache(self._cache_dir, model_id="a")
+    cache.put(cache.key(b"image"), np.arange(4))
+    cache.flush()
+
+    cache = embedding_cache.EmbeddingCache(self._cache_dir, model_id="a")
+    self.assertEqual(1, len(cache))
+    cache = embedding_cache.EmbeddingCache(self._cache_dir, model_id="b")
+    self.assertEqual(0, len(cache))
+    self.assertIsNone(cache.get(cache.key(b"image")))
+    cache.put(cache.key(b"image"), np.ones([4]))
+    self.assertAllEqual(np.ones([4]), cache.get(cache.key(b"image")))
+
+  def testMemoryCache(self):
+    cache = embedding_cache.EmbeddingCache(self._cache_dir, memory_cache_size=1)
+    cache.put("a", np.zeros([4]))
+    cache.put("b", np.ones([4]))
+    cache.get("b")
+    cache.get("a")
+    self.assertEqual(1, cache.memory_hits)
+    self.assertEqual(1, cache.disk_hits)
+
+  def testCachingModel(self):
+    fake_model = FakeModel()
+    model = embedding_cache.CachingModel(
+        fake_model, embedding_cache.EmbeddingCache(self._cache_dir))
+    states = model.feed_images(None, [b"a", b"bb", b"a"])
+    self.assertAllEqual([[1] * 4, [2] * 4, [1] * 4], states)
+    states = model.feed_image(None, b"bb")
+    self.assertAllEqual([[2] * 4], states)
+    self.assertEqual(3, fake_model.num_fed_images)
+
+
+if __name__ == "__main__":
+  tf.test.main()
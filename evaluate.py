@@ -31,8 +31,9 @@ import time
 import numpy as np
 import tensorflow as tf
 
-from im2txt import configuration
-from im2txt import show_and_tell_model
+import configuration
+import show_and_tell_model
+import vocabulary
 
 FLAGS = tf.flags.FLAGS
 
@@ -40,7 +41,16 @@ tf.flags.DEFINE_string("input_file_pattern", "",
                        "File pattern of sharded TFRecord input files.")
 tf.flags.DEFINE_string("checkpoint_dir", "",
                        "Directory containing model checkpoints.")
+tf.flags.DEFINE_boolean("use_inception_features", False,
+                        "Whether the input files contain precomputed "
+                        "InceptionV3 outputs instead of images.")
+tf.flags.DEFINE_string("vocab_file", "",
+                       "Optional vocabulary file (word_counts.txt). If given, "
+                       "the model's vocab_size is fitted to it.")
 tf.flags.DEFINE_string("eval_dir", "", "Directory to write event logs.")
+tf.flags.DEFINE_string("lstm_implementation", "basic",
+                       "LSTM cell implementation: basic or block. Checkpoints "
+                       "of either implementation can be loaded.")
 
 tf.flags.DEFINE_integer("eval_interval_secs", 600,
                         "Interval between evaluation runs.")
@@ -143,7 +153,7 @@ def run_once(model, saver, summary_writer, summary_op):
           global_step=global_step,
           summary_writer=summary_writer,
           summary_op=summary_op)
-    except Exception, e:  # pylint: disable=broad-except
+    except Exception as e:  # pylint: disable=broad-except
       tf.logging.error("Evaluation failed.")
       coord.request_stop(e)
 
@@ -159,16 +169,33 @@ def run():
     tf.logging.info("Creating eval directory: %s", eval_dir)
     tf.gfile.MakeDirs(eval_dir)
 
+  # The model is built with the variable names and logits layout of the
+  # checkpoints, so wait for the first one.
+  while not tf.train.latest_checkpoint(FLAGS.checkpoint_dir):
+    tf.logging.info("Waiting for a checkpoint in: %s", FLAGS.checkpoint_dir)
+    time.sleep(FLAGS.eval_interval_secs)
+
   g = tf.Graph()
   with g.as_default():
     # Build the model for evaluation.
     model_config = configuration.ModelConfig()
     model_config.input_file_pattern = FLAGS.input_file_pattern
+    model_config.use_inception_features = FLAGS.use_inception_features
+    model_config.lstm_implementation = FLAGS.lstm_implementation
+    if FLAGS.vocab_file:
+      model_config.vocab_size = len(vocabulary.Vocabulary(FLAGS.vocab_file))
+    model_config.logits_weights_vocab_major = (
+        show_and_tell_model.checkpoint_logits_vocab_major(
+            FLAGS.checkpoint_dir))
     model = show_and_tell_model.ShowAndTellModel(model_config, mode="eval")
     model.build()
 
-    # Create the Saver to restore model Variables.
-    saver = tf.train.Saver()
+    # Create the Saver to restore model Variables. Checkpoints of the other
+    # lstm_implementation keep their variable names; the mapping is taken from
+    # the first checkpoint.
+    saver = tf.train.Saver(
+        show_and_tell_model.checkpoint_var_list(tf.global_variables(),
+                                                FLAGS.checkpoint_dir))
 
     # Create the summary operation and the summary writer.
     summary_op = tf.summary.merge_all()
@@ -0,0 +1,111 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Exports a frozen, pruned inference graph.
+
+The inference graph of ShowAndTellModel is built, the checkpoint variables are
+folded into constants, and every node that the inference outputs do not depend
+on (summaries, savers, initializers, moving average updates) is removed. The
+result is a single GraphDef file that InferenceWrapperBase.build_graph_from_frozen
+loads without a Saver.
+
+Usage:
+  python export_frozen_graph.py --checkpoint_path=model \
+    --output_file=model/frozen_inference_graph.pb
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+
+import tensorflow as tf
+
+import configuration
+import inference_wrapper
+import show_and_tell_model
+import vocabulary
+
+FLAGS = tf.flags.FLAGS
+
+tf.flags.DEFINE_string("checkpoint_path", "",
+                       "Model checkpoint file or directory containing a "
+                       "model checkpoint file.")
+tf.flags.DEFINE_string("vocab_file", "",
+                       "Optional vocabulary file (word_counts.txt). If given, "
+                       "the model's vocab_size is fitted to it.")
+tf.flags.DEFINE_string("lstm_implementation", "basic",
+                       "LSTM cell implementation: basic or block. Checkpoints "
+                       "of either implementation can be loaded.")
+tf.flags.DEFINE_string("output_file", "", "Output frozen GraphDef file.")
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+# Tensors fetched by InferenceWrapper, without the ":0" suffix.
+OUTPUT_NODE_NAMES = ["lstm/initial_state", "softmax", "lstm/state",
+                     "top_k/values", "top_k/indices", "top_k/shortlist_values",
+                     "top_k/shortlist_indices"]
+
+
+def freeze_graph(sess, output_node_names=None):
+  """Returns a frozen and pruned GraphDef of the Session's graph.
+
+  Args:
+    sess: Session holding the restored model variables.
+    output_node_names: Names of the nodes to keep, together with everything they
+      depend on. Defaults to OUTPUT_NODE_NAMES.
+
+  Returns:
+    A GraphDef whose variables are constants.
+  """
+  output_node_names = output_node_names or OUTPUT_NODE_NAMES
+  graph_def = sess.graph.as_graph_def()
+  # Pruning to the outputs drops summaries, savers and moving_vars updates.
+  # Identity nodes are kept (i.e. no remove_training_nodes) because the image
+  # preprocessing tf.map_fn loop needs them.
+  return tf.graph_util.convert_variables_to_constants(
+      sess, graph_def, output_node_names)
+
+
+def main(unused_argv):
+  assert FLAGS.checkpoint_path, "--checkpoint_path is required"
+  assert FLAGS.output_file, "--output_file is required"
+
+  model_config = configuration.ModelConfig()
+  model_config.lstm_implementation = FLAGS.lstm_implementation
+  if FLAGS.vocab_file:
+    model_config.vocab_size = len(vocabulary.Vocabulary(FLAGS.vocab_file))
+  model_config.logits_weights_vocab_major = (
+      show_and_tell_model.checkpoint_logits_vocab_major(FLAGS.checkpoint_path))
+
+  g = tf.Graph()
+  with g.as_default():
+    model = inference_wrapper.InferenceWrapper()
+    restore_fn = model.build_graph_from_config(model_config,
+                                               FLAGS.checkpoint_path)
+
+  with tf.Session(graph=g) as sess:
+    restore_fn(sess)
+    num_nodes = len(g.as_graph_def().node)
+    graph_def = freeze_graph(sess)
+
+  with tf.gfile.GFile(FLAGS.output_file, "wb") as f:
+    f.write(graph_def.SerializeToString())
+  tf.logging.info("Wrote frozen graph with %d of %d nodes (%d bytes) to %s",
+                  len(graph_def.node), num_nodes, graph_def.ByteSize(),
+                  FLAGS.output_file)
+
+
+if __name__ == "__main__":
+  tf.app.run()
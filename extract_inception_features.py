@@ -0,0 +1,203 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Precomputes the InceptionV3 output of every image in a TFRecord dataset.
+
+While InceptionV3 is not trained (--train_inception=false), its output for an
+image never changes, so it can be computed once instead of at every training
+step. Each input shard is rewritten to an output shard with the same name in
+which the image/data context feature is replaced by the float feature
+ModelConfig.inception_feature_name. The caption feature lists are copied
+unchanged.
+
+Images are processed as at evaluation time: centrally resized and cropped,
+without the random distortions applied in training.
+
+Train on the output with ModelConfig.use_inception_features = True, e.g.
+
+  python extract_inception_features.py \
+    --input_file_pattern="data/out/train-?????-of-00256" \
+    --inception_checkpoint_file=inception_v3.ckpt \
+    --output_dir=data/out/features
+
+  python train.py \
+    --input_file_pattern="data/out/features/train-?????-of-00256" \
+    --inception_checkpoint_file=inception_v3.ckpt \
+    --use_inception_features ...
+
+The InceptionV3 variables are still restored and saved with the model
+checkpoints, so inference runs on images as before.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+
+import tensorflow as tf
+
+import configuration
+import image_embedding
+import image_processing
+
+FLAGS = tf.flags.FLAGS
+
+tf.flags.DEFINE_string("input_file_pattern", "",
+                       "File pattern of sharded TFRecord input files.")
+tf.flags.DEFINE_string("inception_checkpoint_file", "",
+                       "Path to a pretrained inception_v3 model.")
+tf.flags.DEFINE_string("output_dir", "", "Output data directory.")
+tf.flags.DEFINE_integer("batch_size", 64,
+                        "Number of images passed through InceptionV3 at once.")
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+
+def _float_feature(values):
+  """Wrapper for inserting a float Feature into a SequenceExample proto."""
+  return tf.train.Feature(float_list=tf.train.FloatList(value=values))
+
+
+def _build_graph(model_config):
+  """Builds the feature extraction graph.
+
+  Args:
+    model_config: Object containing configuration for building the model.
+
+  Returns:
+    encoded_images: A 1-D string placeholder for a batch of encoded images.
+    inception_output: A float32 Tensor of shape [batch_size,
+      inception_feature_size].
+    saver: A Saver for the InceptionV3 variables.
+  """
+  encoded_images = tf.placeholder(tf.string, shape=[None],
+                                  name="encoded_images")
+
+  def _process_image(encoded_image):
+    return image_processing.process_image(
+        encoded_image,
+        is_training=False,
+        height=model_config.image_height,
+        width=model_config.image_width,
+        image_format=model_config.image_format,
+        add_summaries=False,
+        stored_height=model_config.stored_image_height,
+        stored_width=model_config.stored_image_width)
+
+  images = tf.map_fn(_process_image, encoded_images, dtype=tf.float32,
+                     back_prop=False)
+  inception_output = image_embedding.inception_v3(images,
+                                                  trainable=False,
+                                                  is_training=False,
+                                                  add_summaries=False)
+  saver = tf.train.Saver(
+      tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope="InceptionV3"))
+  return encoded_images, inception_output, saver
+
+
+def _process_shard(sess, encoded_images, inception_output, input_file,
+                   output_file, model_config):
+  """Writes the features of the images in one input shard.
+
+  The shard is written to a temporary file that is renamed to output_file when
+  it is complete.
+
+  Args:
+    sess: A Session of the graph built by _build_graph().
+    encoded_images: The encoded image placeholder returned by _build_graph().
+    inception_output: The InceptionV3 output returned by _build_graph().
+    input_file: TFRecord file of SequenceExample protos with images.
+    output_file: Output TFRecord file.
+    model_config: ModelConfig with the names of the image and feature
+      features.
+
+  Returns:
+    The number of images processed.
+  """
+  image_feature = model_config.image_feature_name
+  writer = tf.python_io.TFRecordWriter(output_file + ".tmp")
+  batch = []
+
+  def _write_batch():
+    features = sess.run(inception_output, feed_dict={
+        encoded_images: [
+            example.context.feature[image_feature].bytes_list.value[0]
+            for example in batch
+        ]
+    })
+    for example, feature in zip(batch, features):
+      context = example.context.feature
+      del context[image_feature]
+      context[model_config.inception_feature_name].CopyFrom(
+          _float_feature(feature))
+      writer.write(example.SerializeToString())
+
+  count = 0
+  for serialized in tf.python_io.tf_record_iterator(input_file):
+    batch.append(tf.train.SequenceExample.FromString(serialized))
+    if len(batch) == FLAGS.batch_size:
+      _write_batch()
+      count += len(batch)
+      batch = []
+  if batch:
+    _write_batch()
+    count += len(batch)
+  writer.close()
+  tf.gfile.Rename(output_file + ".tmp", output_file, overwrite=True)
+  return count
+
+
+def main(unused_argv):
+  assert FLAGS.input_file_pattern, "--input_file_pattern is required"
+  assert FLAGS.inception_checkpoint_file, (
+      "--inception_checkpoint_file is required")
+  assert FLAGS.output_dir, "--output_dir is required"
+
+  model_config = configuration.ModelConfig()
+
+  input_files = []
+  for pattern in FLAGS.input_file_pattern.split(","):
+    input_files.extend(tf.gfile.Glob(pattern))
+  if not input_files:
+    tf.logging.fatal("Found no input files matching %s",
+                     FLAGS.input_file_pattern)
+  output_dir = os.path.realpath(FLAGS.output_dir)
+  if any(os.path.dirname(os.path.realpath(f)) == output_dir
+         for f in input_files):
+    raise ValueError("--output_dir must not contain the input shards: %s" %
+                     FLAGS.output_dir)
+  if not tf.gfile.IsDirectory(FLAGS.output_dir):
+    tf.gfile.MakeDirs(FLAGS.output_dir)
+
+  g = tf.Graph()
+  with g.as_default():
+    encoded_images, inception_output, saver = _build_graph(model_config)
+  g.finalize()
+
+  with tf.Session(graph=g) as sess:
+    saver.restore(sess, FLAGS.inception_checkpoint_file)
+    total = 0
+    for i, input_file in enumerate(sorted(input_files)):
+      output_file = os.path.join(FLAGS.output_dir,
+                                 os.path.basename(input_file))
+      total += _process_shard(sess, encoded_images, inception_output,
+                              input_file, output_file, model_config)
+      tf.logging.info("Wrote %s (%d of %d shards, %d images)", output_file,
+                      i + 1, len(input_files), total)
+
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -66,7 +66,10 @@ def process_image(encoded_image,
                   resize_height=346,
                   resize_width=346,
                   thread_id=0,
-                  image_format="jpeg"):
+                  image_format="jpeg",
+                  add_summaries=True,
+                  stored_height=0,
+                  stored_width=0):
   """Decode an image, resize and apply random distortions.
 
   In training, images are distorted slightly differently depending on thread_id.
@@ -80,18 +83,24 @@ def process_image(encoded_image,
     resize_width: If > 0, resize width before crop to final dimensions.
     thread_id: Preprocessing thread id used to select the ordering of color
       distortions. There should be a multiple of 2 preprocessing threads.
-    image_format: "jpeg" or "png".
+    image_format: "jpeg", "png" or "raw" (uint8 pixels of shape
+      [stored_height, stored_width, 3]).
+    add_summaries: If true, add image summaries (in thread 0 only).
+    stored_height: Height the image was resized to when it was stored, or 0.
+      If stored_height and stored_width are resize_height and resize_width,
+      the image is not resized again.
+    stored_width: Width the image was resized to when it was stored, or 0.
 
   Returns:
     A float32 Tensor of shape [height, width, 3] with values in [-1, 1].
 
   Raises:
-    ValueError: If image_format is invalid.
+    ValueError: If image_format is invalid, or "raw" without a stored size.
   """
   # Helper function to log an image summary to the visualizer. Summaries are
   # only logged in thread 0.
   def image_summary(name, image):
-    if not thread_id:
+    if add_summaries and not thread_id:
       tf.summary.image(name, tf.expand_dims(image, 0))
 
   # Decode image into a float32 Tensor of shape [?, ?, 3] with values in [0, 1).
@@ -100,6 +109,11 @@ def process_image(encoded_image,
       image = tf.image.decode_jpeg(encoded_image, channels=3)
     elif image_format == "png":
       image = tf.image.decode_png(encoded_image, channels=3)
+    elif image_format == "raw":
+      if not (stored_height > 0 and stored_width > 0):
+        raise ValueError("Raw images require stored_height and stored_width.")
+      image = tf.reshape(tf.decode_raw(encoded_image, tf.uint8),
+                         [stored_height, stored_width, 3])
     else:
       raise ValueError("Invalid image format: %s" % image_format)
   image = tf.image.convert_image_dtype(image, dtype=tf.float32)
@@ -107,7 +121,11 @@ def process_image(encoded_image,
 
   # Resize image.
   assert (resize_height > 0) == (resize_width > 0)
-  if resize_height:
+  if resize_height and (stored_height, stored_width) == (resize_height,
+                                                         resize_width):
+    # Already resized when it was stored.
+    image.set_shape([resize_height, resize_width, 3])
+  elif resize_height:
     image = tf.image.resize_images(image,
                                    size=[resize_height, resize_width],
                                    method=tf.image.ResizeMethod.BILINEAR)
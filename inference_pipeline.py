@@ -0,0 +1,509 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Streaming caption generation: prefetched image reads and JSONL output.
+
+The pipeline has three stages that run concurrently:
+
+  1. Reader threads list the input files lazily and read their bytes into a
+     bounded queue (prefetch_images).
+  2. The calling thread captions the images in batches (caption_images), or
+     a pool of worker processes, each with its own Session, captions them
+     (caption_files_in_workers).
+  3. A writer thread serializes one JSON record per image (JsonlWriter).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import fnmatch
+import glob
+import json
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+
+
+from six.moves import queue
+import tensorflow as tf
+
+import caption_generator
+import inference_wrapper
+import vocabulary
+
+# Marks the end of a queue.
+_DONE = object()
+
+
+def checkpoint_vocab_size(checkpoint_path):
+  """Returns the vocabulary size a ShowAndTellModel checkpoint was trained with.
+
+  Args:
+    checkpoint_path: Checkpoint file or a directory containing a checkpoint
+      file.
+
+  Returns:
+    The number of rows of the seq_embedding/map variable.
+
+  Raises:
+    ValueError: If no checkpoint is found.
+  """
+  if tf.gfile.IsDirectory(checkpoint_path):
+    checkpoint_dir = checkpoint_path
+    checkpoint_path = tf.train.latest_checkpoint(checkpoint_dir)
+    if not checkpoint_path:
+      raise ValueError("No checkpoint file found in: %s" % checkpoint_dir)
+  reader = tf.train.NewCheckpointReader(checkpoint_path)
+  return reader.get_variable_to_shape_map()["seq_embedding/map"][0]
+
+
+def build_inference_graph(model_config, checkpoint_path,
+                          frozen_graph_file=None):
+  """Builds a finalized inference graph.
+
+  Args:
+    model_config: Object containing configuration for building the model.
+    checkpoint_path: Checkpoint file or a directory containing a checkpoint
+      file. Ignored if frozen_graph_file is given.
+    frozen_graph_file: Optional frozen GraphDef written by
+      export_frozen_graph.py.
+
+  Returns:
+    g: The Graph.
+    model: An InferenceWrapper for the graph.
+    restore_fn: A function such that restore_fn(sess) loads the model
+      variables, if any.
+  """
+  g = tf.Graph()
+  with g.as_default():
+    model = inference_wrapper.InferenceWrapper()
+    if frozen_graph_file:
+      restore_fn = model.build_graph_from_frozen(frozen_graph_file)
+    else:
+      restore_fn = model.build_graph_from_config(model_config, checkpoint_path)
+  g.finalize()
+  return g, model, restore_fn
+
+
+# Characters that make a path component a pattern, as in the glob module.
+_GLOB_MAGIC = re.compile(r"[*?[]")
+
+
+def _iter_local_files(file_pattern):
+  """Yields the local files matching a pattern, listing directories lazily.
+
+  glob lists a whole directory before matching its entries, so the files
+  matched by the last component of file_pattern are produced from os.scandir()
+  instead, one directory entry at a time.
+  """
+  dirname, basename = os.path.split(file_pattern)
+  if not _GLOB_MAGIC.search(basename):
+    for filename in glob.iglob(file_pattern):
+      yield filename
+    return
+  if _GLOB_MAGIC.search(dirname):
+    dirnames = glob.iglob(dirname)
+  else:
+    dirnames = [dirname]
+  for directory in dirnames:
+    try:
+      entries = os.scandir(directory or os.curdir)
+    except OSError:
+      continue
+    try:
+      for entry in entries:
+        # Like glob, hidden files only match patterns starting with a dot.
+        if entry.name.startswith(".") and not basename.startswith("."):
+          continue
+        if fnmatch.fnmatch(entry.name, basename):
+          yield os.path.join(directory, entry.name)
+    finally:
+      entries.close()
+
+
+def iter_filenames(file_patterns):
+  """Lists the files matching a comma-separated list of file patterns.
+
+  Local directories are listed lazily, so the first files are produced before
+  large directories have been listed completely. Files are produced in
+  directory order, not sorted.
+
+  Args:
+    file_patterns: Comma-separated list of file patterns.
+
+  Yields:
+    File names.
+  """
+  for file_pattern in file_patterns.split(","):
+    if "://" in file_pattern:
+      filenames = tf.gfile.Glob(file_pattern)
+    else:
+      filenames = _iter_local_files(file_pattern)
+    for filename in filenames:
+      yield filename
+
+
+def prefetch_images(filenames, num_threads=8, capacity=64):
+  """Reads image files in background threads.
+
+  Args:
+    filenames: Iterable of image file names.
+    num_threads: Number of reader threads.
+    capacity: Maximum number of images buffered ahead of the consumer.
+
+  Yields:
+    Tuples (filename, encoded_image, read_secs) in the order in which the
+    reads complete. encoded_image is None if the file could not be read.
+
+  Raises:
+    Any exception raised while listing filenames, once the files listed before
+    it have been yielded.
+  """
+  filename_queue = queue.Queue(maxsize=capacity)
+  image_queue = queue.Queue(maxsize=capacity)
+  errors = []
+
+  def _list_files():
+    try:
+      for filename in filenames:
+        filename_queue.put(filename)
+    except Exception as e:  # pylint: disable=broad-except
+      errors.append(e)
+    finally:
+      for _ in range(num_threads):
+        filename_queue.put(_DONE)
+
+  def _read_files():
+    try:
+      while True:
+        filename = filename_queue.get()
+        if filename is _DONE:
+          return
+        start_time = time.time()
+        try:
+          with tf.gfile.GFile(filename, "rb") as f:
+            encoded_image = f.read()
+        except Exception as e:  # pylint: disable=broad-except
+          tf.logging.error("Failed to read %s: %s", filename, e)
+          encoded_image = None
+        image_queue.put((filename, encoded_image, time.time() - start_time))
+    except Exception as e:  # pylint: disable=broad-except
+      errors.append(e)
+    finally:
+      image_queue.put(_DONE)
+
+  threads = [threading.Thread(target=_list_files)]
+  threads.extend(threading.Thread(target=_read_files)
+                 for _ in range(num_threads))
+  for t in threads:
+    t.daemon = True
+    t.start()
+
+  num_done = 0
+  while num_done < num_threads:
+    item = image_queue.get()
+    if item is _DONE:
+      num_done += 1
+    else:
+      yield item
+  if errors:
+    raise errors[0]
+
+
+def caption_to_dict(caption, vocab):
+  """Converts a Caption into a JSON-serializable dict."""
+  # Ignore begin and end words.
+  words = [vocab.id_to_word(w) for w in caption.sentence[1:-1]]
+  return {
+      "sentence": " ".join(words),
+      "logprob": caption.logprob,
+      "score": caption.score,
+  }
+
+
+def caption_images(sess, generator, images, batch_size=1):
+  """Captions a stream of images in batches.
+
+  Args:
+    sess: TensorFlow Session object.
+    generator: A CaptionGenerator.
+    images: Iterable of (filename, encoded_image, read_secs), e.g. as produced
+      by prefetch_images(). filename is passed through unchanged, so it may be
+      any identifier of the image.
+    batch_size: Number of images passed to each beam_search_batch() call.
+
+  Yields:
+    Tuples (filename, captions, timings), where captions is a list of Caption
+    (empty if the image could not be read or captioned) and timings is a dict
+    of the read and caption times in seconds.
+  """
+  batch = []
+
+  def _caption_batch():
+    start_time = time.time()
+    try:
+      batch_captions = generator.beam_search_batch(
+          sess, [encoded_image for _, encoded_image, _ in batch])
+    except tf.errors.InvalidArgumentError as e:
+      # A single undecodable image fails the whole batch; retry one by one.
+      if len(batch) == 1:
+        tf.logging.error("Failed to caption %s: %s", batch[0][0], e)
+        batch_captions = [[]]
+      else:
+        batch_captions = []
+        for item in batch:
+          try:
+            batch_captions.extend(generator.beam_search_batch(sess, [item[1]]))
+          except tf.errors.InvalidArgumentError as e:
+            tf.logging.error("Failed to caption %s: %s", item[0], e)
+            batch_captions.append([])
+    caption_secs = (time.time() - start_time) / len(batch)
+    for (filename, _, read_secs), captions in zip(batch, batch_captions):
+      yield filename, captions, {"read_secs": read_secs,
+                                 "caption_secs": caption_secs}
+
+  for filename, encoded_image, read_secs in images:
+    if encoded_image is None:
+      yield filename, [], {"read_secs": read_secs, "caption_secs": 0.0}
+      continue
+    batch.append((filename, encoded_image, read_secs))
+    if len(batch) == batch_size:
+      for result in _caption_batch():
+        yield result
+      batch = []
+  if batch:
+    for result in _caption_batch():
+      yield result
+
+
+class JsonlWriter(object):
+  """Writes one JSON record per line from a background thread."""
+
+  def __init__(self, output_file, capacity=256):
+    """Starts the writer thread.
+
+    Args:
+      output_file: Output file name, or "-" for stdout.
+      capacity: Maximum number of records buffered ahead of the writer.
+    """
+    self._output_file = output_file
+    self._queue = queue.Queue(maxsize=capacity)
+    self._error = None
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self):
+    done = False
+    try:
+      if self._output_file == "-":
+        f = sys.stdout
+      else:
+        f = tf.gfile.GFile(self._output_file, "w")
+      try:
+        while True:
+          record = self._queue.get()
+          if record is _DONE:
+            done = True
+            return
+          f.write(json.dumps(record, sort_keys=True) + "\n")
+          if self._queue.empty():
+            f.flush()
+      finally:
+        if f is sys.stdout:
+          f.flush()
+        else:
+          f.close()
+    except Exception as e:  # pylint: disable=broad-except
+      self._error = e
+      # Keep draining the queue so that write() and close() never block.
+      while not done:
+        done = self._queue.get() is _DONE
+
+  def write(self, record):
+    """Queues a JSON-serializable record.
+
+    Raises:
+      Any exception that stopped the writer thread.
+    """
+    if self._error is not None:
+      raise self._error
+    self._queue.put(record)
+
+  def close(self):
+    """Writes all queued records and stops the writer thread.
+
+    Raises:
+      Any exception that stopped the writer thread.
+    """
+    self._queue.put(_DONE)
+    self._thread.join()
+    if self._error is not None:
+      raise self._error
+
+
+def _caption_worker(model_config, checkpoint_path, frozen_graph_file,
+                    vocab_file, num_threads, batch_size, task_queue,
+                    result_queue):
+  """Captions the files of task_queue in a worker process.
+
+  Args:
+    model_config: Object containing configuration for building the model.
+    checkpoint_path: Checkpoint file or a directory containing a checkpoint
+      file.
+    frozen_graph_file: Optional frozen GraphDef to use instead of
+      checkpoint_path.
+    vocab_file: Text file containing the vocabulary.
+    num_threads: Number of intra-op and inter-op threads of the Session.
+    batch_size: Number of images passed to each beam_search_batch() call.
+    task_queue: Queue of (index, filename) tasks, terminated by None.
+    result_queue: Queue receiving (index, filename, captions, timings), where
+      captions is a list of dicts as returned by caption_to_dict(). None is put
+      when the worker is done.
+  """
+  g, model, restore_fn = build_inference_graph(model_config, checkpoint_path,
+                                              frozen_graph_file)
+  vocab = vocabulary.Vocabulary(vocab_file)
+
+  def _read_tasks():
+    while True:
+      task = task_queue.get()
+      if task is None:
+        return
+      _, filename = task
+      start_time = time.time()
+      try:
+        with tf.gfile.GFile(filename, "rb") as f:
+          encoded_image = f.read()
+      except Exception as e:  # pylint: disable=broad-except
+        tf.logging.error("Failed to read %s: %s", filename, e)
+        encoded_image = None
+      yield task, encoded_image, time.time() - start_time
+
+  session_config = tf.ConfigProto(intra_op_parallelism_threads=num_threads,
+                                  inter_op_parallelism_threads=num_threads)
+  with tf.Session(graph=g, config=session_config) as sess:
+    restore_fn(sess)
+    generator = caption_generator.CaptionGenerator(model, vocab)
+    for (index, filename), captions, timings in caption_images(
+        sess, generator, _read_tasks(), batch_size=batch_size):
+      result_queue.put((index, filename,
+                        [caption_to_dict(c, vocab) for c in captions],
+                        timings))
+  result_queue.put(None)
+
+
+def caption_files_in_workers(filenames, num_workers, model_config,
+                             checkpoint_path, vocab_file, batch_size=1,
+                             capacity=64, frozen_graph_file=None):
+  """Captions files in a pool of worker processes.
+
+  Each worker builds the inference graph and restores the checkpoint once, and
+  its Session gets an equal share of the CPU cores. Files are handed out through
+  a shared queue, so faster workers take more of them.
+
+  Args:
+    filenames: Iterable of image file names.
+    num_workers: Number of worker processes.
+    model_config: Object containing configuration for building the model.
+    checkpoint_path: Checkpoint file or a directory containing a checkpoint
+      file.
+    vocab_file: Text file containing the vocabulary.
+    batch_size: Number of images passed to each beam_search_batch() call.
+    capacity: Maximum number of files queued ahead of the workers.
+    frozen_graph_file: Optional frozen GraphDef to use instead of
+      checkpoint_path.
+
+  Yields:
+    Tuples (filename, captions, timings) in the order of filenames, where
+    captions is a list of dicts as returned by caption_to_dict().
+
+  Raises:
+    RuntimeError: As soon as a worker process exits before finishing its
+      work. The other workers are terminated.
+  """
+  num_threads = max(1, multiprocessing.cpu_count() // num_workers)
+  task_queue = multiprocessing.Queue(maxsize=capacity)
+  result_queue = multiprocessing.Queue()
+  workers = []
+  for _ in range(num_workers):
+    worker = multiprocessing.Process(
+        target=_caption_worker,
+        args=(model_config, checkpoint_path, frozen_graph_file, vocab_file,
+              num_threads, batch_size, task_queue, result_queue))
+    worker.daemon = True
+    worker.start()
+    workers.append(worker)
+  tf.logging.info("Started %d caption workers with %d threads each.",
+                  num_workers, num_threads)
+
+  def _enqueue_tasks():
+    for task in enumerate(filenames):
+      task_queue.put(task)
+    for _ in workers:
+      task_queue.put(None)
+
+  feeder = threading.Thread(target=_enqueue_tasks)
+  feeder.daemon = True
+  feeder.start()
+
+  def _raise_if_failed():
+    # A crashed worker may hold a file that the ordered output waits for.
+    failed = [worker for worker in workers
+              if worker.exitcode is not None and worker.exitcode != 0]
+    if failed:
+      for worker in workers:
+        if worker.is_alive():
+          worker.terminate()
+      raise RuntimeError("Caption worker %d exited with code %d." %
+                         (failed[0].pid, failed[0].exitcode))
+
+  # Results arrive in completion order; release them in input order.
+  pending = {}
+  next_index = 0
+  num_done = 0
+  while num_done < num_workers:
+    _raise_if_failed()
+    try:
+      results = [result_queue.get(timeout=1.0)]
+    except queue.Empty:
+      if any(worker.is_alive() for worker in workers):
+        continue
+      # Workers that exited cleanly after the timeout may have left their last
+      # results and sentinels in the queue.
+      results = []
+      while True:
+        try:
+          results.append(result_queue.get_nowait())
+        except queue.Empty:
+          break
+      if num_done + results.count(None) < num_workers:
+        _raise_if_failed()
+        raise RuntimeError("Caption workers exited without finishing.")
+    for result in results:
+      if result is None:
+        num_done += 1
+        continue
+      index = result[0]
+      pending[index] = result[1:]
+      while next_index in pending:
+        yield pending.pop(next_index)
+        next_index += 1
+
+  for worker in workers:
+    worker.join()
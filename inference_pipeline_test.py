@@ -0,0 +1,74 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for inference_pipeline."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+
+import tensorflow as tf
+
+import inference_pipeline
+
+
+class IterFilenamesTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(IterFilenamesTest, self).setUp()
+    self._dir = os.path.join(self.get_temp_dir(), "images")
+    os.makedirs(self._dir)
+    for name in ["%03d.jpg" % i for i in range(100)] + ["a.txt", ".b.jpg"]:
+      with open(os.path.join(self._dir, name), "w"):
+        pass
+    self._scandir = os.scandir
+    self._num_listed = 0
+
+  def tearDown(self):
+    os.scandir = self._scandir
+    super(IterFilenamesTest, self).tearDown()
+
+  def _countingScandir(self, path):
+    """Lists a directory like os.scandir(), counting the listed entries."""
+    with self._scandir(path) as entries:
+      for entry in entries:
+        self._num_listed += 1
+        yield entry
+
+  def testMatchesLikeGlob(self):
+    pattern = os.path.join(self._dir, "*.jpg")
+    self.assertEqual(
+        sorted(os.path.join(self._dir, "%03d.jpg" % i) for i in range(100)),
+        sorted(inference_pipeline.iter_filenames(pattern)))
+    self.assertEqual(
+        [os.path.join(self._dir, "a.txt")],
+        list(inference_pipeline.iter_filenames(
+            os.path.join(self._dir, "a.txt"))))
+
+  def testListsDirectoryLazily(self):
+    os.scandir = self._countingScandir
+    filenames = inference_pipeline.iter_filenames(
+        os.path.join(self._dir, "*"))
+    next(filenames)
+    self.assertLess(self._num_listed, 102)
+    self.assertEqual(100, len(list(filenames)))
+    self.assertEqual(102, self._num_listed)
+
+
+if __name__ == "__main__":
+  tf.test.main()
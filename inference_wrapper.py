@@ -20,32 +20,106 @@ from __future__ import division
 from __future__ import print_function
 
 
+import tensorflow as tf
 
 import show_and_tell_model
 import inference_wrapper_base
 
 
 class InferenceWrapper(inference_wrapper_base.InferenceWrapperBase):
-  """Model wrapper class for performing inference with a ShowAndTellModel."""
+  """Model wrapper class for performing inference with a ShowAndTellModel.
+
+  The subgraphs are run through callables made with Session.make_callable(),
+  so feeds and fetches are not resolved again at every call. The callables are
+  made when a Session is first used and remade if a different Session is
+  passed.
+  """
 
   def __init__(self):
     super(InferenceWrapper, self).__init__()
+    self._callables_session = None
+    self._callables = {}
+    # Whether the graph of self._callables_session has each tensor name.
+    self._has_tensor = {}
 
   def build_model(self, model_config):
     model = show_and_tell_model.ShowAndTellModel(model_config, mode="inference")
     model.build()
     return model
 
+  def checkpoint_var_list(self, checkpoint_path):
+    # Checkpoints of either lstm_implementation load into the model.
+    return show_and_tell_model.checkpoint_var_list(tf.global_variables(),
+                                                   checkpoint_path)
+
+  def _set_session(self, sess):
+    """Forgets the callables and tensors of a previous Session."""
+    if sess is not self._callables_session:
+      self._callables = {}
+      self._has_tensor = {}
+      self._callables_session = sess
+
+  def _graph_has_tensor(self, sess, name):
+    """Returns whether the graph of sess has the tensor with the given name."""
+    self._set_session(sess)
+    has_tensor = self._has_tensor.get(name)
+    if has_tensor is None:
+      try:
+        sess.graph.get_tensor_by_name(name)
+        has_tensor = True
+      except KeyError:
+        has_tensor = False
+      self._has_tensor[name] = has_tensor
+    return has_tensor
+
+  def _callable(self, sess, fetches, feed_list):
+    """Returns a callable of sess that runs fetches given feed_list values."""
+    self._set_session(sess)
+    key = (tuple(fetches) if isinstance(fetches, list) else fetches,
+           tuple(feed_list))
+    fn = self._callables.get(key)
+    if fn is None:
+      fn = sess.make_callable(fetches, feed_list)
+      self._callables[key] = fn
+    return fn
+
   def feed_image(self, sess, encoded_image):
-    initial_state = sess.run(fetches="lstm/initial_state:0",
-                             feed_dict={"image_feed:0": encoded_image})
+    initial_state = self._callable(sess, "lstm/initial_state:0",
+                                   ["image_feed:0"])(encoded_image)
     return initial_state
 
+  def feed_images(self, sess, encoded_images):
+    # GraphDefs exported before images_feed was added take one image at a time.
+    if not self._graph_has_tensor(sess, "images_feed:0"):
+      return super(InferenceWrapper, self).feed_images(sess, encoded_images)
+    initial_states = self._callable(sess, "lstm/initial_state:0",
+                                    ["images_feed:0"])(encoded_images)
+    return initial_states
+
   def inference_step(self, sess, input_feed, state_feed):
-    softmax_output, state_output = sess.run(
-        fetches=["softmax:0", "lstm/state:0"],
-        feed_dict={
-            "input_feed:0": input_feed,
-            "lstm/state_feed:0": state_feed,
-        })
+    softmax_output, state_output = self._callable(
+        sess,
+        ["softmax:0", "lstm/state:0"],
+        ["input_feed:0", "lstm/state_feed:0"])(input_feed, state_feed)
     return softmax_output, state_output, None
+
+  def supports_top_k(self, sess):
+    """Returns whether the graph of sess has the top_k subgraph.
+
+    Frozen graphs and GraphDefs exported before the subgraph was added to
+    ShowAndTellModel do not have it, and must use inference_step().
+    """
+    return self._graph_has_tensor(sess, "top_k/indices:0")
+
+  def inference_step_top_k(self, sess, input_feed, state_feed, k,
+                           word_shortlist=None):
+    fetches = ["top_k/indices:0", "top_k/values:0", "lstm/state:0"]
+    feed_list = ["input_feed:0", "lstm/state_feed:0", "top_k/k:0"]
+    feeds = [input_feed, state_feed, k]
+    if word_shortlist is not None:
+      fetches[:2] = ["top_k/shortlist_indices:0", "top_k/shortlist_values:0"]
+      feed_list.append("top_k/word_shortlist:0")
+      feeds.append(word_shortlist)
+    word_ids, probabilities, state_output = self._callable(
+        sess, fetches, feed_list)(*feeds)
+    return word_ids, probabilities, state_output, None
@@ -26,19 +26,35 @@ Subclasses must implement the following methods:
     precisely once at the start of inference for each image. Subclasses may
     compute and/or save per-image internal context in this method.
 
+  feed_images():
+    Optional. Takes a list of encoded images and returns their initial model
+    states in a single batch. The default implementation calls feed_image()
+    once per image.
+
   inference_step():
     Takes a batch of inputs and states at a single time-step. Returns the
     softmax output corresponding to the inputs, and the new states of the batch.
     Optionally also returns metadata about the current inference step, e.g. a
     serialized numpy array containing activations from a particular model layer.
 
+  inference_step_top_k():
+    Optional. Like inference_step(), but returns only the k most probable next
+    words of each input and their probabilities, optionally among a shortlist
+    of word ids. CaptionGenerator uses it when available instead of fetching
+    the whole softmax, unless the optional supports_top_k() returns False for
+    the Session's graph.
+
 Client usage:
-  1. Build the model inference graph via build_graph_from_config() or
-     build_graph_from_proto().
+  1. Build the model inference graph via build_graph_from_config(),
+     build_graph_from_proto() or build_graph_from_frozen().
   2. Call the resulting restore_fn to load the model checkpoint.
   3. For each image in a batch of images:
-     a) Call feed_image() once to get the initial state.
-     b) For each step of caption generation, call inference_step().
+     a) Call feed_image() once to get the initial state, or call feed_images()
+        once for the whole batch.
+     b) For each step of caption generation, call inference_step() or
+        inference_step_top_k().
+     The beams of several images may be packed into a single inference_step()
+     batch, e.g. by CaptionGenerator.beam_search_batch().
 """
 
 from __future__ import absolute_import
@@ -48,6 +64,7 @@ from __future__ import print_function
 import os.path
 
 
+import numpy as np
 import tensorflow as tf
 
 # pylint: disable=unused-argument
@@ -70,6 +87,21 @@ class InferenceWrapperBase(object):
     """
     tf.logging.fatal("Please implement build_model in subclass")
 
+  def checkpoint_var_list(self, checkpoint_path):
+    """Returns the var_list of the Saver that restores checkpoint_path.
+
+    Subclasses may override this to map checkpoint variable names to model
+    variables.
+
+    Args:
+      checkpoint_path: Checkpoint file or a directory containing a checkpoint
+        file.
+
+    Returns:
+      A var_list for tf.train.Saver, or None for all variables by name.
+    """
+    return None
+
   def _create_restore_fn(self, checkpoint_path, saver):
     """Creates a function that restores a model from checkpoint.
 
@@ -113,7 +145,7 @@ class InferenceWrapperBase(object):
     """
     tf.logging.info("Building model.")
     self.build_model(model_config)
-    saver = tf.train.Saver()
+    saver = tf.train.Saver(self.checkpoint_var_list(checkpoint_path))
 
     return self._create_restore_fn(checkpoint_path, saver)
 
@@ -147,6 +179,31 @@ class InferenceWrapperBase(object):
 
     return self._create_restore_fn(checkpoint_path, saver)
 
+  def build_graph_from_frozen(self, frozen_graph_file):
+    """Builds the inference graph from a frozen GraphDef.
+
+    A frozen GraphDef holds the model variables as constants, e.g. as written
+    by export_frozen_graph.py, so no checkpoint is needed.
+
+    Args:
+      frozen_graph_file: File containing a serialized, frozen GraphDef proto.
+
+    Returns:
+      restore_fn: A function with the same signature as the restore_fn of
+        build_graph_from_config(). It does nothing.
+    """
+    tf.logging.info("Loading frozen GraphDef from file: %s", frozen_graph_file)
+    graph_def = tf.GraphDef()
+    with tf.gfile.FastGFile(frozen_graph_file, "rb") as f:
+      graph_def.ParseFromString(f.read())
+    tf.import_graph_def(graph_def, name="")
+
+    def _restore_fn(sess):  # pylint: disable=unused-argument
+      tf.logging.info("Model variables are constants in: %s",
+                      os.path.basename(frozen_graph_file))
+
+    return _restore_fn
+
   def feed_image(self, sess, encoded_image):
     """Feeds an image and returns the initial model state.
 
@@ -161,6 +218,22 @@ class InferenceWrapperBase(object):
     """
     tf.logging.fatal("Please implement feed_image in subclass")
 
+  def feed_images(self, sess, encoded_images):
+    """Feeds a batch of images and returns their initial model states.
+
+    See comments at the top of file.
+
+    Args:
+      sess: TensorFlow Session object.
+      encoded_images: A list of encoded image strings.
+
+    Returns:
+      state: A numpy array of shape [len(encoded_images), state_size].
+    """
+    return np.concatenate(
+        [self.feed_image(sess, encoded_image)
+         for encoded_image in encoded_images])
+
   def inference_step(self, sess, input_feed, state_feed):
     """Runs one step of inference.
 
@@ -0,0 +1,94 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Benchmarks the per-call overhead of InferenceWrapper.
+
+Compares Session.run() with string fetches and a feed_dict against the
+callables made by InferenceWrapper, on the inference graph of the default
+ModelConfig with randomly initialized variables.
+
+Run with:
+  python inference_wrapper_benchmark.py --benchmarks=.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+
+import numpy as np
+import tensorflow as tf
+
+import configuration
+import inference_wrapper
+
+
+class InferenceStepOverheadBenchmark(tf.test.Benchmark):
+  """Measures inference_step() latency with and without callables."""
+
+  def _time(self, name, fn, iters):
+    fn()  # Warm up.
+    start = time.time()
+    for _ in range(iters):
+      fn()
+    wall_time = (time.time() - start) / iters
+    self.report_benchmark(iters=iters, wall_time=wall_time, name=name)
+    return wall_time
+
+  def _benchmark_beam_size(self, beam_size, iters=500):
+    model_config = configuration.ModelConfig()
+    g = tf.Graph()
+    with g.as_default():
+      model = inference_wrapper.InferenceWrapper()
+      model.build_model(model_config)
+      init = tf.global_variables_initializer()
+
+    rng = np.random.RandomState(0)
+    input_feed = rng.randint(0, model_config.vocab_size, size=beam_size)
+    state_feed = rng.rand(beam_size,
+                          2 * model_config.num_lstm_units).astype(np.float32)
+
+    with tf.Session(graph=g) as sess:
+      sess.run(init)
+
+      def _session_run():
+        sess.run(fetches=["softmax:0", "lstm/state:0"],
+                 feed_dict={
+                     "input_feed:0": input_feed,
+                     "lstm/state_feed:0": state_feed,
+                 })
+
+      def _callable():
+        model.inference_step(sess, input_feed, state_feed)
+
+      run_time = self._time("session_run_beam_%d" % beam_size, _session_run,
+                            iters)
+      callable_time = self._time("callable_beam_%d" % beam_size, _callable,
+                                 iters)
+    tf.logging.info("beam_size=%d: %.3f ms -> %.3f ms per step (%.3f ms saved)",
+                    beam_size, run_time * 1e3, callable_time * 1e3,
+                    (run_time - callable_time) * 1e3)
+
+  def benchmark_beam_1(self):
+    self._benchmark_beam_size(1)
+
+  def benchmark_beam_3(self):
+    self._benchmark_beam_size(3)
+
+
+if __name__ == "__main__":
+  tf.logging.set_verbosity(tf.logging.INFO)
+  tf.test.main()
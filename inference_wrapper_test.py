@@ -0,0 +1,67 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for inference_wrapper."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+
+import numpy as np
+import tensorflow as tf
+
+import configuration
+import inference_wrapper
+
+
+class InferenceWrapperTest(tf.test.TestCase):
+
+  def _encodedImages(self, num_images):
+    """Returns num_images distinct encoded JPEG images."""
+    with tf.Graph().as_default(), self.test_session() as sess:
+      images = tf.placeholder(tf.uint8, shape=[None, None, 3])
+      encoded = tf.image.encode_jpeg(images)
+      return [sess.run(encoded,
+                       {images: np.full([32, 48, 3], 50 * i, dtype=np.uint8)})
+              for i in range(num_images)]
+
+  def testFeedImages(self):
+    encoded_images = self._encodedImages(3)
+    model = inference_wrapper.InferenceWrapper()
+    with tf.Graph().as_default():
+      model.build_model(configuration.ModelConfig())
+      with self.test_session() as sess:
+        sess.run(tf.global_variables_initializer())
+        initial_states = model.feed_images(sess, encoded_images)
+        self.assertEqual((3, 1024), initial_states.shape)
+        for i, encoded_image in enumerate(encoded_images):
+          self.assertAllClose(model.feed_image(sess, encoded_image)[0],
+                              initial_states[i], atol=1e-4)
+
+  def testFeedImagesWithoutImagesFeed(self):
+    # The graph of a GraphDef exported before images_feed existed.
+    model = inference_wrapper.InferenceWrapper()
+    with tf.Graph().as_default():
+      image_feed = tf.placeholder(tf.string, shape=[], name="image_feed")
+      tf.reshape(tf.string_to_number(image_feed), [1, 1],
+                 name="lstm/initial_state")
+      with self.test_session() as sess:
+        self.assertAllEqual([[1.0], [2.0], [3.0]],
+                            model.feed_images(sess, [b"1", b"2", b"3"]))
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -51,6 +51,49 @@ def parse_sequence_example(serialized, image_feature, caption_feature):
   return encoded_image, caption
 
 
+def parse_feature_sequence_example(serialized, feature_name, feature_size,
+                                   caption_feature):
+  """Parses a tensorflow.SequenceExample into image features and caption.
+
+  Args:
+    serialized: A scalar string Tensor; a single serialized SequenceExample.
+    feature_name: Name of SequenceExample context feature containing the
+      precomputed image features.
+    feature_size: Number of image features.
+    caption_feature: Name of SequenceExample feature list containing integer
+      captions.
+
+  Returns:
+    features: A float32 Tensor of shape [feature_size].
+    caption: A 1-D uint64 Tensor with dynamically specified length.
+  """
+  context, sequence = tf.parse_single_sequence_example(
+      serialized,
+      context_features={
+          feature_name: tf.FixedLenFeature([feature_size], dtype=tf.float32)
+      },
+      sequence_features={
+          caption_feature: tf.FixedLenSequenceFeature([], dtype=tf.int64),
+      })
+
+  features = context[feature_name]
+  caption = sequence[caption_feature]
+  return features, caption
+
+
+def _list_data_files(file_pattern):
+  """Returns the files matching a comma-separated list of file patterns."""
+  data_files = []
+  for pattern in file_pattern.split(","):
+    data_files.extend(tf.gfile.Glob(pattern))
+  if not data_files:
+    tf.logging.fatal("Found no input files matching %s", file_pattern)
+  else:
+    tf.logging.info("Prefetching values from %d files matching %s",
+                    len(data_files), file_pattern)
+  return data_files
+
+
 def prefetch_input_data(reader,
                         file_pattern,
                         is_training,
@@ -84,14 +127,7 @@ def prefetch_input_data(reader,
   Returns:
     A Queue containing prefetched string values.
   """
-  data_files = []
-  for pattern in file_pattern.split(","):
-    data_files.extend(tf.gfile.Glob(pattern))
-  if not data_files:
-    tf.logging.fatal("Found no input files matching %s", file_pattern)
-  else:
-    tf.logging.info("Prefetching values from %d files matching %s",
-                    len(data_files), file_pattern)
+  data_files = _list_data_files(file_pattern)
 
   if is_training:
     filename_queue = tf.train.string_input_producer(
@@ -180,12 +216,7 @@ def batch_with_dynamic_pad(images_and_captions,
   """
   enqueue_list = []
   for image, caption in images_and_captions:
-    caption_length = tf.shape(caption)[0]
-    input_length = tf.expand_dims(tf.subtract(caption_length, 1), 0)
-
-    input_seq = tf.slice(caption, [0], input_length)
-    target_seq = tf.slice(caption, [1], input_length)
-    indicator = tf.ones(input_length, dtype=tf.int32)
+    input_seq, target_seq, indicator = _split_caption(caption)
     enqueue_list.append([image, input_seq, target_seq, indicator])
 
   images, input_seqs, target_seqs, mask = tf.train.batch_join(
@@ -196,9 +227,186 @@ def batch_with_dynamic_pad(images_and_captions,
       name="batch_and_pad")
 
   if add_summaries:
-    lengths = tf.add(tf.reduce_sum(mask, 1), 1)
-    tf.summary.scalar("caption_length/batch_min", tf.reduce_min(lengths))
-    tf.summary.scalar("caption_length/batch_max", tf.reduce_max(lengths))
-    tf.summary.scalar("caption_length/batch_mean", tf.reduce_mean(lengths))
+    _add_caption_length_summaries(mask)
+
+  return images, input_seqs, target_seqs, mask
+
+
+def _split_caption(caption):
+  """Splits a caption into input and target sequences and an indicator."""
+  caption_length = tf.shape(caption)[0]
+  input_length = tf.expand_dims(tf.subtract(caption_length, 1), 0)
+
+  input_seq = tf.slice(caption, [0], input_length)
+  target_seq = tf.slice(caption, [1], input_length)
+  indicator = tf.ones(input_length, dtype=tf.int32)
+  return input_seq, target_seq, indicator
+
+
+def _add_caption_length_summaries(mask):
+  """Adds summaries of the caption lengths and padding in a batch."""
+  lengths = tf.add(tf.reduce_sum(mask, 1), 1)
+  tf.summary.scalar("caption_length/batch_min", tf.reduce_min(lengths))
+  tf.summary.scalar("caption_length/batch_max", tf.reduce_max(lengths))
+  tf.summary.scalar("caption_length/batch_mean", tf.reduce_mean(lengths))
+  # Fraction of the LSTM and softmax steps in the batch spent on padding.
+  tf.summary.scalar(
+      "caption_length/padding_fraction",
+      1.0 - tf.reduce_sum(tf.to_float(mask)) / tf.to_float(tf.size(mask)))
+
+
+def batch_with_buckets(images_and_captions,
+                       batch_size,
+                       bucket_boundaries,
+                       add_summaries=True):
+  """Batches input images and captions of similar lengths.
+
+  Like batch_with_dynamic_pad(), but each batch is drawn from one bucket of
+  input sequence lengths, so less of it is padding.
+
+  Args:
+    images_and_captions: A list of pairs [image, caption], where image is a
+      Tensor of static shape and caption is a 1-D Tensor of any length. Each
+      pair will be processed and added to the queue in a separate thread.
+    batch_size: Batch size.
+    bucket_boundaries: Increasing list of input sequence lengths (caption
+      lengths minus 1). Bucket i holds the sequences with lengths in
+      [bucket_boundaries[i-1], bucket_boundaries[i]).
+    add_summaries: If true, add caption length summaries.
+
+  Returns:
+    images: A Tensor of shape [batch_size] + image shape.
+    input_seqs: An int64 Tensor of shape [batch_size, padded_length].
+    target_seqs: An int64 Tensor of shape [batch_size, padded_length].
+    mask: An int32 0/1 Tensor of shape [batch_size, padded_length].
+  """
+  enqueue_list = []
+  for image, caption in images_and_captions:
+    input_seq, target_seq, indicator = _split_caption(caption)
+    enqueue_list.append([image, input_seq, target_seq, indicator])
+
+  # Merge the preprocessing threads into a single queue of examples.
+  examples_queue = tf.PaddingFIFOQueue(
+      capacity=2 * batch_size,
+      dtypes=[t.dtype for t in enqueue_list[0]],
+      shapes=[t.get_shape() for t in enqueue_list[0]],
+      name="examples_queue")
+  tf.train.queue_runner.add_queue_runner(tf.train.queue_runner.QueueRunner(
+      examples_queue, [examples_queue.enqueue(e) for e in enqueue_list]))
+  example = examples_queue.dequeue()
+
+  _, (images, input_seqs, target_seqs, mask) = (
+      tf.contrib.training.bucket_by_sequence_length(
+          input_length=tf.shape(example[1])[0],
+          tensors=example,
+          batch_size=batch_size,
+          bucket_boundaries=bucket_boundaries,
+          num_threads=2,
+          capacity=2 * batch_size,
+          dynamic_pad=True,
+          name="bucket_and_pad"))
+
+  if add_summaries:
+    _add_caption_length_summaries(mask)
+
+  return images, input_seqs, target_seqs, mask
+
+
+def batch_dataset_with_dynamic_pad(file_pattern,
+                                   parse_fn,
+                                   is_training,
+                                   batch_size,
+                                   values_per_shard,
+                                   input_queue_capacity_factor=16,
+                                   num_reader_threads=1,
+                                   num_parallel_calls=4,
+                                   prefetch_batches=2,
+                                   bucket_boundaries=None,
+                                   add_summaries=True):
+  """Reads, processes and batches input images and captions with tf.data.
+
+  This is a replacement for prefetch_input_data() followed by
+  batch_with_dynamic_pad() that needs no queue runners. The pipeline is:
+
+    1. Shards are read in parallel and their records interleaved. In training
+       the shard order is shuffled every epoch.
+    2. In training, records are shuffled in a buffer of
+       values_per_shard * input_queue_capacity_factor records, the same as the
+       minimum size of the RandomShuffleQueue of prefetch_input_data().
+    3. Records are parsed and processed by num_parallel_calls parallel calls
+       of parse_fn.
+    4. Captions are split into input and target sequences and batched with
+       padding as in batch_with_dynamic_pad(), or, if bucket_boundaries is
+       given, as in batch_with_buckets().
+    5. prefetch_batches batches are prepared ahead of the consumer.
+
+  The data is repeated indefinitely, as by prefetch_input_data().
+
+  Args:
+    file_pattern: Comma-separated list of file patterns (e.g.
+        /tmp/train_data-?????-of-00100).
+    parse_fn: Function that takes a scalar string Tensor holding a serialized
+      SequenceExample and returns a pair (image, caption), where image is a
+      Tensor of static shape and caption is a 1-D Tensor of any length.
+      parse_fn must not add summaries.
+    is_training: Boolean; whether reading for training or eval.
+    batch_size: Batch size.
+    values_per_shard: Approximate number of values per shard.
+    input_queue_capacity_factor: Minimum number of values to keep in the
+      shuffle buffer in multiples of values_per_shard.
+    num_reader_threads: Number of shards read in parallel.
+    num_parallel_calls: Number of records parsed and processed in parallel.
+    prefetch_batches: Number of batches to prefetch.
+    bucket_boundaries: Optional increasing list of input sequence lengths
+      (caption lengths minus 1). If given, each batch is drawn from one bucket
+      of lengths, as in batch_with_buckets().
+    add_summaries: If true, add caption length summaries.
+
+  Returns:
+    images: A Tensor of shape [batch_size] + image shape.
+    input_seqs: An int64 Tensor of shape [batch_size, padded_length].
+    target_seqs: An int64 Tensor of shape [batch_size, padded_length].
+    mask: An int32 0/1 Tensor of shape [batch_size, padded_length].
+  """
+  data_files = _list_data_files(file_pattern)
+
+  files = tf.data.Dataset.from_tensor_slices(data_files)
+  if is_training:
+    files = files.shuffle(len(data_files))
+  files = files.repeat()
+  dataset = files.apply(tf.contrib.data.parallel_interleave(
+      tf.data.TFRecordDataset,
+      cycle_length=num_reader_threads,
+      sloppy=is_training))
+  if is_training:
+    dataset = dataset.shuffle(values_per_shard * input_queue_capacity_factor)
+
+  def _parse_and_split(serialized):
+    image, caption = parse_fn(serialized)
+    input_seq, target_seq, indicator = _split_caption(caption)
+    return image, input_seq, target_seq, indicator
+
+  dataset = dataset.map(_parse_and_split,
+                        num_parallel_calls=num_parallel_calls)
+  padded_shapes = (dataset.output_shapes[0], [None], [None], [None])
+  if bucket_boundaries:
+    dataset = dataset.apply(tf.contrib.data.bucket_by_sequence_length(
+        lambda *example: tf.shape(example[1])[0],
+        bucket_boundaries=bucket_boundaries,
+        bucket_batch_sizes=[batch_size] * (len(bucket_boundaries) + 1),
+        padded_shapes=padded_shapes))
+  else:
+    dataset = dataset.padded_batch(batch_size, padded_shapes=padded_shapes)
+  dataset = dataset.prefetch(prefetch_batches)
+
+  images, input_seqs, target_seqs, mask = (
+      dataset.make_one_shot_iterator().get_next())
+  # The data repeats indefinitely, so every batch is full.
+  images.set_shape([batch_size] + padded_shapes[0].as_list())
+  for t in (input_seqs, target_seqs, mask):
+    t.set_shape([batch_size, None])
+
+  if add_summaries:
+    _add_caption_length_summaries(mask)
 
   return images, input_seqs, target_seqs, mask
@@ -0,0 +1,121 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Benchmarks the training input pipelines of ShowAndTellModel.
+
+Compares the throughput of the queue runner and tf.data pipelines on synthetic
+TFRecord shards with JPEG images and captions of random lengths.
+
+Run with:
+  python inputs_benchmark.py --benchmarks=.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+
+
+import numpy as np
+import tensorflow as tf
+
+import configuration
+import show_and_tell_model
+
+
+def _write_shards(output_dir, num_shards, values_per_shard):
+  """Writes synthetic SequenceExample shards and returns their file pattern."""
+  rng = np.random.RandomState(0)
+  g = tf.Graph()
+  with g.as_default():
+    image = tf.placeholder(tf.uint8, [300, 400, 3])
+    encode = tf.image.encode_jpeg(image)
+  with tf.Session(graph=g) as sess:
+    for shard in range(num_shards):
+      filename = os.path.join(output_dir,
+                              "train-%.5d-of-%.5d" % (shard, num_shards))
+      writer = tf.python_io.TFRecordWriter(filename)
+      for _ in range(values_per_shard):
+        encoded_image = sess.run(encode, feed_dict={
+            image: rng.randint(0, 256, size=[300, 400, 3])
+        })
+        caption_ids = rng.randint(1, 12000, size=rng.randint(3, 30))
+        example = tf.train.SequenceExample(
+            context=tf.train.Features(feature={
+                "image/data": tf.train.Feature(
+                    bytes_list=tf.train.BytesList(value=[encoded_image])),
+            }),
+            feature_lists=tf.train.FeatureLists(feature_list={
+                "image/caption_ids": tf.train.FeatureList(feature=[
+                    tf.train.Feature(int64_list=tf.train.Int64List(value=[v]))
+                    for v in caption_ids
+                ]),
+            }))
+        writer.write(example.SerializeToString())
+      writer.close()
+  return os.path.join(output_dir, "train-?????-of-%.5d" % num_shards)
+
+
+class InputPipelineBenchmark(tf.test.Benchmark):
+  """Measures training examples per second of each input pipeline."""
+
+  def _run(self, file_pattern, input_pipeline, num_batches=50):
+    model_config = configuration.ModelConfig()
+    model_config.input_file_pattern = file_pattern
+    model_config.input_pipeline = input_pipeline
+    model_config.values_per_input_shard = 100
+    model_config.num_input_reader_threads = 4
+
+    g = tf.Graph()
+    with g.as_default():
+      model = show_and_tell_model.ShowAndTellModel(model_config, mode="train")
+      model.build_inputs()
+      fetches = [model.images, model.input_seqs, model.target_seqs,
+                 model.input_mask]
+
+    with tf.Session(graph=g) as sess:
+      coord = tf.train.Coordinator()
+      threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+      sess.run(fetches)  # Warm up, filling the shuffle buffer.
+      start = time.time()
+      for _ in range(num_batches):
+        sess.run(fetches)
+      wall_time = (time.time() - start) / num_batches
+      coord.request_stop()
+      coord.join(threads)
+
+    examples_per_sec = model_config.batch_size / wall_time
+    self.report_benchmark(iters=num_batches, wall_time=wall_time,
+                          name="%s_input_pipeline" % input_pipeline,
+                          extras={"examples_per_sec": examples_per_sec})
+    return examples_per_sec
+
+  def benchmark_input_pipelines(self):
+    output_dir = os.path.join(tf.test.get_temp_dir(), "inputs_benchmark")
+    if not tf.gfile.IsDirectory(output_dir):
+      tf.gfile.MakeDirs(output_dir)
+    file_pattern = _write_shards(output_dir, num_shards=8, values_per_shard=100)
+
+    queue_rate = self._run(file_pattern, "queue")
+    dataset_rate = self._run(file_pattern, "dataset")
+    tf.logging.info("queue: %.1f examples/sec, dataset: %.1f examples/sec "
+                    "(%.2fx)", queue_rate, dataset_rate,
+                    dataset_rate / queue_rate)
+
+
+if __name__ == "__main__":
+  tf.logging.set_verbosity(tf.logging.INFO)
+  tf.test.main()
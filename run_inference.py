@@ -20,13 +20,16 @@ from __future__ import print_function
 
 import math
 import os
+import time
 
 
 import tensorflow as tf
 
 import configuration
-import inference_wrapper
+import embedding_cache
+import inference_pipeline
 import caption_generator
+import show_and_tell_model
 import vocabulary
 
 FLAGS = tf.flags.FLAGS
@@ -34,52 +37,166 @@ FLAGS = tf.flags.FLAGS
 tf.flags.DEFINE_string("checkpoint_path", "",
                        "Model checkpoint file or directory containing a "
                        "model checkpoint file.")
+tf.flags.DEFINE_string("frozen_graph", "",
+                       "Optional frozen graph written by export_frozen_graph.py "
+                       "to use instead of --checkpoint_path.")
 tf.flags.DEFINE_string("vocab_file", "", "Text file containing the vocabulary.")
 tf.flags.DEFINE_string("input_files", "",
                        "File pattern or comma-separated list of file patterns "
                        "of image files.")
+tf.flags.DEFINE_string("lstm_implementation", "basic",
+                       "LSTM cell implementation: basic or block. Checkpoints "
+                       "of either implementation can be loaded.")
+tf.flags.DEFINE_integer("batch_size", 1,
+                        "Number of images whose beams are decoded together.")
+tf.flags.DEFINE_string("embedding_cache_dir", "",
+                       "Optional directory of a persistent cache of image "
+                       "states keyed by image content.")
+tf.flags.DEFINE_integer("embedding_cache_memory_size", 0,
+                        "Number of recently used cached image states to also "
+                        "keep in memory.")
+tf.flags.DEFINE_string("output_jsonl", "",
+                       "If set, stream one JSON record per image to this file "
+                       "(\"-\" for stdout) while input files are still being "
+                       "listed and read.")
+tf.flags.DEFINE_integer("num_reader_threads", 8,
+                        "Number of threads reading image files in streaming "
+                        "mode.")
+tf.flags.DEFINE_integer("prefetch_capacity", 64,
+                        "Maximum number of images read ahead in streaming "
+                        "mode.")
+tf.flags.DEFINE_integer("num_workers", 1,
+                        "If > 1, caption in this many worker processes, each "
+                        "with its own Session and a share of the CPU cores.")
 
 tf.logging.set_verbosity(tf.logging.INFO)
 
 
+def run_streaming(sess, generator, vocab):
+  """Captions images as they are read and writes JSONL records."""
+  images = inference_pipeline.prefetch_images(
+      inference_pipeline.iter_filenames(FLAGS.input_files),
+      num_threads=FLAGS.num_reader_threads,
+      capacity=FLAGS.prefetch_capacity)
+  writer = inference_pipeline.JsonlWriter(FLAGS.output_jsonl)
+  num_images = 0
+  start_time = time.time()
+  try:
+    for filename, captions, timings in inference_pipeline.caption_images(
+        sess, generator, images, batch_size=FLAGS.batch_size):
+      writer.write({
+          "filename": filename,
+          "captions": [inference_pipeline.caption_to_dict(c, vocab)
+                       for c in captions],
+          "timings": timings,
+      })
+      num_images += 1
+      if not num_images % 1000:
+        tf.logging.info("Captioned %d images (%.1f images/sec)", num_images,
+                        num_images / (time.time() - start_time))
+  finally:
+    writer.close()
+  tf.logging.info("Captioned %d images matching %s in %.1f sec", num_images,
+                  FLAGS.input_files, time.time() - start_time)
+
+
+def run_workers(model_config):
+  """Captions images in worker processes and prints results in input order."""
+  if FLAGS.embedding_cache_dir:
+    raise ValueError(
+        "--embedding_cache_dir is not supported with --num_workers > 1")
+  results = inference_pipeline.caption_files_in_workers(
+      inference_pipeline.iter_filenames(FLAGS.input_files),
+      num_workers=FLAGS.num_workers,
+      model_config=model_config,
+      checkpoint_path=FLAGS.checkpoint_path,
+      vocab_file=FLAGS.vocab_file,
+      batch_size=FLAGS.batch_size,
+      capacity=FLAGS.prefetch_capacity,
+      frozen_graph_file=FLAGS.frozen_graph)
+  if FLAGS.output_jsonl:
+    writer = inference_pipeline.JsonlWriter(FLAGS.output_jsonl)
+    try:
+      for filename, captions, timings in results:
+        writer.write({"filename": filename, "captions": captions,
+                      "timings": timings})
+    finally:
+      writer.close()
+  else:
+    for filename, captions, _ in results:
+      print("Captions for image %s:" % os.path.basename(filename))
+      for i, caption in enumerate(captions):
+        print("  %d) %s (p=%f)" % (i, caption["sentence"],
+                                   math.exp(caption["logprob"])))
+
+
 def main(_):
-  # Build the inference graph.
-  g = tf.Graph()
-  with g.as_default():
-    model = inference_wrapper.InferenceWrapper()
-    restore_fn = model.build_graph_from_config(configuration.ModelConfig(),
-                                               FLAGS.checkpoint_path)
-  g.finalize()
-
-  # Create the vocabulary.
+  # Create the vocabulary, and build the model with the vocabulary size of the
+  # checkpoint, which may be larger than the vocabulary file.
   vocab = vocabulary.Vocabulary(FLAGS.vocab_file)
+  model_config = configuration.ModelConfig()
+  model_config.lstm_implementation = FLAGS.lstm_implementation
+  if not FLAGS.frozen_graph:
+    model_config.vocab_size = inference_pipeline.checkpoint_vocab_size(
+        FLAGS.checkpoint_path)
+    model_config.logits_weights_vocab_major = (
+        show_and_tell_model.checkpoint_logits_vocab_major(
+            FLAGS.checkpoint_path))
+
+  if FLAGS.num_workers > 1:
+    # Build the graphs in the workers only; the parent holds no Session.
+    run_workers(model_config)
+    return
 
-  filenames = []
-  for file_pattern in FLAGS.input_files.split(","):
-    filenames.extend(tf.gfile.Glob(file_pattern))
-  tf.logging.info("Running caption generation on %d files matching %s",
-                  len(filenames), FLAGS.input_files)
+  # Build the inference graph.
+  g, model, restore_fn = inference_pipeline.build_inference_graph(
+      model_config, FLAGS.checkpoint_path, FLAGS.frozen_graph)
 
   with tf.Session(graph=g) as sess:
     # Load the model from checkpoint.
     restore_fn(sess)
 
+    if FLAGS.embedding_cache_dir:
+      cache = embedding_cache.EmbeddingCache(
+          FLAGS.embedding_cache_dir,
+          memory_cache_size=FLAGS.embedding_cache_memory_size,
+          model_id=embedding_cache.model_identity(FLAGS.checkpoint_path,
+                                                  FLAGS.frozen_graph))
+      model = embedding_cache.CachingModel(model, cache)
+
     # Prepare the caption generator. Here we are implicitly using the default
     # beam search parameters. See caption_generator.py for a description of the
     # available beam search parameters.
     generator = caption_generator.CaptionGenerator(model, vocab)
 
-    for filename in filenames:
-      with tf.gfile.GFile(filename, "r") as f:
-        image = f.read()
-      captions = generator.beam_search(sess, image)
-      print("Captions for image %s:" % os.path.basename(filename))
-      for i, caption in enumerate(captions):
-        # Ignore begin and end words.
-        sentence = [vocab.id_to_word(w) for w in caption.sentence[1:-1]]
-        sentence = " ".join(sentence)
-        print("  %d) %s (p=%f)" % (i, sentence, math.exp(caption.logprob)))
-
+    if FLAGS.output_jsonl:
+      run_streaming(sess, generator, vocab)
+    else:
+      filenames = []
+      for file_pattern in FLAGS.input_files.split(","):
+        filenames.extend(tf.gfile.Glob(file_pattern))
+      tf.logging.info("Running caption generation on %d files matching %s",
+                      len(filenames), FLAGS.input_files)
+
+      for begin in range(0, len(filenames), FLAGS.batch_size):
+        batch_filenames = filenames[begin:begin + FLAGS.batch_size]
+        images = []
+        for filename in batch_filenames:
+          with tf.gfile.GFile(filename, "rb") as f:
+            images.append(f.read())
+        batch_captions = generator.beam_search_batch(sess, images)
+        for filename, captions in zip(batch_filenames, batch_captions):
+          print("Captions for image %s:" % os.path.basename(filename))
+          for i, caption in enumerate(captions):
+            # Ignore begin and end words.
+            sentence = [vocab.id_to_word(w) for w in caption.sentence[1:-1]]
+            sentence = " ".join(sentence)
+            print("  %d) %s (p=%f)" % (i, sentence, math.exp(caption.logprob)))
+
+    if FLAGS.embedding_cache_dir:
+      cache.flush()
+      tf.logging.info("Embedding cache: %d hits (%d in memory), %d misses",
+                      cache.hits, cache.memory_hits, cache.misses)
 
 if __name__ == "__main__":
   tf.app.run()
@@ -30,6 +30,76 @@ import image_embedding
 import image_processing
 import inputs as input_ops
 
+# Variable scope of the LSTM cell of each ModelConfig.lstm_implementation,
+# within the "lstm" scope. Both cells have the same "kernel" and "bias"
+# variables: the gates are ordered i, j, f, o and the forget bias is 1.0.
+LSTM_CELL_SCOPES = {
+    "basic": "basic_lstm_cell",
+    "block": "lstm_cell",
+}
+
+
+def checkpoint_var_list(variables, checkpoint_path):
+  """Maps checkpoint variable names to model variables for a Saver.
+
+  LSTM variables that are missing from the checkpoint are mapped to the names
+  of the other LSTM implementation, so that a checkpoint trained with either
+  lstm_implementation loads into a model built with the other one.
+
+  Args:
+    variables: List of model variables.
+    checkpoint_path: Checkpoint file, a directory containing a checkpoint file,
+      or None.
+
+  Returns:
+    A dict mapping checkpoint variable names to variables, or None (meaning
+    the default variable names) if there is no checkpoint.
+  """
+  if checkpoint_path and tf.gfile.IsDirectory(checkpoint_path):
+    checkpoint_path = tf.train.latest_checkpoint(checkpoint_path)
+  if not checkpoint_path:
+    return None
+
+  checkpoint_names = set(
+      tf.train.NewCheckpointReader(checkpoint_path).get_variable_to_shape_map())
+  cell_scopes = set(LSTM_CELL_SCOPES.values())
+  var_list = {}
+  for var in variables:
+    name = var.op.name
+    parts = name.split("/")
+    if (name not in checkpoint_names and len(parts) > 2 and
+        parts[0] == "lstm" and parts[1] in cell_scopes):
+      for scope in cell_scopes:
+        candidate = "/".join(["lstm", scope] + parts[2:])
+        if candidate in checkpoint_names:
+          name = candidate
+          break
+    var_list[name] = var
+  return var_list
+
+
+def checkpoint_logits_vocab_major(checkpoint_path, default=False):
+  """Returns whether a checkpoint stores its logits weights vocab-major.
+
+  Args:
+    checkpoint_path: Checkpoint file, a directory containing a checkpoint file,
+      or None.
+    default: Value returned if there is no checkpoint.
+
+  Returns:
+    True if the logits/weights variable of the checkpoint has shape
+    [vocab_size, num_lstm_units], see ModelConfig.logits_weights_vocab_major.
+  """
+  if checkpoint_path and tf.gfile.IsDirectory(checkpoint_path):
+    checkpoint_path = tf.train.latest_checkpoint(checkpoint_path)
+  if not checkpoint_path:
+    return default
+  shapes = tf.train.NewCheckpointReader(
+      checkpoint_path).get_variable_to_shape_map()
+  if "logits/weights" not in shapes:
+    return default
+  return shapes["logits/weights"][0] == shapes["seq_embedding/map"][0]
+
 
 class ShowAndTellModel(object):
   """Image-to-text implementation based on http://arxiv.org/abs/1411.4555.
@@ -47,6 +117,10 @@ class ShowAndTellModel(object):
       train_inception: Whether the inception submodel variables are trainable.
     """
     assert mode in ["train", "eval", "inference"]
+    assert config.training_loss in ["softmax", "sampled_softmax", "nce"]
+    assert config.lstm_implementation in LSTM_CELL_SCOPES
+    assert not (train_inception and config.use_inception_features), (
+        "Precomputed Inception features require train_inception=False")
     self.config = config
     self.mode = mode
     self.train_inception = train_inception
@@ -63,6 +137,11 @@ class ShowAndTellModel(object):
     # A float32 Tensor with shape [batch_size, height, width, channels].
     self.images = None
 
+    # A float32 Tensor with shape [batch_size, inception_feature_size]; the
+    # precomputed InceptionV3 output. Only set if config.use_inception_features
+    # is True in training and evaluation, in which case self.images is None.
+    self.inception_features = None
+
     # An int32 Tensor with shape [batch_size, padded_length].
     self.input_seqs = None
 
@@ -100,47 +179,131 @@ class ShowAndTellModel(object):
     """Returns true if the model is built for training mode."""
     return self.mode == "train"
 
-  def process_image(self, encoded_image, thread_id=0):
+  def process_image(self, encoded_image, thread_id=0, add_summaries=True):
     """Decodes and processes an image string.
 
     Args:
       encoded_image: A scalar string Tensor; the encoded image.
       thread_id: Preprocessing thread id used to select the ordering of color
         distortions.
+      add_summaries: If true, add image summaries (except in inference mode).
 
     Returns:
       A float32 Tensor of shape [height, width, 3]; the processed image.
     """
-    return image_processing.process_image(encoded_image,
-                                          is_training=self.is_training(),
-                                          height=self.config.image_height,
-                                          width=self.config.image_width,
-                                          thread_id=thread_id,
-                                          image_format=self.config.image_format)
+    image_format = self.config.image_format
+    stored_height = self.config.stored_image_height
+    stored_width = self.config.stored_image_width
+    if self.mode == "inference":
+      # Inference reads original encoded images.
+      if image_format == "raw":
+        image_format = "jpeg"
+      stored_height = stored_width = 0
+    return image_processing.process_image(
+        encoded_image,
+        is_training=self.is_training(),
+        height=self.config.image_height,
+        width=self.config.image_width,
+        thread_id=thread_id,
+        image_format=image_format,
+        # Summaries cannot be fetched from inside the inference tf.map_fn.
+        add_summaries=add_summaries and self.mode != "inference",
+        stored_height=stored_height,
+        stored_width=stored_width)
+
+  def _parse_and_process(self, serialized_sequence_example, thread_id,
+                         add_summaries=True):
+    """Parses a SequenceExample into a processed image and a caption.
+
+    If config.use_inception_features is True, the "image" is the precomputed
+    InceptionV3 output.
+
+    Args:
+      serialized_sequence_example: A scalar string Tensor.
+      thread_id: Preprocessing thread id passed to process_image().
+      add_summaries: If true, add image summaries.
+
+    Returns:
+      image: A float32 Tensor; the processed image or InceptionV3 output.
+      caption: A 1-D int64 Tensor with dynamically specified length.
+    """
+    if self.config.use_inception_features:
+      # Precomputed InceptionV3 outputs need no image processing.
+      return input_ops.parse_feature_sequence_example(
+          serialized_sequence_example,
+          feature_name=self.config.inception_feature_name,
+          feature_size=self.config.inception_feature_size,
+          caption_feature=self.config.caption_feature_name)
+    encoded_image, caption = input_ops.parse_sequence_example(
+        serialized_sequence_example,
+        image_feature=self.config.image_feature_name,
+        caption_feature=self.config.caption_feature_name)
+    image = self.process_image(encoded_image, thread_id=thread_id,
+                               add_summaries=add_summaries)
+    return image, caption
 
   def build_inputs(self):
     """Input prefetching, preprocessing and batching.
 
     Outputs:
-      self.images
+      self.images (unless self.inception_features is set)
+      self.inception_features (training and eval with precomputed features)
       self.input_seqs
       self.target_seqs (training and eval only)
       self.input_mask (training and eval only)
     """
+    inception_features = None
     if self.mode == "inference":
-      # In inference mode, images and inputs are fed via placeholders.
+      # In inference mode, images and inputs are fed via placeholders. A batch
+      # of images may be fed via "images_feed"; if it is not fed, it holds the
+      # single image fed via "image_feed".
       image_feed = tf.placeholder(dtype=tf.string, shape=[], name="image_feed")
+      images_feed = tf.placeholder_with_default(
+          tf.expand_dims(image_feed, 0),
+          shape=[None],  # batch_size
+          name="images_feed")
       input_feed = tf.placeholder(dtype=tf.int64,
                                   shape=[None],  # batch_size
                                   name="input_feed")
 
-      # Process image and insert batch dimensions.
-      images = tf.expand_dims(self.process_image(image_feed), 0)
+      # Decode and process the images in parallel.
+      images = tf.map_fn(self.process_image,
+                         images_feed,
+                         dtype=tf.float32,
+                         parallel_iterations=self.config.num_preprocess_threads,
+                         back_prop=False)
       input_seqs = tf.expand_dims(input_feed, 1)
 
       # No target sequences or input mask in inference mode.
       target_seqs = None
       input_mask = None
+    elif self.config.input_pipeline == "dataset":
+      def _parse_fn(serialized_sequence_example):
+        if not self.is_training() or self.config.use_inception_features:
+          return self._parse_and_process(serialized_sequence_example, 0,
+                                         add_summaries=False)
+        # Alternate randomly between the color distortion orderings of the
+        # queue pipeline's preprocessing threads.
+        return tf.cond(
+            tf.equal(tf.random_uniform([], maxval=2, dtype=tf.int32), 0),
+            lambda: self._parse_and_process(serialized_sequence_example, 0,
+                                            add_summaries=False),
+            lambda: self._parse_and_process(serialized_sequence_example, 1,
+                                            add_summaries=False))
+
+      images, input_seqs, target_seqs, input_mask = (
+          input_ops.batch_dataset_with_dynamic_pad(
+              self.config.input_file_pattern,
+              parse_fn=_parse_fn,
+              is_training=self.is_training(),
+              batch_size=self.config.batch_size,
+              values_per_shard=self.config.values_per_input_shard,
+              input_queue_capacity_factor=(
+                  self.config.input_queue_capacity_factor),
+              num_reader_threads=self.config.num_input_reader_threads,
+              num_parallel_calls=self.config.num_preprocess_threads,
+              prefetch_batches=self.config.num_prefetch_batches,
+              bucket_boundaries=self.config.caption_length_boundaries))
     else:
       # Prefetch serialized SequenceExample protos.
       input_queue = input_ops.prefetch_input_data(
@@ -158,22 +321,30 @@ class ShowAndTellModel(object):
       images_and_captions = []
       for thread_id in range(self.config.num_preprocess_threads):
         serialized_sequence_example = input_queue.dequeue()
-        encoded_image, caption = input_ops.parse_sequence_example(
-            serialized_sequence_example,
-            image_feature=self.config.image_feature_name,
-            caption_feature=self.config.caption_feature_name)
-        image = self.process_image(encoded_image, thread_id=thread_id)
-        images_and_captions.append([image, caption])
+        images_and_captions.append(
+            self._parse_and_process(serialized_sequence_example, thread_id))
 
       # Batch inputs.
-      queue_capacity = (2 * self.config.num_preprocess_threads *
-                        self.config.batch_size)
-      images, input_seqs, target_seqs, input_mask = (
-          input_ops.batch_with_dynamic_pad(images_and_captions,
-                                           batch_size=self.config.batch_size,
-                                           queue_capacity=queue_capacity))
+      if self.config.caption_length_boundaries:
+        images, input_seqs, target_seqs, input_mask = (
+            input_ops.batch_with_buckets(
+                images_and_captions,
+                batch_size=self.config.batch_size,
+                bucket_boundaries=self.config.caption_length_boundaries))
+      else:
+        queue_capacity = (2 * self.config.num_preprocess_threads *
+                          self.config.batch_size)
+        images, input_seqs, target_seqs, input_mask = (
+            input_ops.batch_with_dynamic_pad(images_and_captions,
+                                             batch_size=self.config.batch_size,
+                                             queue_capacity=queue_capacity))
+
+    if self.mode != "inference" and self.config.use_inception_features:
+      inception_features = images
+      images = None
 
     self.images = images
+    self.inception_features = inception_features
     self.input_seqs = input_seqs
     self.target_seqs = target_seqs
     self.input_mask = input_mask
@@ -182,15 +353,27 @@ class ShowAndTellModel(object):
     """Builds the image model subgraph and generates image embeddings.
 
     Inputs:
-      self.images
+      self.images or self.inception_features
 
     Outputs:
       self.image_embeddings
     """
-    inception_output = image_embedding.inception_v3(
-        self.images,
-        trainable=self.train_inception,
-        is_training=self.is_training())
+    if self.inception_features is not None:
+      # The InceptionV3 output was precomputed. The InceptionV3 variables are
+      # still created (their ops never run) so that they are restored from the
+      # Inception checkpoint and saved in the model checkpoints for inference.
+      image_embedding.inception_v3(
+          tf.placeholder(tf.float32, [None, self.config.image_height,
+                                      self.config.image_width, 3]),
+          trainable=False,
+          is_training=False,
+          add_summaries=False)
+      inception_output = self.inception_features
+    else:
+      inception_output = image_embedding.inception_v3(
+          self.images,
+          trainable=self.train_inception,
+          is_training=self.is_training())
     self.inception_variables = tf.get_collection(
         tf.GraphKeys.GLOBAL_VARIABLES, scope="InceptionV3")
 
@@ -238,14 +421,20 @@ class ShowAndTellModel(object):
 
     Outputs:
       self.total_loss (training and eval only)
-      self.target_cross_entropy_losses (training and eval only)
+      self.target_cross_entropy_losses (training and eval only; sampled loss
+        estimates in training with config.training_loss != "softmax")
       self.target_cross_entropy_loss_weights (training and eval only)
     """
     # This LSTM cell has biases and outputs tanh(new_c) * sigmoid(o), but the
     # modified LSTM in the "Show and Tell" paper has no biases and outputs
     # new_c * sigmoid(o).
-    lstm_cell = tf.contrib.rnn.BasicLSTMCell(
-        num_units=self.config.num_lstm_units, state_is_tuple=True)
+    if self.config.lstm_implementation == "block":
+      # The same cell, computed by a single fused kernel per step.
+      lstm_cell = tf.contrib.rnn.LSTMBlockCell(
+          num_units=self.config.num_lstm_units)
+    else:
+      lstm_cell = tf.contrib.rnn.BasicLSTMCell(
+          num_units=self.config.num_lstm_units, state_is_tuple=True)
     if self.mode == "train":
       lstm_cell = tf.contrib.rnn.DropoutWrapper(
           lstm_cell,
@@ -254,8 +443,11 @@ class ShowAndTellModel(object):
 
     with tf.variable_scope("lstm", initializer=self.initializer) as lstm_scope:
       # Feed the image embeddings to set the initial LSTM state.
-      zero_state = lstm_cell.zero_state(
-          batch_size=self.image_embeddings.get_shape()[0], dtype=tf.float32)
+      # The batch size is only known statically in training and evaluation.
+      batch_size = self.image_embeddings.get_shape()[0].value
+      if batch_size is None:
+        batch_size = tf.shape(self.image_embeddings)[0]
+      zero_state = lstm_cell.zero_state(batch_size=batch_size, dtype=tf.float32)
       _, initial_state = lstm_cell(self.image_embeddings, zero_state)
 
       # Allow the LSTM variables to be reused.
@@ -292,23 +484,83 @@ class ShowAndTellModel(object):
     # Stack batches vertically.
     lstm_outputs = tf.reshape(lstm_outputs, [-1, lstm_cell.output_size])
 
+    use_sampled_loss = (self.mode == "train" and
+                        self.config.training_loss != "softmax")
+    vocab_major = self.config.logits_weights_vocab_major
     with tf.variable_scope("logits") as logits_scope:
-      logits = tf.contrib.layers.fully_connected(
-          inputs=lstm_outputs,
-          num_outputs=self.config.vocab_size,
-          activation_fn=None,
-          weights_initializer=self.initializer,
-          scope=logits_scope)
+      if use_sampled_loss or vocab_major:
+        # Same variables as fully_connected() below, so that checkpoints are
+        # interchangeable, but the full logits are never computed in training
+        # with a sampled loss.
+        if vocab_major:
+          weights_shape = [self.config.vocab_size, lstm_cell.output_size]
+        else:
+          weights_shape = [lstm_cell.output_size, self.config.vocab_size]
+        logits_weights = tf.get_variable(
+            "weights",
+            shape=weights_shape,
+            initializer=self.initializer)
+        logits_biases = tf.get_variable(
+            "biases",
+            shape=[self.config.vocab_size],
+            initializer=tf.zeros_initializer())
+        if not use_sampled_loss:
+          logits = tf.nn.bias_add(
+              tf.matmul(lstm_outputs, logits_weights, transpose_b=True),
+              logits_biases)
+      else:
+        logits = tf.contrib.layers.fully_connected(
+            inputs=lstm_outputs,
+            num_outputs=self.config.vocab_size,
+            activation_fn=None,
+            weights_initializer=self.initializer,
+            scope=logits_scope)
 
     if self.mode == "inference":
-      tf.nn.softmax(logits, name="softmax")
+      softmax = tf.nn.softmax(logits, name="softmax")
+
+      # The k most probable next words of each partial caption, so that beam
+      # search need not fetch the whole softmax. The shortlist_* outputs
+      # restrict the candidates to the fed word_shortlist; their probabilities
+      # are not renormalized. Equal probabilities are ordered by shortlist
+      # position. Only those outputs gather the shortlisted columns, so the
+      # unrestricted top k does not copy the softmax.
+      with tf.name_scope("top_k"):
+        k = tf.placeholder_with_default(3, shape=[], name="k")
+        values, indices = tf.nn.top_k(softmax, k=k)
+        tf.identity(values, name="values")
+        tf.identity(indices, name="indices")
+
+        word_shortlist = tf.placeholder(
+            tf.int32, shape=[None], name="word_shortlist")
+        values, indices = tf.nn.top_k(
+            tf.gather(softmax, word_shortlist, axis=1),
+            k=tf.minimum(k, tf.size(word_shortlist)))
+        tf.identity(values, name="shortlist_values")
+        tf.gather(word_shortlist, indices, name="shortlist_indices")
     else:
       targets = tf.reshape(self.target_seqs, [-1])
       weights = tf.to_float(tf.reshape(self.input_mask, [-1]))
 
       # Compute losses.
-      losses = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=targets,
-                                                              logits=logits)
+      if use_sampled_loss:
+        if self.config.training_loss == "sampled_softmax":
+          loss_fn = tf.nn.sampled_softmax_loss
+        else:
+          loss_fn = tf.nn.nce_loss
+        if not vocab_major:
+          # Copies the whole matrix at every step; vocab-major weights avoid
+          # it, see ModelConfig.logits_weights_vocab_major.
+          logits_weights = tf.transpose(logits_weights)
+        losses = loss_fn(weights=logits_weights,
+                         biases=logits_biases,
+                         labels=tf.expand_dims(targets, 1),
+                         inputs=lstm_outputs,
+                         num_sampled=self.config.num_sampled_classes,
+                         num_classes=self.config.vocab_size)
+      else:
+        losses = tf.nn.sparse_softmax_cross_entropy_with_logits(
+            labels=targets, logits=logits)
       batch_loss = tf.div(tf.reduce_sum(tf.multiply(losses, weights)),
                           tf.reduce_sum(weights),
                           name="batch_loss")
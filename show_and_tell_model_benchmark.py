@@ -0,0 +1,166 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Benchmarks ShowAndTellModel training and inference steps.
+
+The image model is excluded: the training inputs are random precomputed
+InceptionV3 outputs and random captions, and inference steps are fed random
+words and LSTM states, so only the LSTM and the word prediction layer are timed.
+
+Run with:
+  python show_and_tell_model_benchmark.py --benchmarks=.
+
+Steps/sec is only half of the comparison of training losses. The other half is
+the perplexity reached by evaluate.py (which always uses the full softmax)
+after training the same number of steps with --training_loss=softmax and
+--training_loss=sampled_softmax.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+
+import numpy as np
+import tensorflow as tf
+
+import configuration
+import show_and_tell_model
+
+
+class RandomInputModel(show_and_tell_model.ShowAndTellModel):
+  """ShowAndTellModel with random InceptionV3 outputs and captions."""
+
+  def __init__(self, config, sequence_length=15):
+    config.use_inception_features = True
+    super(RandomInputModel, self).__init__(config, mode="train")
+    self._sequence_length = sequence_length
+
+  def build_inputs(self):
+    self.inception_features = tf.random_uniform(
+        shape=[self.config.batch_size, self.config.inception_feature_size])
+    self.input_seqs = tf.random_uniform(
+        [self.config.batch_size, self._sequence_length],
+        minval=0,
+        maxval=self.config.vocab_size,
+        dtype=tf.int64)
+    self.target_seqs = tf.random_uniform(
+        [self.config.batch_size, self._sequence_length],
+        minval=0,
+        maxval=self.config.vocab_size,
+        dtype=tf.int64)
+    self.input_mask = tf.ones_like(self.input_seqs, dtype=tf.int32)
+
+
+class TrainingStepBenchmark(tf.test.Benchmark):
+  """Measures training steps per second."""
+
+  def _run(self, name, model_config, num_steps=20):
+    g = tf.Graph()
+    with g.as_default():
+      model = RandomInputModel(model_config)
+      model.build()
+      train_op = tf.contrib.layers.optimize_loss(
+          loss=model.total_loss,
+          global_step=model.global_step,
+          learning_rate=2.0,
+          optimizer="SGD",
+          summaries=[])
+
+    with tf.Session(graph=g) as sess:
+      sess.run(tf.global_variables_initializer())
+      sess.run(train_op)  # Warm up.
+      start = time.time()
+      for _ in range(num_steps):
+        sess.run(train_op)
+      wall_time = (time.time() - start) / num_steps
+
+    self.report_benchmark(iters=num_steps, wall_time=wall_time, name=name,
+                          extras={"steps_per_sec": 1.0 / wall_time})
+    return wall_time
+
+  def benchmark_training_loss(self):
+    times = {}
+    for training_loss in ["softmax", "sampled_softmax", "nce"]:
+      for vocab_major in [False, True]:
+        if training_loss == "softmax" and vocab_major:
+          continue
+        model_config = configuration.ModelConfig()
+        model_config.training_loss = training_loss
+        model_config.logits_weights_vocab_major = vocab_major
+        name = training_loss + ("_vocab_major" if vocab_major else "")
+        times[name] = self._run("training_loss_%s" % name, model_config)
+    for name in ["sampled_softmax", "sampled_softmax_vocab_major", "nce",
+                 "nce_vocab_major"]:
+      tf.logging.info("%s: %.1f ms -> %.1f ms per step (%.1fx)", name,
+                      times["softmax"] * 1e3, times[name] * 1e3,
+                      times["softmax"] / times[name])
+
+  def benchmark_lstm_implementation(self):
+    times = {}
+    for lstm_implementation in ["basic", "block"]:
+      model_config = configuration.ModelConfig()
+      model_config.lstm_implementation = lstm_implementation
+      times[lstm_implementation] = self._run(
+          "training_lstm_%s" % lstm_implementation, model_config)
+    tf.logging.info("Training step: basic %.1f ms, block %.1f ms (%.2fx)",
+                    times["basic"] * 1e3, times["block"] * 1e3,
+                    times["basic"] / times["block"])
+
+
+class InferenceStepBenchmark(tf.test.Benchmark):
+  """Measures the latency of one beam search step (softmax and LSTM state)."""
+
+  def _run(self, lstm_implementation, beam_size=3, num_steps=200):
+    model_config = configuration.ModelConfig()
+    model_config.lstm_implementation = lstm_implementation
+    g = tf.Graph()
+    with g.as_default():
+      model = show_and_tell_model.ShowAndTellModel(model_config,
+                                                   mode="inference")
+      model.build()
+      init = tf.global_variables_initializer()
+
+    rng = np.random.RandomState(0)
+    feed_dict = {
+        "input_feed:0": rng.randint(0, model_config.vocab_size,
+                                    size=beam_size),
+        "lstm/state_feed:0": rng.rand(beam_size,
+                                      2 * model_config.num_lstm_units),
+    }
+    with tf.Session(graph=g) as sess:
+      sess.run(init)
+      fetches = ["softmax:0", "lstm/state:0"]
+      sess.run(fetches, feed_dict)  # Warm up.
+      start = time.time()
+      for _ in range(num_steps):
+        sess.run(fetches, feed_dict)
+      wall_time = (time.time() - start) / num_steps
+
+    self.report_benchmark(iters=num_steps, wall_time=wall_time,
+                          name="inference_step_lstm_%s" % lstm_implementation)
+    return wall_time
+
+  def benchmark_lstm_implementation(self):
+    basic_time = self._run("basic")
+    block_time = self._run("block")
+    tf.logging.info("Inference step: basic %.3f ms, block %.3f ms (%.2fx)",
+                    basic_time * 1e3, block_time * 1e3, basic_time / block_time)
+
+
+if __name__ == "__main__":
+  tf.logging.set_verbosity(tf.logging.INFO)
+  tf.test.main()
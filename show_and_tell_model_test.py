@@ -36,11 +36,15 @@ class ShowAndTellModel(show_and_tell_model.ShowAndTellModel):
       return super(ShowAndTellModel, self).build_inputs()
     else:
       # Replace disk I/O with random Tensors.
-      self.images = tf.random_uniform(
-          shape=[self.config.batch_size, self.config.image_height,
-                 self.config.image_width, 3],
-          minval=-1,
-          maxval=1)
+      if self.config.use_inception_features:
+        self.inception_features = tf.random_uniform(
+            shape=[self.config.batch_size, self.config.inception_feature_size])
+      else:
+        self.images = tf.random_uniform(
+            shape=[self.config.batch_size, self.config.image_height,
+                   self.config.image_width, 3],
+            minval=-1,
+            maxval=1)
       self.input_seqs = tf.random_uniform(
           [self.config.batch_size, 15],
           minval=0,
@@ -165,6 +169,103 @@ class ShowAndTellModelTest(tf.test.TestCase):
     }
     self._checkOutputs(expected_shapes)
 
+  def testBuildForTrainingWithInceptionFeatures(self):
+    self._model_config.use_inception_features = True
+    model = ShowAndTellModel(self._model_config, mode="train")
+    model.build()
+
+    # The InceptionV3 variables are created even though they are not used.
+    self._checkModelParameters()
+    self.assertIsNone(model.images)
+
+    expected_shapes = {
+        # [batch_size, embedding_size]
+        model.image_embeddings: (32, 512),
+        # Scalar
+        model.total_loss: (),
+    }
+    self._checkOutputs(expected_shapes)
+
+  def _testBuildForTrainingWithLoss(self, training_loss, vocab_major=False):
+    self._model_config.training_loss = training_loss
+    self._model_config.logits_weights_vocab_major = vocab_major
+    model = ShowAndTellModel(self._model_config, mode="train")
+    model.build()
+
+    # The logits variables are unchanged, up to their layout.
+    self._checkModelParameters()
+    logits_weights = [v for v in tf.global_variables()
+                      if v.op.name == "logits/weights"][0]
+    self.assertEqual([12000, 512] if vocab_major else [512, 12000],
+                     logits_weights.get_shape().as_list())
+
+    expected_shapes = {
+        # Scalar
+        model.total_loss: (),
+        # [batch_size * sequence_length]
+        model.target_cross_entropy_losses: (480,),
+    }
+    self._checkOutputs(expected_shapes)
+
+  def testBuildForTrainingWithSampledSoftmax(self):
+    self._testBuildForTrainingWithLoss("sampled_softmax")
+
+  def testBuildForTrainingWithNCE(self):
+    self._testBuildForTrainingWithLoss("nce")
+
+  def testBuildForTrainingWithVocabMajorLogits(self):
+    self._testBuildForTrainingWithLoss("sampled_softmax", vocab_major=True)
+    # No op copies the whole logits weights matrix.
+    self.assertFalse([
+        op for op in tf.get_default_graph().get_operations()
+        if op.type == "Transpose" and
+        any(t.op.name.startswith("logits/weights") for t in op.inputs)])
+
+  def testBuildForEvalWithVocabMajorLogits(self):
+    self._model_config.logits_weights_vocab_major = True
+    model = ShowAndTellModel(self._model_config, mode="eval")
+    model.build()
+    self._checkOutputs({
+        # [batch_size * sequence_length]
+        model.target_cross_entropy_losses: (480,),
+    })
+
+  def testBuildForTrainingWithBlockLSTM(self):
+    self._model_config.lstm_implementation = "block"
+    model = ShowAndTellModel(self._model_config, mode="train")
+    model.build()
+
+    self._checkModelParameters()
+
+    expected_shapes = {
+        # Scalar
+        model.total_loss: (),
+        # [batch_size * sequence_length]
+        model.target_cross_entropy_losses: (480,),
+    }
+    self._checkOutputs(expected_shapes)
+
+  def testCheckpointVarListMapsLSTMImplementations(self):
+    checkpoint_path = self.get_temp_dir() + "/basic_lstm.ckpt"
+    with tf.Graph().as_default():
+      tf.Variable(tf.ones([3, 8]), name="lstm/basic_lstm_cell/kernel")
+      tf.Variable(tf.ones([8]), name="logits/biases")
+      with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        tf.train.Saver().save(sess, checkpoint_path)
+
+    with tf.Graph().as_default():
+      kernel = tf.Variable(tf.zeros([3, 8]), name="lstm/lstm_cell/kernel")
+      biases = tf.Variable(tf.zeros([8]), name="logits/biases")
+      var_list = show_and_tell_model.checkpoint_var_list(
+          tf.global_variables(), checkpoint_path)
+      self.assertDictEqual(
+          {"lstm/basic_lstm_cell/kernel": kernel, "logits/biases": biases},
+          var_list)
+      with tf.Session() as sess:
+        tf.train.Saver(var_list).restore(sess, checkpoint_path)
+        self.assertAllEqual(np.ones([3, 8]), sess.run(kernel))
+
   def testBuildForInference(self):
     model = ShowAndTellModel(self._model_config, mode="inference")
     model.build()
@@ -182,6 +283,15 @@ class ShowAndTellModelTest(tf.test.TestCase):
     }
     self._checkOutputs(expected_shapes, feed_dict)
 
+    # Test feeding a batch of images to get a batch of initial LSTM states.
+    images_feed = np.random.rand(4, 299, 299, 3)
+    feed_dict = {model.images: images_feed}
+    expected_shapes = {
+        # [batch_size, 2 * num_lstm_units]
+        "lstm/initial_state:0": (4, 1024),
+    }
+    self._checkOutputs(expected_shapes, feed_dict)
+
     # Test feeding a batch of inputs and LSTM states to get softmax output and
     # LSTM states.
     input_feed = np.random.randint(0, 10, size=3)
@@ -192,6 +302,21 @@ class ShowAndTellModelTest(tf.test.TestCase):
         "lstm/state:0": (3, 1024),
         # [batch_size, vocab_size]
         "softmax:0": (3, 12000),
+        # [batch_size, k]
+        "top_k/values:0": (3, 3),
+        "top_k/indices:0": (3, 3),
+    }
+    self._checkOutputs(expected_shapes, feed_dict)
+
+    # Test restricting the top k words to a shortlist.
+    feed_dict["top_k/k:0"] = 5
+    feed_dict["top_k/word_shortlist:0"] = [2, 3, 5, 7]
+    expected_shapes = {
+        # [batch_size, k]
+        "top_k/indices:0": (3, 5),
+        # [batch_size, min(k, shortlist_size)]
+        "top_k/shortlist_values:0": (3, 4),
+        "top_k/shortlist_indices:0": (3, 4),
     }
     self._checkOutputs(expected_shapes, feed_dict)
 
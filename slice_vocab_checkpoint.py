@@ -0,0 +1,124 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Shrinks a model checkpoint to the size of its vocabulary.
+
+Checkpoints trained with the default ModelConfig.vocab_size (12000) have word
+embedding rows and logits columns for word ids that the vocabulary never
+produces. This script keeps the first len(vocabulary) of them, in the variables
+and in any optimizer slots of the same shape, and copies every other variable
+unchanged. The result restores into a model whose vocab_size was fitted to the
+vocabulary, as train.py, evaluate.py and run_inference.py do when given
+--vocab_file.
+
+Usage:
+  python slice_vocab_checkpoint.py --checkpoint_path=model/train \
+    --vocab_file=data/out/word_counts.txt \
+    --output_checkpoint=model/sliced/model.ckpt
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+
+import tensorflow as tf
+
+import vocabulary
+
+FLAGS = tf.flags.FLAGS
+
+tf.flags.DEFINE_string("checkpoint_path", "",
+                       "Model checkpoint file or directory containing a "
+                       "model checkpoint file.")
+tf.flags.DEFINE_string("vocab_file", "", "Text file containing the vocabulary.")
+tf.flags.DEFINE_string("output_checkpoint", "",
+                       "Path prefix of the output checkpoint.")
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+# Variables with a vocab_size dimension, mapped to the indices the dimension
+# may have. The first of them with the checkpoint's vocab_size is sliced; the
+# logits weights may be vocab-major (see ModelConfig.logits_weights_vocab_major).
+VOCAB_VARIABLES = {
+    "seq_embedding/map": (0,),
+    "logits/weights": (1, 0),
+    "logits/biases": (0,),
+}
+
+
+def slice_vocab_variable(name, value, vocab_size, old_vocab_size):
+  """Slices a checkpoint value to vocab_size if it is a vocab variable.
+
+  Args:
+    name: Variable name in the checkpoint.
+    value: numpy array value of the variable.
+    vocab_size: Target vocabulary size.
+    old_vocab_size: Vocabulary size of the checkpoint.
+
+  Returns:
+    The sliced value, or value itself if name is not a vocab variable or one
+    of its optimizer slots.
+  """
+  for prefix, axes in VOCAB_VARIABLES.items():
+    if name != prefix and not name.startswith(prefix + "/"):
+      continue
+    for axis in axes:
+      if value.ndim > axis and value.shape[axis] == old_vocab_size:
+        index = [slice(None)] * value.ndim
+        index[axis] = slice(0, vocab_size)
+        return value[tuple(index)]
+  return value
+
+
+def main(unused_argv):
+  assert FLAGS.checkpoint_path, "--checkpoint_path is required"
+  assert FLAGS.vocab_file, "--vocab_file is required"
+  assert FLAGS.output_checkpoint, "--output_checkpoint is required"
+
+  checkpoint_path = FLAGS.checkpoint_path
+  if tf.gfile.IsDirectory(checkpoint_path):
+    checkpoint_path = tf.train.latest_checkpoint(checkpoint_path)
+    if not checkpoint_path:
+      raise ValueError("No checkpoint file found in: %s" % FLAGS.checkpoint_path)
+
+  vocab_size = len(vocabulary.Vocabulary(FLAGS.vocab_file))
+  reader = tf.train.NewCheckpointReader(checkpoint_path)
+  shapes = reader.get_variable_to_shape_map()
+  old_vocab_size = shapes["seq_embedding/map"][0]
+  if vocab_size > old_vocab_size:
+    raise ValueError("Vocabulary has %d words, but the checkpoint only %d." %
+                     (vocab_size, old_vocab_size))
+
+  g = tf.Graph()
+  with g.as_default():
+    variables = []
+    for name in sorted(shapes):
+      value = slice_vocab_variable(name, reader.get_tensor(name), vocab_size,
+                                   old_vocab_size)
+      if value.shape != tuple(shapes[name]):
+        tf.logging.info("Sliced %s from %s to %s", name, shapes[name],
+                        list(value.shape))
+      variables.append(tf.Variable(value, name=name))
+    saver = tf.train.Saver(variables)
+
+  with tf.Session(graph=g) as sess:
+    sess.run(tf.variables_initializer(variables))
+    saver.save(sess, FLAGS.output_checkpoint, write_meta_graph=False)
+  tf.logging.info("Wrote checkpoint with vocab_size %d (was %d) to %s",
+                  vocab_size, old_vocab_size, FLAGS.output_checkpoint)
+
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -23,6 +23,7 @@ import tensorflow as tf
 
 import configuration
 import show_and_tell_model
+import vocabulary
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -30,10 +31,20 @@ tf.flags.DEFINE_string("input_file_pattern", "",
                        "File pattern of sharded TFRecord input files.")
 tf.flags.DEFINE_string("inception_checkpoint_file", "",
                        "Path to a pretrained inception_v3 model.")
+tf.flags.DEFINE_string("vocab_file", "",
+                       "Optional vocabulary file (word_counts.txt). If given, "
+                       "the model's vocab_size is fitted to it.")
 tf.flags.DEFINE_string("train_dir", "",
                        "Directory for saving and loading model checkpoints.")
 tf.flags.DEFINE_boolean("train_inception", False,
                         "Whether to train inception submodel variables.")
+tf.flags.DEFINE_boolean("use_inception_features", False,
+                        "Whether the input files contain precomputed "
+                        "InceptionV3 outputs instead of images.")
+tf.flags.DEFINE_string("training_loss", "softmax",
+                       "Training loss: softmax, sampled_softmax or nce.")
+tf.flags.DEFINE_string("lstm_implementation", "basic",
+                       "LSTM cell implementation: basic or block.")
 tf.flags.DEFINE_integer("number_of_steps", 1000000, "Number of training steps.")
 tf.flags.DEFINE_integer("log_every_n_steps", 1,
                         "Frequency at which loss and global step are logged.")
@@ -48,6 +59,11 @@ def main(unused_argv):
   model_config = configuration.ModelConfig()
   model_config.input_file_pattern = FLAGS.input_file_pattern
   model_config.inception_checkpoint_file = FLAGS.inception_checkpoint_file
+  model_config.use_inception_features = FLAGS.use_inception_features
+  model_config.training_loss = FLAGS.training_loss
+  model_config.lstm_implementation = FLAGS.lstm_implementation
+  if FLAGS.vocab_file:
+    model_config.vocab_size = len(vocabulary.Vocabulary(FLAGS.vocab_file))
   training_config = configuration.TrainingConfig()
 
   # Create training directory.
@@ -56,6 +72,12 @@ def main(unused_argv):
     tf.logging.info("Creating training directory: %s", train_dir)
     tf.gfile.MakeDirs(train_dir)
 
+  # The sampled losses gather rows of vocab-major logits weights. Training
+  # resumed from a checkpoint keeps that checkpoint's layout.
+  model_config.logits_weights_vocab_major = (
+      show_and_tell_model.checkpoint_logits_vocab_major(
+          train_dir, default=FLAGS.training_loss != "softmax"))
+
   # Build the TensorFlow graph.
   g = tf.Graph()
   with g.as_default():
@@ -96,7 +118,12 @@ def main(unused_argv):
         learning_rate_decay_fn=learning_rate_decay_fn)
 
     # Set up the Saver for saving and restoring model checkpoints.
-    saver = tf.train.Saver(max_to_keep=training_config.max_checkpoints_to_keep)
+    # Training resumed from a checkpoint of the other lstm_implementation keeps
+    # that checkpoint's variable names.
+    saver = tf.train.Saver(
+        show_and_tell_model.checkpoint_var_list(tf.global_variables(),
+                                                train_dir),
+        max_to_keep=training_config.max_checkpoints_to_keep)
 
   # Run training.
   tf.contrib.slim.learning.train(
@@ -63,6 +63,10 @@ class Vocabulary(object):
     self.end_id = vocab[end_word]
     self.unk_id = vocab[unk_word]
 
+  def __len__(self):
+    """Returns the number of word ids, including the unknown word."""
+    return len(self.reverse_vocab)
+
   def word_to_id(self, word):
     """Returns the integer word id of a word string."""
     if word in self.vocab: